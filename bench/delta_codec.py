@@ -0,0 +1,86 @@
+# Copyright 2011 Omniscale (http://omniscale.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmark of the native delta codec of the compact coords cache against
+the protobuf codec (``DeltaCoords``) of older versions.
+
+    python bench/delta_codec.py [number of blocks]
+"""
+
+import random
+import sys
+import time
+
+from imposm.cache.tc import DeltaNodes
+from imposm.cache.internal import DeltaCoords
+
+COORD_FACTOR = 11930464.7083
+
+def create_blocks(n, block_size=64):
+    blocks = []
+    osmid = 1000000
+    lon, lat = 8.0, 53.0
+    for _ in xrange(n):
+        block = DeltaNodes()
+        for _ in xrange(block_size):
+            # mostly consecutive ids and nearby coords
+            osmid += random.randint(1, 3)
+            lon += random.uniform(-0.001, 0.001)
+            lat += random.uniform(-0.001, 0.001)
+            block.add(osmid, lon, lat)
+        blocks.append(block)
+    return blocks
+
+def protobuf_serialize(block):
+    ids, lons, lats = [], [], []
+    last_id = last_lon = last_lat = 0
+    for osmid, lon, lat in block.nodes:
+        lon = int((lon + 180.0) * COORD_FACTOR)
+        lat = int((lat + 180.0) * COORD_FACTOR)
+        ids.append(osmid - last_id)
+        lons.append(lon - last_lon)
+        lats.append(lat - last_lat)
+        last_id, last_lon, last_lat = osmid, lon, lat
+    msg = DeltaCoords()
+    msg.ids = ids
+    msg.lons = lons
+    msg.lats = lats
+    return msg.SerializeToString()
+
+def timeit(title, func, items):
+    start = time.time()
+    for item in items:
+        func(item)
+    duration = time.time() - start
+    print '%-22s %8.3fs %10.0f blocks/s' % (title, duration, len(items) / duration)
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    blocks = create_blocks(n)
+
+    protobuf_data = [protobuf_serialize(b) for b in blocks]
+    native_data = [b.serialize() for b in blocks]
+    print 'size protobuf: %.1fMB native: %.1fMB' % (
+        sum(map(len, protobuf_data)) / 1024.0 / 1024.0,
+        sum(map(len, native_data)) / 1024.0 / 1024.0,
+    )
+
+    timeit('serialize protobuf', protobuf_serialize, blocks)
+    timeit('serialize native', lambda b: b.serialize(), blocks)
+    timeit('deserialize protobuf', DeltaNodes, protobuf_data)
+    timeit('deserialize native', DeltaNodes, native_data)
+
+if __name__ == '__main__':
+    main()
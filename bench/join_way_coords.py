@@ -0,0 +1,104 @@
+# Copyright 2011 Omniscale (http://omniscale.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmark of --join-way-coords (`imposm.cache.tc.join_way_coords`)
+against the lookups of the refs of each way in the coords cache with
+`get_ways_coords_array`, as the writer does without the join.
+The refs are random node ids, like the refs of ways in a large extract.
+
+    python bench/join_way_coords.py [number of ways] [refs of each way] [nodes]
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from imposm.cache.tc import CoordDB, WayDB, WayCoordsDB, join_way_coords
+
+# ways that are resolved at once, same as the batches of the writer
+BATCH_WAYS = 1000
+
+def create_caches(path, n, refs, nodes):
+    coords = CoordDB(os.path.join(path, 'coords.cache'), estimated_records=nodes)
+    for osmid in xrange(1, nodes + 1):
+        coords.put(osmid, random.uniform(-180, 180), random.uniform(-90, 90))
+    coords.close()
+    ways = WayDB(os.path.join(path, 'ways.cache'), estimated_records=n)
+    for osmid in xrange(1, n + 1):
+        ways.put(osmid, {}, [random.randint(1, nodes) for _ in xrange(refs)])
+    ways.close()
+
+def batches(ways):
+    batch = []
+    for way in ways:
+        batch.append(way)
+        if len(batch) == BATCH_WAYS:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def lookup_refs(path):
+    coords = CoordDB(os.path.join(path, 'coords.cache'), 'r')
+    ways = WayDB(os.path.join(path, 'ways.cache'), 'r')
+    for batch in batches(ways):
+        coords.get_ways_coords_array([way.refs for way in batch])
+    coords.close()
+    ways.close()
+
+def join(path):
+    coords = CoordDB(os.path.join(path, 'coords.cache'), 'r')
+    ways = WayDB(os.path.join(path, 'ways.cache'), 'r')
+    way_coords = WayCoordsDB(os.path.join(path, 'way_coords.cache'),
+        estimated_records=len(ways))
+    join_way_coords(ways, coords, way_coords, path)
+    for c in (coords, ways, way_coords):
+        c.close()
+
+def lookup_way_coords(path):
+    ways = WayDB(os.path.join(path, 'ways.cache'), 'r')
+    way_coords = WayCoordsDB(os.path.join(path, 'way_coords.cache'), 'r')
+    for batch in batches(ways):
+        way_coords.get_ways_coords_array([way.osm_id for way in batch])
+    ways.close()
+    way_coords.close()
+
+def timeit(title, func, path):
+    start = time.time()
+    func(path)
+    duration = time.time() - start
+    print '%-20s %8.3fs' % (title, duration)
+    return duration
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    refs = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    nodes = int(sys.argv[3]) if len(sys.argv) > 3 else 2000000
+    path = tempfile.mkdtemp()
+    try:
+        create_caches(path, n, refs, nodes)
+        print '%d ways with %d refs, %d nodes' % (n, refs, nodes)
+        timeit('lookup refs', lookup_refs, path)
+        duration = timeit('join', join, path)
+        duration += timeit('lookup way coords', lookup_way_coords, path)
+        print '%-20s %8.3fs' % ('join + lookup', duration)
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == '__main__':
+    main()
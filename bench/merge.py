@@ -0,0 +1,112 @@
+# Copyright 2011 Omniscale (http://omniscale.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmark of the ref merging of --merge-cache (`imposm.merge.multimerge`)
+against the ``difflib.SequenceMatcher`` based merge of older versions.
+Long ways are split into overlapping parts, as if each part was read
+from a different extract.
+
+    python bench/merge.py [number of ways] [refs of each way] [extracts]
+"""
+
+import difflib
+import random
+import sys
+import time
+
+from imposm.merge import multimerge, permutations
+
+def difflib_merge(a, b):
+    sqm = difflib.SequenceMatcher(None, a, b)
+    matching_blocks = sqm.get_matching_blocks()
+    matching_blocks.pop(-1)
+
+    if not matching_blocks:
+        return None
+
+    a_idx = b_idx = 0
+    result = []
+
+    for block in matching_blocks:
+        if a_idx < block[0]:
+            result.extend(a[a_idx:block[0]])
+        if b_idx < block[1]:
+            result.extend(b[b_idx:block[1]])
+        a_idx = block[0]+block[-1]
+        b_idx = block[1]+block[-1]
+        result.extend(a[block[0]:block[0]+block[-1]])
+
+    if a_idx < len(a):
+        result.extend(a[a_idx:])
+    if b_idx < len(b):
+        result.extend(b[b_idx:])
+
+    return result
+
+def difflib_multimerge(candidates):
+    candidates = list(candidates)
+    while len(candidates) > 1:
+        for a, b in permutations(candidates, 2):
+            res = difflib_merge(a, b)
+            if res is not None:
+                break
+        else:
+            return candidates
+        candidates.remove(b)
+        candidates.remove(a)
+        candidates.append(res)
+    return candidates[0]
+
+def create_ways(n, refs, extracts):
+    """
+    Return the refs of `n` ways, each split into `extracts` overlapping
+    parts in random order.
+    """
+    ways = []
+    osmid = 1000000
+    for _ in xrange(n):
+        way = range(osmid, osmid + refs)
+        osmid += refs
+        bounds = sorted(random.sample(xrange(1, refs - 1), extracts - 1))
+        parts = []
+        start = 0
+        for end in bounds + [refs]:
+            # neighbouring extracts share a few refs at the border
+            parts.append(way[max(0, start - random.randint(1, 5)):end])
+            start = end
+        random.shuffle(parts)
+        ways.append((way, parts))
+    return ways
+
+def timeit(title, multimerge_func, ways):
+    start = time.time()
+    for way, parts in ways:
+        result = multimerge_func(parts)
+        assert result == way
+    duration = time.time() - start
+    print '%-10s %8.3fs %10.1f ways/s' % (title, duration, len(ways) / duration)
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    refs = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    extracts = int(sys.argv[3]) if len(sys.argv) > 3 else 16
+    ways = create_ways(n, refs, extracts)
+    print '%d ways with %d refs in %d extracts' % (n, refs, extracts)
+
+    timeit('merge', multimerge, ways)
+    timeit('difflib', difflib_multimerge, ways)
+
+if __name__ == '__main__':
+    main()
@@ -13,9 +13,10 @@
 # limitations under the License.
 
 from __future__ import with_statement
-import glob
 import sys
 import os
+import atexit
+import shutil
 import optparse
 import logging
 
@@ -42,6 +43,8 @@ import imposm.version
 from imposm.writer import ImposmWriter
 from imposm.db.config import DB, check_connection
 from imposm.cache import OSMCache
+from imposm.cache.osm import memory_cache_dir
+from imposm.cache.tc import coords_precision
 from imposm.reader import ImposmReader
 from imposm.mapping import TagMapper
 from imposm.geom import load_geom
@@ -90,6 +93,9 @@ def main(argv=None):
 
     parser.add_option('-c', '--concurrency', dest='concurrency', metavar='N',
                       type='int', default=n_cpu)
+    parser.add_option('--write-threads', dest='write_threads', metavar='N',
+        type='int', help="threads of each way/relation writer process, the "
+        "threads share the caches of their process")
 
     parser.add_option('--merge-cache', dest='merge_cache', default=False,
         action='store_true')
@@ -97,6 +103,48 @@ def main(argv=None):
         action='store_true')
     parser.add_option('--cache-dir', dest='cache_dir', default='.',
         help="path where node/ways/relations should be cached [current working dir]")
+    parser.add_option('--merge-cache-dirs', dest='merge_cache_dirs', metavar='DIR,DIR,...',
+        help="merge the caches of these dirs into the --cache-dir, e.g. the "
+        "caches of extracts that were read in parallel with their own --cache-dir")
+    parser.add_option('--memory-cache', dest='memory_cache', default=False,
+        action='store_true', help="keep the caches in shared memory (/dev/shm) "
+        "instead of the --cache-dir, starts with a copy of the existing caches")
+    parser.add_option('--memory-cache-dump', dest='memory_cache_dump', default=False,
+        action='store_true', help="copy the caches from memory to the --cache-dir "
+        "before writing")
+    parser.add_option('--dense-coords-cache', dest='dense_coords_cache', default=False,
+        action='store_true', help="store coords in a memory-mapped file indexed "
+        "by node id, recommended for planet imports")
+    parser.add_option('--coords-block-cache-size', dest='coords_block_cache_size',
+        metavar='MB', type='int', default=None, help="cache size for decoded "
+        "coords blocks of the compact coords cache, for each process")
+    parser.add_option('--coords-shared-cache-size', dest='coords_shared_cache_size',
+        metavar='MB', type='int', default=None, help="cache size for decoded "
+        "coords blocks that is shared by all writer processes [disabled]")
+    parser.add_option('--coords-precision', dest='coords_precision',
+        metavar='DEGREES', default=None, help="precision of the cached coords "
+        "in degrees, or 'osm' (1e-7) or 'render' (1e-6) [full 32bit precision]")
+    parser.add_option('--join-way-coords', dest='join_way_coords', default=False,
+        action='store_true', help="join the ways with their coords after "
+        "reading, speeds up the writing of large imports")
+    parser.add_option('--freeze-cache', dest='freeze_cache', default=False,
+        action='store_true', help="convert the nodes/ways/relations caches "
+        "into read-only files that are faster to read")
+    parser.add_option('--cache-shards', dest='cache_shards', metavar='N',
+        type='int', default=None, help="split each cache into N files with "
+        "one writer process for each file")
+    parser.add_option('--compact-cache', dest='compact_cache', default=False,
+        action='store_true', help="rewrite the caches in key order, use after "
+        "--merge-cache to speed up --write")
+    parser.add_option('--compact-cache-compression', dest='compact_cache_compression',
+        default=None, type='choice', choices=['none', 'deflate', 'bzip', 'tcbs'],
+        help="recompress the caches with --compact-cache")
+    parser.add_option('--cache-stats', dest='cache_stats', default=False,
+        action='store_true', help="print gets, misses, bytes and timings "
+        "of all caches at the end of each phase")
+    parser.add_option('--pipeline-stats', dest='pipeline_stats', default=False,
+        action='store_true', help="print the depths and blocked times of the "
+        "queues between the read/write stages at the end of each phase")
 
 
     parser.add_option('--table-prefix',
@@ -140,13 +188,17 @@ def main(argv=None):
         options.help = True
 
     if not any([options.read, options.write, options.optimize, options.deploy_tables,
-        options.recover_tables, options.remove_backup_tables]):
+        options.recover_tables, options.remove_backup_tables, options.compact_cache,
+        options.freeze_cache, options.join_way_coords, options.merge_cache_dirs]):
         options.help = True
 
     if options.help:
         parser.print_help()
         sys.exit(1)
 
+    if options.read and options.merge_cache_dirs:
+        parser.error('--read and --merge-cache-dirs cannot be used together')
+
     if options.quiet:
         logger = imposm.util.QuietProgressLog
         logger_parser = imposm.util.QuietParserProgress
@@ -187,6 +239,29 @@ def main(argv=None):
         imposm.config.imposm_multipolygon_report = float(os.environ['IMPOSM_MULTIPOLYGON_REPORT'])
     if 'IMPOSM_MULTIPOLYGON_MAX_RING' in os.environ:
         imposm.config.imposm_multipolygon_max_ring = int(os.environ['IMPOSM_MULTIPOLYGON_MAX_RING'])
+    if options.dense_coords_cache:
+        imposm.config.imposm_dense_coords_cache = True
+    if options.coords_block_cache_size is not None:
+        imposm.config.imposm_coords_block_cache_size = options.coords_block_cache_size
+    if options.coords_shared_cache_size is not None:
+        imposm.config.imposm_coords_shared_cache_size = options.coords_shared_cache_size
+    if options.coords_precision is not None:
+        try:
+            imposm.config.imposm_coords_precision = coords_precision(options.coords_precision)
+        except ValueError, ex:
+            parser.error('--coords-precision: %s' % ex)
+    if options.cache_shards is not None:
+        imposm.config.imposm_cache_shards = options.cache_shards
+    if options.write_threads is not None:
+        imposm.config.imposm_write_threads = options.write_threads
+    if options.cache_stats:
+        imposm.config.imposm_cache_stats = True
+    if options.pipeline_stats:
+        imposm.config.imposm_pipeline_stats = True
+    if options.memory_cache:
+        imposm.config.imposm_memory_cache = True
+    if imposm.config.imposm_cache_processes is None:
+        imposm.config.imposm_cache_processes = options.concurrency
 
     if options.table_prefix:
         options.table_prefix = options.table_prefix.rstrip('_') + '_'
@@ -222,9 +297,39 @@ def main(argv=None):
 
     imposm_timer = imposm.util.Timer('imposm', logger)
 
+    cache = OSMCache(options.cache_dir)
+    # the caches that the memory cache starts with, they are checked
+    # before they are copied
+    existing_cache = cache
+    if imposm.config.imposm_memory_cache:
+        try:
+            memory_path = memory_cache_dir()
+        except IOError, ex:
+            print 'ERROR: --memory-cache: %s' % ex
+            sys.exit(2)
+        cache = OSMCache(memory_path)
+        atexit.register(shutil.rmtree, cache.path, True)
+        logger.message('## keeping the caches in %s' % cache.path)
+        if options.overwrite_cache:
+            existing_cache = cache
+
+    if options.read:
+        if not args:
+            print "no file(s) supplied"
+            sys.exit(2)
+
+        # inputs that are not in the existing caches, None if there
+        # is no manifest that matches the inputs and the mapping
+        mapping_hash = tag_mapping.tag_filter_hash()
+        unread_inputs = existing_cache.unread_inputs(args, mapping_hash)
+        if unread_inputs == []:
+            logger.message('## caches are up to date with the input files and '
+                'mapping, skipping --read')
+            options.read = False
+
     if options.read:
-        if not options.merge_cache:
-            cache_files = glob.glob(os.path.join(options.cache_dir, 'imposm_*.cache'))
+        if unread_inputs is None and not options.merge_cache:
+            cache_files = existing_cache.files()
             if cache_files:
                 if not options.overwrite_cache:
                     print (
@@ -238,29 +343,90 @@ def main(argv=None):
                 for cache_file in cache_files:
                     os.unlink(cache_file)
 
-    cache = OSMCache(options.cache_dir)
+    if options.merge_cache_dirs:
+        cache_files = existing_cache.files()
+        if cache_files:
+            if not options.overwrite_cache:
+                print (
+                    "ERROR: found existing cache files in '%s'. "
+                    'Use --overwrite-cache to overwrite them with the merged caches.'
+                    % os.path.abspath(options.cache_dir)
+                )
+                sys.exit(2)
+            for cache_file in cache_files:
+                os.unlink(cache_file)
+
+    if existing_cache is not cache:
+        existing_cache.copy_files(cache.path)
 
     if options.read:
         read_timer = imposm.util.Timer('reading', logger)
 
-        if not args:
-            print "no file(s) supplied"
-            sys.exit(2)
-
         if options.write:
             err = check_connection(db_conf)
             if err:
                 logger.message("ERROR: unable to connect to database. Check your DB settings.\n{0}".format(err))
                 sys.exit(2)
 
+        previous_manifest = cache.remove_manifest()
+        cache.remove_way_coords_cache()
+        if unread_inputs is None:
+            previous_manifest = None
+            unread_inputs = args
+        else:
+            logger.message('## caches are up to date with %s, reading only the '
+                'new input files' % ', '.join(args[:len(args) - len(unread_inputs)]))
+
         reader = ImposmReader(tag_mapping, cache=cache, merge=options.merge_cache,
             pool_size=options.concurrency, logger=logger_parser)
-        reader.estimated_coords = imposm.util.estimate_records(args)
-        for arg in args:
+        reader.estimated_coords = imposm.util.estimate_records(unread_inputs)
+        for arg in unread_inputs:
             logger.message('## reading %s' % arg)
             reader.read(arg)
+        # the origin of merged caches is unknown without a manifest
+        if previous_manifest is not None or not options.merge_cache:
+            cache.write_manifest(args, mapping_hash, previous_manifest)
         read_timer.stop()
 
+    if options.merge_cache_dirs:
+        merge_timer = imposm.util.Timer('merging caches', logger)
+        sources = [OSMCache(path) for path in options.merge_cache_dirs.split(',')]
+        counts = cache.merge_caches(sources)
+        logger.message('## merged %d coords, %d nodes, %d ways and %d relations' % (
+            counts['coords'], counts['nodes'], counts['ways'], counts['relations']))
+        merge_timer.stop()
+
+    if options.compact_cache or ((options.read or options.merge_cache_dirs)
+        and imposm.config.imposm_compact_cache):
+        compact_timer = imposm.util.Timer('compacting cache', logger)
+        compress = False
+        if options.compact_cache_compression:
+            compress = options.compact_cache_compression
+            if compress == 'none':
+                compress = None
+        for (fname, records, size_before, size_after,
+            scan_before, scan_after) in cache.compact(compress=compress):
+            logger.message('%s: %d records, %.1fMB -> %.1fMB, '
+                'scan %d -> %d records/s' % (os.path.basename(fname), records,
+                size_before / 1024.0 / 1024.0, size_after / 1024.0 / 1024.0,
+                records / max(scan_before, 1e-6), records / max(scan_after, 1e-6)))
+        compact_timer.stop()
+
+    if options.freeze_cache:
+        freeze_timer = imposm.util.Timer('freezing cache', logger)
+        cache.freeze()
+        freeze_timer.stop()
+
+    if options.join_way_coords or ((options.read or options.merge_cache_dirs)
+        and imposm.config.imposm_join_way_coords):
+        join_timer = imposm.util.Timer('joining ways with coords', logger)
+        logger.message('## joined %d ways with their coords' % cache.join_way_coords())
+        join_timer.stop()
+
+    if imposm.config.imposm_memory_cache and options.memory_cache_dump:
+        logger.message('## copying the caches to %s' % options.cache_dir)
+        cache.copy_files(options.cache_dir)
+
     if options.write:
         db = DB(db_conf)
         write_timer = imposm.util.Timer('writing', logger)
@@ -0,0 +1,54 @@
+# Copyright 2011 Omniscale (http://omniscale.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Streaming k-way merge of caches that were read independently
+(e.g. one cache for each extract, see ``--merge-cache-dirs``).
+
+All caches are iterated in id order at the same time, so the sources
+are read and the merged cache is written sequentially. Elements are
+only merged (`Way.merge`, `Relation.merge`) if an id is in multiple
+caches.
+"""
+
+import heapq
+from itertools import groupby
+from operator import itemgetter
+
+def merge_sorted(iterables, key, combine):
+    """
+    Return the items of the sorted `iterables` in sorted order. Items
+    with the same `key` are combined with ``combine(item, other)``, in
+    the order of the `iterables`.
+
+    >>> list(merge_sorted([[1, 3, 5], [2, 3]], lambda x: x, lambda a, b: a * 10))
+    [1, 2, 30, 5]
+    """
+    decorated = [((key(item), i, item) for item in iterable)
+        for i, iterable in enumerate(iterables)]
+    for _, items in groupby(heapq.merge(*decorated), itemgetter(0)):
+        _, _, result = items.next()
+        for _, _, other in items:
+            result = combine(result, other)
+        yield result
+
+def merge_elems(elem, other):
+    """
+    Merge the tags and refs/members of two nodes/ways/relations.
+    """
+    elem.merge(*other.to_tuple()[1:])
+    return elem
+
+def first_item(item, other):
+    return item
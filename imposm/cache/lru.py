@@ -0,0 +1,134 @@
+# Copyright 2011 Omniscale (http://omniscale.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+PREV, NEXT, KEY, VALUE, SIZE = 0, 1, 2, 3, 4
+
+class LRUCache(object):
+    """
+    Least recently used cache with a budget in bytes.
+
+    The size of each item is passed to `put`. `on_evict` is called with
+    the key and value of each item that is removed from the cache.
+
+    >>> evicted = []
+    >>> cache = LRUCache(100, on_evict=lambda k, v: evicted.append(k))
+    >>> cache.put(1, 'a', 40)
+    >>> cache.put(2, 'b', 40)
+    >>> cache.get(1)
+    'a'
+    >>> cache.put(3, 'c', 40)
+    >>> evicted
+    [2]
+    >>> cache.get(2) is None
+    True
+    >>> sorted(cache.stats().items())
+    [('bytes', 80), ('evictions', 1), ('hits', 1), ('items', 2), ('misses', 1)]
+    """
+    def __init__(self, max_bytes, on_evict=None):
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = {}
+        # circular doubly linked list, most recently used item is root[NEXT]
+        self._root = root = []
+        root[:] = [root, root, None, None, 0]
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key):
+        """
+        Return the value for `key` and mark it as recently used.
+        Returns None if the key is not cached.
+        """
+        item = self._items.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._unlink(item)
+        self._link(item)
+        return item[VALUE]
+
+    def put(self, key, value, size):
+        """
+        Add or replace `key`. Evicts the least recently used items
+        until the cache fits into the budget again. The new item
+        itself is never evicted.
+        """
+        item = self._items.get(key)
+        if item is not None:
+            self._unlink(item)
+            self.bytes -= item[SIZE]
+            item[VALUE] = value
+            item[SIZE] = size
+        else:
+            item = [None, None, key, value, size]
+            self._items[key] = item
+        self._link(item)
+        self.bytes += size
+
+        root = self._root
+        while self.bytes > self.max_bytes and root[PREV] is not item:
+            self._evict(root[PREV])
+
+    def clear(self):
+        """
+        Remove all items, calls `on_evict` for each item.
+        """
+        root = self._root
+        while root[PREV] is not root:
+            self._evict(root[PREV], count=False)
+
+    def values(self):
+        """
+        Return all cached values, most recently used first.
+        """
+        result = []
+        item = self._root[NEXT]
+        while item is not self._root:
+            result.append(item[VALUE])
+            item = item[NEXT]
+        return result
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses,
+            evictions=self.evictions, items=len(self._items), bytes=self.bytes)
+
+    def _evict(self, item, count=True):
+        self._unlink(item)
+        del self._items[item[KEY]]
+        self.bytes -= item[SIZE]
+        if count:
+            self.evictions += 1
+        if self.on_evict is not None:
+            self.on_evict(item[KEY], item[VALUE])
+
+    def _link(self, item):
+        root = self._root
+        first = root[NEXT]
+        item[PREV] = root
+        item[NEXT] = first
+        first[PREV] = item
+        root[NEXT] = item
+
+    def _unlink(self, item):
+        item[PREV][NEXT] = item[NEXT]
+        item[NEXT][PREV] = item[PREV]
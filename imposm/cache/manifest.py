@@ -0,0 +1,114 @@
+# Copyright 2011 Omniscale (http://omniscale.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import with_statement
+
+import os
+import marshal
+import hashlib
+
+MANIFEST_FORMAT_VERSION = 1
+
+def file_sha1(filename, chunk_size=1024*1024):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+def input_fingerprint(filename):
+    """
+    Return the name, size, mtime and SHA1 of `filename`.
+    """
+    st = os.stat(filename)
+    return dict(name=os.path.basename(filename), size=st.st_size,
+        mtime=int(st.st_mtime), sha1=file_sha1(filename))
+
+def input_matches(fingerprint, filename):
+    """
+    Check if `filename` has the content of the `fingerprint`. Files with
+    the same name, size and mtime are not hashed again.
+    """
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return False
+    if st.st_size != fingerprint['size']:
+        return False
+    if (os.path.basename(filename) == fingerprint['name']
+        and int(st.st_mtime) == fingerprint['mtime']):
+        return True
+    return file_sha1(filename) == fingerprint['sha1']
+
+class CacheManifest(object):
+    """
+    Records what produced the caches: the fingerprints of the input
+    files in the order they were read, the hash of the tag filters of
+    the mapping, the format versions and options of the caches and the
+    number of records in each cache.
+    """
+    def __init__(self, inputs, mapping_hash, formats, options, counts):
+        self.inputs = inputs
+        self.mapping_hash = mapping_hash
+        self.formats = formats
+        self.options = options
+        self.counts = counts
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Return the manifest in `filename` or None if it is missing
+        or was written by another version.
+        """
+        if not os.path.exists(filename):
+            return None
+        try:
+            with open(filename, 'rb') as f:
+                data = marshal.load(f)
+        except (EOFError, ValueError, TypeError):
+            return None
+        if not isinstance(data, dict) or data.get('version') != MANIFEST_FORMAT_VERSION:
+            return None
+        return cls(data['inputs'], data['mapping_hash'], data['formats'],
+            data['options'], data['counts'])
+
+    def save(self, filename):
+        data = dict(version=MANIFEST_FORMAT_VERSION, inputs=self.inputs,
+            mapping_hash=self.mapping_hash, formats=self.formats,
+            options=self.options, counts=self.counts)
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            marshal.dump(data, f, 2)
+        os.rename(tmp_filename, filename)
+
+    def unread_inputs(self, filenames, mapping_hash, formats, options, counts):
+        """
+        Return the `filenames` that are not in the caches yet. The caches
+        are only reusable if they were read from the first `filenames`
+        with the same mapping, formats and options and if they still
+        contain all records. Returns None if the caches need to be read
+        again from scratch.
+        """
+        if (mapping_hash != self.mapping_hash or formats != self.formats
+            or options != self.options or counts != self.counts):
+            return None
+        if len(self.inputs) > len(filenames):
+            return None
+        for fingerprint, filename in zip(self.inputs, filenames):
+            if not input_matches(fingerprint, filename):
+                return None
+        return filenames[len(self.inputs):]
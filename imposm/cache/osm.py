@@ -12,11 +12,37 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from __future__ import with_statement
+
 import os
+import glob
+import heapq
+import time
+import logging
+import tempfile
+from operator import attrgetter, itemgetter
 
 import imposm.config
 
-from . tc import DeltaCoordsDB, CoordDB, NodeDB, WayDB, InsertedWayDB, RelationDB
+from . tc import DeltaCoordsDB, CoordDB, DenseCoordDB, NodeDB, WayDB, IdBitmap, RelationDB
+from . tc import SharedBlockCache, WayCoordsDB, join_way_coords
+from . tc import is_dense_coords_file, is_frozen_file, freeze_db
+from . tc import BDB, FrozenNodeDB, FrozenWayDB, FrozenRelationDB, CACHE_FORMAT_VERSIONS
+from . tagdict import TagDictionary, TAG_DICT_FORMAT_VERSION
+from . manifest import CacheManifest, input_fingerprint
+from . shard import ShardedCache
+from . kmerge import merge_sorted, merge_elems, first_item
+from . tuning import tuning_profile
+from . import stats as cache_stats
+
+log = logging.getLogger(__name__)
+
+# caches that can be frozen with their read-only class
+FROZEN_CLASSES = {
+    NodeDB: FrozenNodeDB,
+    WayDB: FrozenWayDB,
+    RelationDB: FrozenRelationDB,
+}
 
 class OSMCache(object):
     def __init__(self, path, prefix='imposm_', suffix='.cache'):
@@ -27,45 +53,513 @@ class OSMCache(object):
         self.nodes_fname = os.path.join(path, prefix + 'nodes' + suffix) 
         self.ways_fname = os.path.join(path, prefix + 'ways' + suffix) 
         self.inserted_ways_fname = os.path.join(path, prefix + 'inserted_ways' + suffix) 
+        self.way_coords_fname = os.path.join(path, prefix + 'way_coords' + suffix)
         self.relations_fname = os.path.join(path, prefix + 'relations' + suffix) 
+        self.tags_fname = os.path.join(path, prefix + 'tags' + suffix)
+        self.manifest_fname = os.path.join(path, prefix + 'manifest' + suffix)
         self.caches = {}
+        self._tag_dict = None
+        self._shared_blocks = None
+        self._shard_warnings = set()
 
     def close_all(self):
         for mode_, cache in self.caches.values():
             cache.close()
         self.caches = {}
 
-    def coords_cache(self, mode='r', estimated_records=None):
-        if imposm.config.imposm_compact_coords_cache:
-            coords_db = DeltaCoordsDB
+    def dump_stats(self):
+        """
+        Write the stats of the closed caches of this process into the
+        cache dir, see `imposm.cache.stats`. Called by worker processes.
+        """
+        if cache_stats.enabled():
+            cache_stats.dump(self.path, self.prefix)
+
+    def report_stats(self, phase, message):
+        """
+        Collect the stats of all processes and pass a line for each
+        cache type to `message`.
+        """
+        if not cache_stats.enabled():
+            return
+        for line in cache_stats.format_stats(cache_stats.collect(self.path, self.prefix)):
+            message('%s stats %s' % (phase, line))
+
+    def files(self):
+        """
+        Return all files of the caches, including the tag dictionary,
+        the index of the tagged ways and the manifest.
+        """
+        return sorted(glob.glob(os.path.join(self.path, self.prefix + '*' + self.suffix)))
+
+    def copy_files(self, path):
+        """
+        Replace the caches in `path` with copies of these caches.
+        Returns the copied files.
+        """
+        self.close_all()
+        for fname in glob.glob(os.path.join(path, self.prefix + '*' + self.suffix)):
+            os.unlink(fname)
+        copied = []
+        for fname in self.files():
+            dst = os.path.join(path, os.path.basename(fname))
+            copy_sparse(fname, dst)
+            copied.append(dst)
+        return copied
+
+    def shard_fname(self, name, shard):
+        return os.path.join(self.path, '%s%s.%d%s' % (self.prefix, name, shard, self.suffix))
+
+    def shards(self, name):
+        """
+        Return the number of shards of the `name` cache. Uses the number of
+        existing shard files or ``imposm.config.imposm_cache_shards`` for
+        new caches. Logs a warning if the existing files do not match
+        the configured number of shards.
+        """
+        configured = imposm.config.imposm_cache_shards
+        n = 0
+        while os.path.exists(self.shard_fname(name, n)):
+            n += 1
+        if not n and os.path.exists(os.path.join(self.path, self.prefix + name + self.suffix)):
+            n = 1
+        if not n:
+            return max(1, configured or 1)
+        if configured is not None and n != max(1, configured) and name not in self._shard_warnings:
+            self._shard_warnings.add(name)
+            log.warn('using the %d shard(s) of the existing %s cache in %s instead of '
+                'the configured %d, remove the cache to change the number of shards',
+                n, name, self.path, configured)
+        return n
+
+    def _sharded_cache(self, name, open_cache, mode, estimated_records, shard, key):
+        """
+        Open the `name` cache with `open_cache`. Returns the cache of a single
+        `shard` or a `ShardedCache` with all shards.
+        """
+        if shard is not None:
+            return open_cache(self.shard_fname(name, shard), mode, estimated_records)
+        n = self.shards(name)
+        if n == 1:
+            return open_cache(os.path.join(self.path, self.prefix + name + self.suffix),
+                mode, estimated_records)
+        if estimated_records:
+            estimated_records //= n
+        return ShardedCache([open_cache(self.shard_fname(name, i), mode, estimated_records)
+            for i in range(n)], key=key)
+
+    def tuning_profile(self, name, estimated_records=None):
+        """
+        Return the tuning profile for each shard of the `name` cache.
+        Returns None if the cache is not stored in a B+ tree.
+        """
+        if name == 'coords' and imposm.config.imposm_dense_coords_cache:
+            return None
+        cache_type = self._cache_type(name)
+        if estimated_records:
+            if cache_type == 'coords_blocks':
+                estimated_records >>= 6
+            estimated_records //= self.shards(name)
+        return tuning_profile(cache_type, estimated_records)
+
+    def _cache_type(self, name):
+        """
+        Return the type of the records in the B+ tree of the `name` cache.
+        """
+        if name == 'coords' and imposm.config.imposm_compact_coords_cache:
+            return 'coords_blocks'
+        return name
+
+    def coords_cache(self, mode='r', estimated_records=None, shard=None):
+        return self._sharded_cache('coords', self._coords_cache, mode,
+            estimated_records, shard, key=itemgetter(0))
+
+    def _coords_cache(self, fname, mode, estimated_records):
+        if mode == 'r' and os.path.exists(fname):
+            dense = is_dense_coords_file(fname)
+        else:
+            dense = imposm.config.imposm_dense_coords_cache
+        if dense:
+            coords_db = DenseCoordDB
+        elif imposm.config.imposm_compact_coords_cache:
+            return self._x_cache(fname, DeltaCoordsDB, mode, estimated_records,
+                shared_blocks=self._shared_blocks)
         else:
             coords_db = CoordDB
-        return self._x_cache(self.coords_fname, coords_db, mode, estimated_records)
+        return self._x_cache(fname, coords_db, mode, estimated_records)
+
+    def open_shared_coords_cache(self):
+        """
+        Create the `SharedBlockCache` for the compact coords cache. All
+        processes that are forked afterwards share the decoded blocks.
+        """
+        size = imposm.config.imposm_coords_shared_cache_size
+        if (self._shared_blocks is not None or imposm.config.imposm_dense_coords_cache
+            or not imposm.config.imposm_compact_coords_cache or not size):
+            return
+        self._shared_blocks = SharedBlockCache(size)
+
+    def close_shared_coords_cache(self):
+        if self._shared_blocks is not None:
+            self._shared_blocks.close()
+            self._shared_blocks = None
+
+    def tag_dict(self):
+        """
+        Return the `TagDictionary` of the nodes/ways/relations caches.
+        """
+        if self._tag_dict is None:
+            if os.path.exists(self.tags_fname):
+                self._tag_dict = TagDictionary.load(self.tags_fname)
+            else:
+                self._tag_dict = TagDictionary()
+        return self._tag_dict
+
+    def update_tag_dict(self, strings):
+        """
+        Add `strings` to the tag dictionary and store it next to the caches.
+        Needs to be called before the caches are opened for writing.
+        """
+        tag_dict = self.tag_dict()
+        tag_dict.update(strings)
+        tag_dict.save(self.tags_fname)
+
+    def _elem_cache(self, x_class):
+        def open_cache(fname, mode, estimated_records):
+            if os.path.exists(fname) and is_frozen_file(fname):
+                x = FROZEN_CLASSES[x_class]
+            else:
+                x = x_class
+            return self._x_cache(fname, x, mode, estimated_records,
+                tag_dict=self.tag_dict())
+        return open_cache
+
+    def cache_files(self, name):
+        """
+        Return the existing files of the `name` cache.
+        """
+        n = self.shards(name)
+        if n == 1:
+            fnames = [os.path.join(self.path, self.prefix + name + self.suffix)]
+        else:
+            fnames = [self.shard_fname(name, i) for i in range(n)]
+        return [fname for fname in fnames if os.path.exists(fname)]
+
+    def freeze(self, names=('nodes', 'ways', 'relations')):
+        """
+        Convert the caches into read-only frozen caches, see `FrozenDB`.
+        Returns the number of frozen records.
+        """
+        self.close_all()
+        count = 0
+        for name in names:
+            for fname in self.cache_files(name):
+                if is_frozen_file(fname):
+                    continue
+                db = BDB(fname, 'r')
+                try:
+                    count += freeze_db(db, fname + '.frozen')
+                finally:
+                    db.close()
+                os.rename(fname + '.frozen', fname)
+        return count
+
+    def merge_caches(self, sources):
+        """
+        Merge the caches of the `sources` (`OSMCache`) into these new
+        caches with a k-way merge in id order, see `imposm.cache.kmerge`.
+        Returns the number of merged records of each cache.
+        """
+        self.close_all()
+        self.remove_manifest()
+        self.remove_way_coords_cache()
+        for source in sources:
+            self.update_tag_dict(source.tag_dict().strings)
 
-    def nodes_cache(self, mode='r', estimated_records=None):
-        return self._x_cache(self.nodes_fname, NodeDB, mode, estimated_records)
+        counts = {}
+        for name, key, combine in (
+            ('coords', itemgetter(0), first_item),
+            ('nodes', attrgetter('osm_id'), merge_elems),
+            ('ways', attrgetter('osm_id'), merge_elems),
+            ('relations', attrgetter('osm_id'), merge_elems),
+        ):
+            inputs = [getattr(source, name + '_cache')('r')
+                for source in sources if source.cache_files(name)]
+            estimated_records = None
+            if name != 'coords':
+                estimated_records = sum(len(cache) for cache in inputs)
+            cache = getattr(self, name + '_cache')('w', estimated_records)
+            count = 0
+            for item in merge_sorted(inputs, key, combine):
+                if name == 'coords':
+                    cache.put(item[0], *item[1])
+                else:
+                    cache.put(*item.to_tuple())
+                count += 1
+            counts[name] = count
+            self.close_all()
+            for source in sources:
+                source.close_all()
+        return counts
 
-    def ways_cache(self, mode='r', estimated_records=None):
-        return self._x_cache(self.ways_fname, WayDB, mode, estimated_records)
+    def warm_up(self, names):
+        """
+        Start to load the `names` caches into the page cache of the OS,
+        if they fit into the available memory (see `BDB.advise`).
+        """
+        for name in names:
+            getattr(self, name + '_cache')('r').advise('willneed')
+        self.close_all()
 
-    def inserted_ways_cache(self, mode='r', estimated_records=None):
-        return self._x_cache(self.inserted_ways_fname, InsertedWayDB, mode, estimated_records)
+    def compact(self, names=('coords', 'nodes', 'ways', 'relations'), compress=False):
+        """
+        Rewrite the B+ tree caches in key order, see `BDB.compact`.
+        Frozen and dense caches are skipped.
+
+        Returns a list with the file name, the number of records, the
+        size before and after and the time of a full scan before and
+        after the compaction of each file.
+        """
+        self.close_all()
+        results = []
+        for name in names:
+            cache_type = self._cache_type(name)
+            for fname in self.cache_files(name):
+                if is_frozen_file(fname) or is_dense_coords_file(fname):
+                    continue
+                size_before = os.path.getsize(fname)
+                db = BDB(fname, 'w')
+                try:
+                    records = len(db)
+                    scan_before = _scan_time(db)
+                    db.compact(tuning_profile(cache_type, records)['bnum'], compress)
+                    scan_after = _scan_time(db)
+                finally:
+                    db.close()
+                results.append((fname, records, size_before, os.path.getsize(fname),
+                    scan_before, scan_after))
+        return results
+
+    def _manifest_state(self):
+        """
+        Return the formats, options and record counts of the caches.
+        """
+        formats = dict(CACHE_FORMAT_VERSIONS, tag_dict=TAG_DICT_FORMAT_VERSION)
+        options = dict(dense_coords=imposm.config.imposm_dense_coords_cache,
+            compact_coords=imposm.config.imposm_compact_coords_cache,
+            coords_precision=imposm.config.imposm_coords_precision,
+            shards=dict((name, self.shards(name))
+                for name in ('coords', 'nodes', 'ways', 'relations')))
+        counts = {}
+        for name in ('nodes', 'ways', 'relations'):
+            if self.cache_files(name):
+                counts[name] = len(getattr(self, name + '_cache')('r'))
+            else:
+                counts[name] = None
+        counts['coords'] = bool(self.cache_files('coords'))
+        self.close_all()
+        return formats, options, counts
+
+    def unread_inputs(self, filenames, mapping_hash):
+        """
+        Return the `filenames` that still need to be read into the
+        existing caches, an empty list if the caches are up to date.
+        Returns None if there is no matching manifest (see `CacheManifest`).
+        """
+        manifest = CacheManifest.load(self.manifest_fname)
+        if manifest is None:
+            return None
+        return manifest.unread_inputs(list(filenames), mapping_hash,
+            *self._manifest_state())
+
+    def write_manifest(self, filenames, mapping_hash, previous=None):
+        """
+        Record that the caches were read from `filenames` with a mapping
+        with `mapping_hash`. Reuses the fingerprints of the inputs of the
+        `previous` manifest, if the caches were extended with the
+        `unread_inputs` of this manifest.
+        """
+        inputs = []
+        if previous is not None:
+            inputs = previous.inputs[:len(filenames)]
+        inputs += [input_fingerprint(fname) for fname in filenames[len(inputs):]]
+        formats, options, counts = self._manifest_state()
+        CacheManifest(inputs, mapping_hash, formats, options, counts).save(self.manifest_fname)
+
+    def remove_manifest(self):
+        """
+        Remove the manifest before the caches are changed.
+        Returns the removed manifest or None.
+        """
+        manifest = CacheManifest.load(self.manifest_fname)
+        if os.path.exists(self.manifest_fname):
+            os.unlink(self.manifest_fname)
+        return manifest
+
+    def nodes_cache(self, mode='r', estimated_records=None, shard=None):
+        return self._sharded_cache('nodes', self._elem_cache(NodeDB), mode,
+            estimated_records, shard, key=attrgetter('osm_id'))
+
+    def ways_cache(self, mode='r', estimated_records=None, shard=None):
+        return self._sharded_cache('ways', self._ways_cache, mode,
+            estimated_records, shard, key=attrgetter('osm_id'))
+
+    def _ways_cache(self, fname, mode, estimated_records):
+        tagged_fname = self._tagged_ways_fname(fname)
+        if mode == 'w' and not os.path.exists(fname) and os.path.exists(tagged_fname):
+            # index of a removed cache, the ids are not in the new cache
+            os.unlink(tagged_fname)
+        # ways that are added to an existing cache without an index
+        # would result in an incomplete index
+        index = mode == 'w' and (not os.path.exists(fname) or os.path.exists(tagged_fname))
+        cache = self._elem_cache(WayDB)(fname, mode, estimated_records)
+        if index and isinstance(cache, WayDB) and cache.tagged_ids is None:
+            cache.tagged_ids = IdBitmap(tagged_fname, 'w')
+        return cache
+
+    def _tagged_ways_fname(self, ways_fname):
+        """
+        Return the file of the index of the tagged ways of the
+        `ways_fname` cache (or shard).
+        """
+        return os.path.join(self.path, self.prefix + 'tagged_'
+            + os.path.basename(ways_fname)[len(self.prefix):])
+
+    def tagged_ways_cache(self):
+        """
+        Return the ways with tags, without the ways that are only
+        members of relations. Returns None if the ways cache has no
+        index of the tagged ways (i.e. caches of older versions).
+        """
+        tagged_fnames = [self._tagged_ways_fname(fname)
+            for fname in self.cache_files('ways')]
+        if not tagged_fnames or not all(os.path.exists(fname) for fname in tagged_fnames):
+            return None
+        return TaggedWays(self.ways_cache('r'),
+            [self._x_cache(fname, IdBitmap, 'r') for fname in tagged_fnames])
+
+    def inserted_ways_cache(self, mode='r'):
+        return IdBitmap(self.inserted_ways_fname, mode)
 
     def remove_inserted_way_cache(self):
         if os.path.exists(self.inserted_ways_fname):
             os.unlink(self.inserted_ways_fname)
 
-    def relations_cache(self, mode='r', estimated_records=None):
-        return self._x_cache(self.relations_fname, RelationDB, mode, estimated_records)
+    def way_coords_cache(self, mode='r', estimated_records=None):
+        """
+        Return the coords of the ways (see `join_way_coords`). Returns
+        None in read mode if the ways were not joined with their coords.
+        """
+        if mode == 'r' and not os.path.exists(self.way_coords_fname):
+            return None
+        return self._x_cache(self.way_coords_fname, WayCoordsDB, mode, estimated_records)
 
-    def _x_cache(self, x, x_class, mode, estimated_records=None):
+    def join_way_coords(self):
+        """
+        Join the ways with the coords of their refs and store the result in
+        the way coords cache, see `imposm.cache.tc.join_way_coords`. The cache is renamed
+        after the join, so that no incomplete cache is used by the writer.
+        Returns the number of ways with complete coords.
+        """
+        self.remove_way_coords_cache()
+        ways = self.ways_cache('r')
+        tmp_fname = self.way_coords_fname + '.tmp'
+        way_coords = self._x_cache(tmp_fname, WayCoordsDB, 'w', len(ways))
+        count = join_way_coords(ways, self.coords_cache('r'), way_coords, tmp_dir=self.path)
+        self.close_all()
+        os.rename(tmp_fname, self.way_coords_fname)
+        return count
+
+    def remove_way_coords_cache(self):
+        """
+        Remove the way coords, needs to be called before the ways or
+        coords are changed.
+        """
+        for fname in (self.way_coords_fname, self.way_coords_fname + '.tmp'):
+            if os.path.exists(fname):
+                os.unlink(fname)
+
+    def relations_cache(self, mode='r', estimated_records=None, shard=None):
+        return self._sharded_cache('relations', self._elem_cache(RelationDB), mode,
+            estimated_records, shard, key=attrgetter('osm_id'))
+
+    def _x_cache(self, x, x_class, mode, estimated_records=None, **kw):
         if x in self.caches:
             current_mode, cache = self.caches[x]
             if current_mode == mode:
                 return cache
             else:
                 cache.close()
-        cache = x_class(x, mode, estimated_records=estimated_records)
+        cache = x_class(x, mode, estimated_records=estimated_records, **kw)
         self.caches[x] = mode, cache
 
         return cache
+
+class TaggedWays(object):
+    """
+    The ways of the `ways_cache` with the ids from the `tagged_ids`
+    (one `IdBitmap` for each shard) in id order.
+
+    Each shard is still read sequentially, but only the tagged ways
+    are decoded.
+    """
+    def __init__(self, ways_cache, tagged_ids):
+        self.ways_cache = ways_cache
+        self.tagged_ids = tagged_ids
+
+    def __len__(self):
+        return sum(len(ids) for ids in self.tagged_ids)
+
+    def __iter__(self):
+        caches = getattr(self.ways_cache, 'caches', [self.ways_cache])
+        shards = [cache.iter_ids(ids) for cache, ids in zip(caches, self.tagged_ids)]
+        if len(shards) == 1:
+            return shards[0]
+        return self._merge(shards)
+
+    def _merge(self, shards):
+        shards = [((way.osm_id, way) for way in shard) for shard in shards]
+        for _, way in heapq.merge(*shards):
+            yield way
+
+    def advise(self, hint):
+        return self.ways_cache.advise(hint)
+
+def memory_cache_dir():
+    """
+    Create a temporary directory for the caches in
+    ``imposm.config.imposm_memory_cache_path`` (a tmpfs).
+    Raises IOError if the path does not exist, the default temp dir
+    is usually on disk.
+    """
+    path = imposm.config.imposm_memory_cache_path
+    if not path or not os.path.isdir(path):
+        raise IOError('memory cache path %s does not exist' % path)
+    return tempfile.mkdtemp(prefix='imposm_', dir=path)
+
+def copy_sparse(src, dst, chunk_size=1024*1024):
+    """
+    Copy `src` to `dst` without writing the blocks that only contain
+    zeros, so that the sparse dense coords cache stays sparse.
+    """
+    zeros = '\0' * chunk_size
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            while True:
+                data = fsrc.read(chunk_size)
+                if not data:
+                    break
+                if data == zeros[:len(data)]:
+                    fdst.seek(len(data), os.SEEK_CUR)
+                else:
+                    fdst.write(data)
+            fdst.truncate()
+
+def _scan_time(db):
+    """
+    Return the seconds for reading all records of `db`.
+    """
+    start = time.time()
+    for _ in db.iter_raw():
+        pass
+    return time.time() - start
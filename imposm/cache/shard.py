@@ -0,0 +1,128 @@
+# Copyright 2011 Omniscale (http://omniscale.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import heapq
+from array import array
+
+# blocks of 2**SHARD_ID_BITS consecutive ids are stored in the same
+# shard, this matches the blocks of the DeltaCoordsDB
+SHARD_ID_BITS = 6
+
+def shard_index(osmid, shards):
+    """
+    Return the shard for `osmid`.
+
+    >>> shard_index(63, 4), shard_index(64, 4), shard_index(4 * 64, 4)
+    (0, 1, 0)
+    """
+    return (osmid >> SHARD_ID_BITS) % shards
+
+class ShardedCache(object):
+    """
+    Routes all requests to the cache of the shard of each id.
+
+    Iterates over all shards in the order of the ids, `key`
+    returns the id of an item.
+    """
+    def __init__(self, caches, key):
+        self.caches = caches
+        self.key = key
+
+    def _cache(self, osmid):
+        return self.caches[(osmid >> SHARD_ID_BITS) % len(self.caches)]
+
+    def get(self, osmid):
+        return self._cache(osmid).get(osmid)
+
+    def put(self, osmid, *args):
+        return self._cache(osmid).put(osmid, *args)
+
+    def put_marshaled(self, osmid, *args):
+        return self._cache(osmid).put_marshaled(osmid, *args)
+
+    def put_encoded(self, osmid, data):
+        return self._cache(osmid).put_encoded(osmid, data)
+
+    def __contains__(self, osmid):
+        return osmid in self._cache(osmid)
+
+    def __len__(self):
+        return sum(len(cache) for cache in self.caches)
+
+    def __iter__(self):
+        key = self.key
+        shards = [((key(item), item) for item in cache) for cache in self.caches]
+        for _, item in heapq.merge(*shards):
+            yield item
+
+    def get_coords(self, refs):
+        coords = self.get_coords_array(refs)
+        if coords is None:
+            return None
+        return zip(coords[::2], coords[1::2])
+
+    def get_coords_array(self, refs):
+        coords, offsets, missing = self.get_ways_coords_array([refs])
+        if missing[0]:
+            return None
+        return coords
+
+    def get_ways_coords_array(self, ways_refs):
+        """
+        Return the coords for a list of refs lists, see
+        `CoordDB.get_ways_coords_array`.
+
+        The refs are split into runs of consecutive refs from the same
+        shard and each shard resolves all of its runs with one call.
+        """
+        n = len(self.caches)
+        shard_runs = [[] for _ in xrange(n)]
+        # (shard, index into shard_runs[shard]) for the runs of each way
+        ways_runs = []
+        for refs in ways_refs:
+            runs = []
+            last_shard = None
+            for ref in refs:
+                shard = (ref >> SHARD_ID_BITS) % n
+                if shard != last_shard:
+                    run = []
+                    runs.append((shard, len(shard_runs[shard])))
+                    shard_runs[shard].append(run)
+                    last_shard = shard
+                run.append(ref)
+            ways_runs.append(runs)
+
+        results = [cache.get_ways_coords_array(runs) if runs else None
+            for cache, runs in zip(self.caches, shard_runs)]
+
+        coords = array('d')
+        offsets = array('l', [0])
+        missing = array('b')
+        for runs in ways_runs:
+            is_missing = 0
+            for shard, i in runs:
+                run_coords, run_offsets, run_missing = results[shard]
+                if run_missing[i]:
+                    is_missing = 1
+                coords.extend(run_coords[run_offsets[i]*2:run_offsets[i+1]*2])
+            offsets.append(len(coords) // 2)
+            missing.append(is_missing)
+        return coords, offsets, missing
+
+    def advise(self, hint):
+        return all([cache.advise(hint) for cache in self.caches])
+
+    def close(self):
+        for cache in self.caches:
+            cache.close()
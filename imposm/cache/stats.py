@@ -0,0 +1,191 @@
+# Copyright 2011 Omniscale (http://omniscale.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Counters and latency histograms of the caches.
+
+The caches only collect stats if ``imposm.config.imposm_cache_stats``
+is enabled. Each cache adds its stats to the stats of the process with
+`record` when it is closed. Worker processes write their stats into the
+cache dir with `dump` and the main process merges the stats of all
+processes with `collect` at the end of each phase.
+
+Stats are dicts of counters. Lists are histograms with the number of
+operations that took less than ``2**i`` microseconds in bucket ``i``.
+"""
+
+from __future__ import with_statement
+
+import os
+import glob
+import marshal
+
+import imposm.config
+
+# the order of the counters in `format_stats`
+COUNTERS = [
+    ('gets', '%d gets'),
+    ('misses', '%d misses'),
+    ('puts', '%d puts'),
+    ('bytes_read', '%s read'),
+    ('bytes_decoded', '%s decoded'),
+    ('block_hits', '%d block hits'),
+    ('block_misses', '%d block misses'),
+    ('block_evictions', '%d block evictions'),
+    ('block_prefetches', '%d blocks prefetched'),
+    ('shared_block_hits', '%d shared block hits'),
+    ('get_time', '%.1fs get'),
+    ('decode_time', '%.1fs decode'),
+    ('put_time', '%.1fs put'),
+    ('io_read_bytes', '%s read from disk'),
+]
+
+_process_stats = {}
+
+def enabled():
+    return imposm.config.imposm_cache_stats
+
+def merge_stats(target, stats):
+    """
+    Add all counters and histograms of `stats` to `target`.
+
+    >>> s = {'gets': 2, 'get_latency': [1, 2]}
+    >>> merge_stats(s, {'gets': 3, 'misses': 1, 'get_latency': [0, 1, 1]})
+    >>> sorted(s.items())
+    [('get_latency', [1, 3, 1]), ('gets', 5), ('misses', 1)]
+    """
+    for key, value in stats.iteritems():
+        if isinstance(value, list):
+            current = target.setdefault(key, [])
+            current.extend([0] * (len(value) - len(current)))
+            for i, n in enumerate(value):
+                current[i] += n
+        else:
+            target[key] = target.get(key, 0) + value
+
+def record(cache_type, stats):
+    """
+    Add the `stats` of a cache to the stats of this process.
+    """
+    merge_stats(_process_stats.setdefault(cache_type, {}), stats)
+
+def _io_read_bytes():
+    """
+    Return the bytes this process read from the disk (not from the
+    page cache). Returns None if the number is not available.
+    """
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('read_bytes:'):
+                    return int(line.split()[1])
+    except (IOError, ValueError):
+        pass
+    return None
+
+def _stats_fname(path, prefix, pid):
+    return os.path.join(path, '%sstats.%d' % (prefix, pid))
+
+def dump(path, prefix='imposm_'):
+    """
+    Write the stats of this process into `path` and reset them.
+    """
+    io_read_bytes = _io_read_bytes()
+    if io_read_bytes is not None:
+        record('process', {'io_read_bytes': io_read_bytes})
+    fname = _stats_fname(path, prefix, os.getpid())
+    with open(fname + '.tmp', 'wb') as f:
+        marshal.dump(_process_stats, f, 2)
+    os.rename(fname + '.tmp', fname)
+    _process_stats.clear()
+
+def collect(path, prefix='imposm_'):
+    """
+    Return the merged stats of this process and of all dumped stats in
+    `path`. Removes the dumped stats and resets the stats of this process.
+    """
+    result = {}
+    for cache_type, stats in _process_stats.iteritems():
+        merge_stats(result.setdefault(cache_type, {}), stats)
+    _process_stats.clear()
+
+    for fname in glob.glob(os.path.join(path, prefix + 'stats.*')):
+        if fname.endswith('.tmp'):
+            continue
+        with open(fname, 'rb') as f:
+            process_stats = marshal.load(f)
+        os.unlink(fname)
+        for cache_type, stats in process_stats.iteritems():
+            merge_stats(result.setdefault(cache_type, {}), stats)
+    return result
+
+def _format_bytes(n):
+    """
+    >>> _format_bytes(512), _format_bytes(3 * 1024 * 1024)
+    ('512B', '3.0MB')
+    """
+    for unit in ('B', 'KB', 'MB'):
+        if n < 1024:
+            if unit == 'B':
+                return '%d%s' % (n, unit)
+            return '%.1f%s' % (n, unit)
+        n /= 1024.0
+    return '%.1fGB' % n
+
+def percentile(histogram, p):
+    """
+    Return the upper bound in microseconds of the bucket that
+    contains the `p` percentile.
+
+    >>> percentile([0, 5, 4, 1], 50), percentile([0, 5, 4, 1], 99)
+    (2, 8)
+    >>> percentile([], 50)
+    0
+    """
+    total = sum(histogram)
+    if not total:
+        return 0
+    limit = total * p / 100.0
+    count = 0
+    for i, n in enumerate(histogram):
+        count += n
+        if count >= limit:
+            return 2**i
+    return 2**(len(histogram) - 1)
+
+def format_stats(stats):
+    """
+    Return a line for each cache type.
+
+    >>> format_stats({'coords': {'gets': 4, 'misses': 1, 'bytes_read': 48,
+    ...     'get_time': 0.02, 'get_latency': [0, 3, 1]}})
+    ['coords: 4 gets, 1 misses, 48B read, 0.0s get, get latency p50<2us p99<4us']
+    """
+    lines = []
+    for cache_type in sorted(stats):
+        cache_stats = stats[cache_type]
+        parts = []
+        for key, fmt in COUNTERS:
+            if key not in cache_stats:
+                continue
+            value = cache_stats[key]
+            if key.endswith('bytes') or key.startswith('bytes'):
+                value = _format_bytes(value)
+            parts.append(fmt % value)
+        for key in sorted(cache_stats):
+            if isinstance(cache_stats[key], list) and sum(cache_stats[key]):
+                parts.append('%s p50<%dus p99<%dus' % (key.replace('_', ' '),
+                    percentile(cache_stats[key], 50), percentile(cache_stats[key], 99)))
+        lines.append('%s: %s' % (cache_type, ', '.join(parts)))
+    return lines
@@ -0,0 +1,77 @@
+# Copyright 2011 Omniscale (http://omniscale.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import with_statement
+
+import os
+import marshal
+
+TAG_DICT_FORMAT_VERSION = 1
+
+class TagDictionary(object):
+    """
+    Integer codes for tag keys and values.
+
+    Codes are assigned in the order the strings are added and never
+    change, so the dictionary can be extended for caches that already
+    contain coded records (e.g. with --merge-cache).
+
+    >>> d = TagDictionary(['highway', 'residential'])
+    >>> d.codes['residential']
+    1
+    >>> d.update(['building', 'highway', 42])
+    >>> d.strings
+    [u'highway', u'residential', u'building']
+    >>> d.encoded
+    ['highway', 'residential', 'building']
+    """
+    def __init__(self, strings=()):
+        self.strings = []
+        # UTF-8 encoded strings, for tags that were added as str
+        self.encoded = []
+        self.codes = {}
+        self.update(strings)
+
+    def __len__(self):
+        return len(self.strings)
+
+    def update(self, strings):
+        """
+        Add new strings to the dictionary. Skips everything that
+        is not a string.
+        """
+        for s in strings:
+            if isinstance(s, str):
+                s = s.decode('utf-8')
+            elif not isinstance(s, unicode):
+                continue
+            if s not in self.codes:
+                self.codes[s] = len(self.strings)
+                self.strings.append(s)
+                self.encoded.append(s.encode('utf-8'))
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'rb') as f:
+            version, strings = marshal.load(f)
+        if version != TAG_DICT_FORMAT_VERSION:
+            raise ValueError('unsupported tag dictionary version %r in %s'
+                % (version, filename))
+        return cls(strings)
+
+    def save(self, filename):
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            marshal.dump((TAG_DICT_FORMAT_VERSION, self.strings), f, 2)
+        os.rename(tmp_filename, filename)
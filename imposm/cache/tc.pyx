@@ -1,13 +1,80 @@
+import os
+import shutil
+import tempfile
+import threading
+import struct
+import logging
+log = logging.getLogger(__name__)
+
+import imposm.config
 from imposm.base import Node, Way, Relation
-from libc.stdint cimport uint32_t, int64_t
+from imposm.cache.tuning import tuning_profile, describe_profile, available_memory
+from imposm.cache import stats as cache_stats
+from libc.stdint cimport uint8_t, uint32_t, int64_t, uint64_t, INT64_MIN
+from libc.stdlib cimport malloc, calloc, realloc, free, qsort
+from cpython cimport array
+import array
 
 cdef extern from "Python.h":
     object PyString_FromStringAndSize(char *s, Py_ssize_t len)
+    int PyObject_AsReadBuffer(object obj, void **buffer, Py_ssize_t *buffer_len) except -1
+    int PyObject_AsWriteBuffer(object obj, void **buffer, Py_ssize_t *buffer_len) except -1
 
 cdef extern from "marshal.h":
     object PyMarshal_ReadObjectFromString(char *string, Py_ssize_t len)
     object PyMarshal_WriteObjectToString(object value, int version)
 
+cdef extern from "fcntl.h":
+    enum: O_RDONLY
+    enum: O_RDWR
+    enum: O_CREAT
+    int c_open "open" (char *path, int flags, int mode)
+    enum: POSIX_FADV_WILLNEED
+    int posix_fadvise(int fd, int64_t offset, int64_t len, int advice)
+
+cdef extern from "unistd.h":
+    enum: SEEK_SET
+    int c_close "close" (int fd)
+    ssize_t c_read "read" (int fd, void *buf, size_t count) nogil
+    ssize_t c_write "write" (int fd, void *buf, size_t count) nogil
+    int64_t c_lseek "lseek" (int fd, int64_t offset, int whence)
+    int ftruncate(int fd, int64_t length)
+
+cdef extern from "sys/stat.h":
+    cdef struct stat:
+        int64_t st_size
+    int fstat(int fd, stat *buf)
+
+cdef extern from "sys/mman.h":
+    enum: PROT_READ
+    enum: PROT_WRITE
+    enum: MAP_SHARED
+    enum: MAP_ANONYMOUS
+    void *MAP_FAILED
+    void *mmap(void *addr, size_t length, int prot, int flags, int fd, int64_t offset)
+    int munmap(void *addr, size_t length)
+    enum: MADV_SEQUENTIAL
+    enum: MADV_RANDOM
+    enum: MADV_WILLNEED
+    int madvise(void *addr, size_t length, int advice)
+
+cdef extern from "time.h":
+    enum: CLOCK_MONOTONIC
+    cdef struct timespec:
+        long tv_sec
+        long tv_nsec
+    int clock_gettime(int clk_id, timespec *tp) nogil
+
+cdef extern from *:
+    # GCC atomic builtins
+    bint __sync_bool_compare_and_swap(int64_t *ptr, int64_t oldval, int64_t newval) nogil
+    void __sync_synchronize() nogil
+
+cdef extern from "string.h":
+    void *memcpy(void *dest, void *src, size_t n)
+    void *memmove(void *dest, void *src, size_t n)
+    void *memset(void *s, int c, size_t n) nogil
+
 cdef extern from "tcutil.h":
     ctypedef int TCCMP()
     cdef int tccmpint32()
@@ -44,6 +111,8 @@ cdef extern from "tcbdb.h":
     bint tcbdbtune(TCBDB *db, int lmemb, int nmemb,
                    int bnum, int apow, int fpow, int opts)
     bint tcbdbsetcache(TCBDB *bdb, int lcnum, int ncnum)
+    bint tcbdboptimize(TCBDB *bdb, int lmemb, int nmemb,
+                       int64_t bnum, int apow, int fpow, int opts)
 
     bint tcbdbsetcmpfunc(TCBDB *bdb, TCCMP cmp, void *cmpop)
     bint tcbdbsetmutex(TCBDB *bdb)
@@ -66,53 +135,343 @@ cdef extern from "tcbdb.h":
 
 DEF COORD_FACTOR = 11930464.7083 # ((2<<31)-1)/360.0
 
-cdef uint32_t _coord_to_uint32(double x) nogil:
-    return <uint32_t>((x + 180.0) * COORD_FACTOR)
+# named precisions for imposm_coords_precision, in degrees
+COORDS_PRECISIONS = {
+    # precision of the OSM database
+    'osm': 1e-7,
+    # about 10cm, enough for rendering
+    'render': 1e-6,
+}
+
+def coords_precision(precision):
+    """
+    Return the precision in degrees for a number or a name from
+    `COORDS_PRECISIONS`. None is the full precision of 32bit
+    (about 8.4e-8 degrees).
+    """
+    if precision is None:
+        return None
+    if isinstance(precision, basestring):
+        if precision not in COORDS_PRECISIONS:
+            try:
+                precision = float(precision)
+            except ValueError:
+                raise ValueError('unknown coords precision %r' % precision)
+        else:
+            precision = COORDS_PRECISIONS[precision]
+    if precision * COORD_FACTOR < 1.0:
+        raise ValueError('coords precision %r is finer than 32bit' % precision)
+    return float(precision)
+
+def coord_factor(precision):
+    """
+    Return the factor of the fixed-point coords with `precision` degrees.
+    Coords are stored as ``(x + 180) * factor`` for both axes, smaller
+    factors result in smaller deltas in the `DeltaNodes`.
+    """
+    if precision is None:
+        return COORD_FACTOR
+    return 1.0 / precision
+
+cdef uint32_t _coord_to_uint32(double x, double factor) nogil:
+    return <uint32_t>((x + 180.0) * factor + 0.5)
 
-cdef double _uint32_to_coord(uint32_t x) nogil:
-    return <double>((x / COORD_FACTOR) - 180.0)
+cdef double _uint32_to_coord(uint32_t x, double factor) nogil:
+    return <double>((x / factor) - 180.0)
 
 ctypedef struct coord:
     uint32_t x
     uint32_t y
 
-cdef inline coord coord_struct(double x, double y) nogil:
+cdef inline coord coord_struct(double x, double y, double factor) nogil:
     cdef coord p
-    p.x = _coord_to_uint32(x)
-    p.y = _coord_to_uint32(y)
+    p.x = _coord_to_uint32(x, factor)
+    p.y = _coord_to_uint32(y, factor)
     return p
 
+# copies the coord of osmid to out, returns 0 if osmid is missing
+ctypedef bint (*coord_lookup)(void *ctx, int64_t osmid, coord *out) nogil
+# called with the ids of all refs before the lookups, with the GIL
+ctypedef int (*coord_prepare)(void *ctx, int64_t *ids, Py_ssize_t n) except -1
+
+cdef array.array _double_array = array.array('d')
+cdef array.array _long_array = array.array('l')
+cdef array.array _byte_array = array.array('b')
+
+cdef object _lookup_ways_coords(coord_lookup lookup, void *ctx, ways_refs, double factor,
+    coord_prepare prepare=NULL):
+    """
+    Resolve the refs of all ways with `lookup` and convert the coords
+    with `factor`. `prepare` is called with all refs before the lookups,
+    i.e. to load the blocks of the refs.
+    Returns a tuple with the coords as a flat double array (x0, y0, x1, ...),
+    the offsets of each way into the coords (way i starts at offsets[i]
+    and ends at offsets[i+1], in coordinate pairs) and a byte array that
+    marks ways with missing coords. The coords of missing ways are undefined.
+    """
+    cdef Py_ssize_t i, w, n = 0, n_ways = len(ways_refs)
+    cdef int64_t *ids
+    cdef coord value
+    cdef array.array offsets = array.clone(_long_array, n_ways + 1, zero=False)
+    cdef array.array missing = array.clone(_byte_array, n_ways, zero=True)
+    cdef array.array coords
+    cdef long *o = offsets.data.as_longs
+    cdef signed char *m = missing.data.as_schars
+    cdef double *c
+
+    for w in range(n_ways):
+        o[w] = n
+        n += len(ways_refs[w])
+    o[n_ways] = n
+
+    ids = <int64_t *>malloc(n * sizeof(int64_t) + 1)
+    if not ids:
+        raise MemoryError()
+    try:
+        i = 0
+        for refs in ways_refs:
+            for osmid in refs:
+                ids[i] = osmid
+                i += 1
+        if prepare:
+            prepare(ctx, ids, n)
+
+        coords = array.clone(_double_array, n * 2, zero=False)
+        c = coords.data.as_doubles
+        with nogil:
+            for w in range(n_ways):
+                for i in range(o[w], o[w+1]):
+                    if not lookup(ctx, ids[i], &value):
+                        m[w] = 1
+                        break
+                    c[i*2] = _uint32_to_coord(value.x, factor)
+                    c[i*2+1] = _uint32_to_coord(value.y, factor)
+    finally:
+        free(ids)
+    return coords, offsets, missing
+
+cdef inline uint64_t _zigzag(int64_t v) nogil:
+    return (<uint64_t>v << 1) ^ <uint64_t>(v >> 63)
+
+cdef inline int64_t _unzigzag(uint64_t v) nogil:
+    return <int64_t>(v >> 1) ^ -<int64_t>(v & 1)
+
+cdef inline Py_ssize_t _write_varint(unsigned char *buf, uint64_t v) nogil:
+    """
+    Write `v` as varint to `buf` (needs up to 10 bytes).
+    Returns the number of written bytes.
+    """
+    cdef Py_ssize_t n = 0
+    while v >= 0x80:
+        buf[n] = (v & 0x7f) | 0x80
+        v >>= 7
+        n += 1
+    buf[n] = v
+    return n + 1
+
+cdef inline Py_ssize_t _read_varint(unsigned char *buf, Py_ssize_t pos,
+    Py_ssize_t size, uint64_t *v) nogil:
+    """
+    Read varint at `pos` into `v`.
+    Returns the position after the varint or -1 for invalid data.
+    """
+    cdef uint64_t result = 0
+    cdef int shift = 0
+    cdef unsigned char b
+    while pos < size and shift < 64:
+        b = buf[pos]
+        pos += 1
+        result |= (<uint64_t>(b & 0x7f)) << shift
+        if not b & 0x80:
+            v[0] = result
+            return pos
+        shift += 7
+    return -1
+
+DEF STATS_HIST_BUCKETS = 24
+
+ctypedef struct io_stats:
+    bint enabled
+    int64_t gets
+    int64_t misses
+    int64_t bytes_read
+    double get_time
+    double decode_time
+    double put_time
+    int64_t get_latency[STATS_HIST_BUCKETS]
+
+cdef inline double _now() nogil:
+    cdef timespec t
+    clock_gettime(CLOCK_MONOTONIC, &t)
+    return t.tv_sec + t.tv_nsec * 1e-9
+
+cdef inline void _add_latency(int64_t *histogram, double seconds) nogil:
+    """
+    Count `seconds` in the bucket of the next power of two microseconds.
+    """
+    cdef int64_t us = <int64_t>(seconds * 1e6)
+    cdef int i = 0
+    while us and i < STATS_HIST_BUCKETS - 1:
+        us >>= 1
+        i += 1
+    histogram[i] += 1
+
+cdef inline void _init_io_stats(io_stats *st, bint enabled) nogil:
+    if enabled:
+        memset(st, 0, sizeof(io_stats))
+    st.enabled = enabled
+
+cdef void _add_io_stats(io_stats *total, io_stats *st):
+    """
+    Add the counts of `st` to `total`.
+    Threads that read without the GIL count in their own `io_stats` and
+    add them with this function, the GIL serializes the updates of `total`.
+    """
+    cdef int i
+    if not st.enabled:
+        return
+    total.gets += st.gets
+    total.misses += st.misses
+    total.bytes_read += st.bytes_read
+    total.get_time += st.get_time
+    total.decode_time += st.decode_time
+    total.put_time += st.put_time
+    for i in range(STATS_HIST_BUCKETS):
+        total.get_latency[i] += st.get_latency[i]
+
+cdef inline void *_tcbdb_get(TCBDB *db, int64_t osmid, int *size, bint copy) nogil:
+    if copy:
+        return tcbdbget(db, <char *>&osmid, sizeof(int64_t), size)
+    return tcbdbget3(db, <char *>&osmid, sizeof(int64_t), size)
+
+cdef inline void *_bdb_get(TCBDB *db, io_stats *st, int64_t osmid, int *size, bint copy=0) nogil:
+    """
+    Get the record of `osmid`, counts gets, misses, bytes and time if
+    the stats are enabled.
+    Returns a copy of the record that needs to be freed if `copy` is set,
+    otherwise the record is only valid until the next operation on `db`.
+    """
+    cdef void *ret
+    cdef double start, duration
+    if not st.enabled:
+        return _tcbdb_get(db, osmid, size, copy)
+    start = _now()
+    ret = _tcbdb_get(db, osmid, size, copy)
+    duration = _now() - start
+    st.gets += 1
+    st.get_time += duration
+    _add_latency(st.get_latency, duration)
+    if ret:
+        st.bytes_read += size[0]
+    else:
+        st.misses += 1
+    return ret
+
+_madvise_hints = {
+    'sequential': MADV_SEQUENTIAL,
+    'random': MADV_RANDOM,
+    'willneed': MADV_WILLNEED,
+}
+
+def _check_hint(hint):
+    if hint not in _madvise_hints:
+        raise ValueError('unknown access hint %r' % hint)
+
+def _fits_in_memory(int64_t size):
+    """
+    Files are only loaded with 'willneed' if they fit into half of the
+    available memory, larger files would evict the other caches.
+    """
+    return size <= available_memory() // 2
+
+cdef bint _madvise(void *addr, int64_t size, hint) except -1:
+    _check_hint(hint)
+    if hint == 'willneed' and not _fits_in_memory(size):
+        return False
+    return madvise(addr, size, _madvise_hints[hint]) == 0
+
+cdef bint _fadvise_willneed(filename) except -1:
+    """
+    Start to load `filename` into the page cache, if it fits into memory.
+    """
+    cdef stat st
+    cdef int fd = c_open(filename, O_RDONLY, 0)
+    cdef bint result = False
+    if fd < 0:
+        return False
+    if fstat(fd, &st) == 0 and _fits_in_memory(st.st_size):
+        result = posix_fadvise(fd, 0, 0, POSIX_FADV_WILLNEED) == 0
+    c_close(fd)
+    return result
+
+# key of the header record, see BDB.header
+HEADER_KEY = INT64_MIN
+
+_compression = {
+    None: 0,
+    'deflate': BDBTDEFLATE,
+    'bzip': BDBTBZIP,
+    'tcbs': BDBTTCBS,
+}
+
 _modes = {
     'w': BDBOWRITER | BDBOCREAT,
     'r': BDBOREADER | BDBONOLCK,
 }
 
+def threaded_reads():
+    """
+    Return ``True`` if the caches that are opened for reading are shared
+    by multiple threads (see ``imposm.config.imposm_write_threads``).
+    """
+    return (imposm.config.imposm_write_threads or 1) > 1
+
 cdef class BDB:
     cdef TCBDB *db
     cdef object filename
     cdef int _opened
     cdef BDBCUR *_cur
-    def __cinit__(self, filename, mode='w', estimated_records=0):
+    cdef object tag_dict
+    cdef int64_t _last_id
+    cdef int64_t _appended
+    cdef int64_t _unordered
+    cdef io_stats _stats
+    cdef bint _has_header
+    cdef bint _threaded
+    def __cinit__(self, filename, mode='w', estimated_records=0, tag_dict=None):
         self.db = tcbdbnew()
         self._opened = 0
+        self._last_id = INT64_MIN
+        self._stats.enabled = cache_stats.enabled()
 
-    def __init__(self, filename, mode='w', estimated_records=0):
+    def __init__(self, filename, mode='w', estimated_records=0, tag_dict=None):
+        """
+        `tag_dict` is the `TagDictionary` for the tags of nodes, ways and
+        relations. Tags are marshaled if it is None.
+        """
         self.filename = filename
+        self.tag_dict = tag_dict
         self._tune_db(estimated_records)
         tcbdbsetcmpfunc(self.db, tccmpint64, NULL)
+        self._threaded = mode == 'r' and threaded_reads()
+        if self._threaded:
+            tcbdbsetmutex(self.db)
         if not tcbdbopen(self.db, filename, _modes[mode]):
             raise IOError(tcbdbecode(self.db))
         self._opened = 1
+        self._has_header = self._header_record() != NULL
     
+    # type of the tuning profile, see imposm.cache.tuning
+    cache_type = 'default'
+
     def _tune_db(self, estimated_records):
-        if estimated_records:
-            lmemb = 128 # default
-            nmemb = -1
-            fpow = 13 # 2^13 = 8196
-            bnum = int((estimated_records*3)/lmemb)
-            tcbdbtune(self.db, lmemb, nmemb, bnum, 5, fpow, BDBTLARGE | BDBTDEFLATE)
-        else:
-            tcbdbtune(self.db, -1, -1, -1, 5, 13, BDBTLARGE | BDBTDEFLATE)
+        profile = tuning_profile(self.cache_type, estimated_records)
+        log.debug('%s: %s', self.filename, describe_profile(profile))
+        # the tuning is stored in the file, only the cache sizes
+        # are used for existing files
+        tcbdbtune(self.db, profile['lmemb'], profile['nmemb'], profile['bnum'],
+            profile['apow'], profile['fpow'], BDBTLARGE | _compression[profile['compress']])
+        tcbdbsetcache(self.db, profile['lcnum'], profile['ncnum'])
     
     def get(self, int64_t osmid):
         """
@@ -121,9 +480,18 @@ cdef class BDB:
         """
         cdef void *ret
         cdef int ret_size
-        ret = tcbdbget3(self.db, <char *>&osmid, sizeof(int64_t), &ret_size)
+        cdef double start
+        ret = self._get_record(osmid, &ret_size)
         if not ret: return None
-        return self._obj(osmid, PyMarshal_ReadObjectFromString(<char *>ret, ret_size))
+        try:
+            if not self._stats.enabled:
+                return self._decode(osmid, <char *>ret, ret_size)
+            start = _now()
+            obj = self._decode(osmid, <char *>ret, ret_size)
+            self._stats.decode_time += _now() - start
+            return obj
+        finally:
+            self._release_record(ret)
 
     def get_raw(self, int64_t osmid):
         """
@@ -132,15 +500,110 @@ cdef class BDB:
         """
         cdef void *ret
         cdef int ret_size
-        ret = tcbdbget3(self.db, <char *>&osmid, sizeof(int64_t), &ret_size)
+        ret = self._get_record(osmid, &ret_size)
         if not ret: return None
-        return PyString_FromStringAndSize(<char *>ret, ret_size)
+        data = PyString_FromStringAndSize(<char *>ret, ret_size)
+        self._release_record(ret)
+        return data
+
+    cdef void *_get_record(self, int64_t osmid, int *size):
+        """
+        Return the record of `osmid` or NULL, release it with
+        `_release_record`. Caches that are shared by multiple threads
+        return a copy of the record and look it up without the GIL.
+        """
+        cdef void *ret
+        cdef io_stats st
+        if not self._threaded:
+            return _bdb_get(self.db, &self._stats, osmid, size)
+        _init_io_stats(&st, self._stats.enabled)
+        with nogil:
+            ret = _bdb_get(self.db, &st, osmid, size, 1)
+        _add_io_stats(&self._stats, &st)
+        return ret
+
+    cdef void _release_record(self, void *record):
+        if self._threaded:
+            free(record)
 
     def put(self, int64_t osmid, data):
         return self.put_marshaled(osmid, PyMarshal_WriteObjectToString(data, 2))
 
     def put_marshaled(self, int64_t osmid, data):
-        return tcbdbput(self.db, <char *>&osmid, sizeof(int64_t), <char *>data, len(data))
+        return self._put_record(osmid, <char *>data, len(data))
+
+    cdef bint _put_record(self, int64_t osmid, char *data, int size) nogil:
+        """
+        Store the data for osmid. Counts the records that are stored in
+        increasing id order. These are appended to the last leaf of the
+        B+ tree (Tokyo Cabinet checks the last used leaf before it searches
+        the tree) and only need a split of this leaf when it is full.
+        """
+        cdef double start
+        cdef bint ok
+        if self._stats.enabled:
+            start = _now()
+            ok = tcbdbput(self.db, <char *>&osmid, sizeof(int64_t), data, size)
+            self._stats.put_time += _now() - start
+        else:
+            ok = tcbdbput(self.db, <char *>&osmid, sizeof(int64_t), data, size)
+        if not ok:
+            return False
+        if osmid > self._last_id:
+            self._appended += 1
+        else:
+            self._unordered += 1
+        self._last_id = osmid
+        return True
+
+    cdef void *_header_record(self, int *size=NULL):
+        cdef int64_t key = INT64_MIN
+        cdef int ret_size
+        return tcbdbget3(self.db, <char *>&key, sizeof(int64_t), size if size else &ret_size)
+
+    def header(self):
+        """
+        Return the header dict of this cache or None. The header is
+        stored in the record with the `HEADER_KEY`, which is no valid
+        OSM id, and it is skipped by all iterators.
+        """
+        cdef int size
+        cdef void *ret = self._header_record(&size)
+        if not ret:
+            return None
+        return PyMarshal_ReadObjectFromString(<char *>ret, size)
+
+    def set_header(self, header):
+        cdef int64_t key = INT64_MIN
+        data = PyMarshal_WriteObjectToString(header, 2)
+        if not tcbdbput(self.db, <char *>&key, sizeof(int64_t), <char *>data, len(data)):
+            raise IOError(tcbdbecode(self.db))
+        self._has_header = True
+
+    def stats(self):
+        """
+        Return the number of records that were put in increasing
+        id order (`appended`) and out of order (`unordered`).
+        """
+        return dict(appended=self._appended, unordered=self._unordered)
+
+    def io_stats(self):
+        """
+        Return the counters and the get latency histogram, see
+        `imposm.cache.stats`. All values are 0 if the stats are disabled.
+        """
+        return dict(gets=self._stats.gets, misses=self._stats.misses,
+            puts=self._appended + self._unordered, bytes_read=self._stats.bytes_read,
+            get_time=self._stats.get_time, decode_time=self._stats.decode_time,
+            put_time=self._stats.put_time,
+            get_latency=[self._stats.get_latency[i] for i in range(STATS_HIST_BUCKETS)])
+
+    cdef object _decode(self, int64_t osmid, char *data, int size):
+        """
+        Create an object from the id and the stored data.
+        Unmarshals the data and calls `_obj` by default.
+        """
+        return self._obj(osmid, PyMarshal_ReadObjectFromString(data, size))
 
     cdef object _obj(self, int64_t osmid, data):
         """
@@ -157,21 +620,24 @@ cdef class BDB:
         if self._cur:
             tcbdbcurdel(self._cur)
         self._cur = tcbdbcurnew(self.db)
-        if not tcbdbcurfirst(self._cur):
+        if not tcbdbcurfirst(self._cur) or (self._has_header and not tcbdbcurnext(self._cur)):
+            tcbdbcurdel(self._cur)
+            self._cur = NULL
             return iter([])
         return self
 
     def __contains__(self, int64_t osmid):
         cdef void *ret
         cdef int ret_size
-        ret = tcbdbget3(self.db, <char *>&osmid, sizeof(int64_t), &ret_size);
+        ret = self._get_record(osmid, &ret_size)
         if ret:
+            self._release_record(ret)
             return 1
         else:
             return 0
     
     def __len__(self):
-        return tcbdbrnum(self.db)
+        return tcbdbrnum(self.db) - self._has_header
     
     def __next__(self):
         """
@@ -181,31 +647,112 @@ cdef class BDB:
 
         if not self._cur: raise StopIteration
 
-        osmid, data = self._get_cur()
+        obj = self._get_cur()
 
         # advance cursor, set to NULL if at the end
         if tcbdbcurnext(self._cur) == 0:
             tcbdbcurdel(self._cur)
             self._cur = NULL
         
-        # return objectified item
-        return self._obj(osmid, data)
+        return obj
 
     cdef object _get_cur(self):
         """
-        Return the current object at the current cursor position
-        as a tuple of the id and the unmarshaled data.
+        Return the object at the current cursor position.
         """
         cdef int size
         cdef void *ret
+        cdef int64_t osmid
         ret = tcbdbcurkey3(self._cur, &size)
         osmid = (<int64_t *>ret)[0]
         ret = tcbdbcurval3(self._cur, &size)
-        value = PyMarshal_ReadObjectFromString(<char *>ret, size)
-        return osmid, value
+        return self._decode(osmid, <char *>ret, size)
+
+    def iter_raw(self):
+        """
+        Return an iterator of all ``(osmid, data)`` in id order,
+        with the undecoded data.
+        """
+        cdef BDBCUR *cur = tcbdbcurnew(self.db)
+        cdef int size
+        cdef void *ret
+        cdef int64_t osmid
+        try:
+            if not tcbdbcurfirst(cur):
+                return
+            if self._has_header and not tcbdbcurnext(cur):
+                return
+            while True:
+                ret = tcbdbcurkey3(cur, &size)
+                osmid = (<int64_t *>ret)[0]
+                ret = tcbdbcurval3(cur, &size)
+                yield osmid, PyString_FromStringAndSize(<char *>ret, size)
+                if not tcbdbcurnext(cur):
+                    break
+        finally:
+            tcbdbcurdel(cur)
+
+    def iter_ids(self, IdBitmap ids):
+        """
+        Return an iterator of all objects with an id in `ids`, in id
+        order. Reads all records with a cursor, but only decodes the
+        records of `ids`.
+        """
+        cdef BDBCUR *cur = tcbdbcurnew(self.db)
+        cdef int size
+        cdef void *ret
+        cdef int64_t osmid
+        try:
+            if not tcbdbcurfirst(cur):
+                return
+            if self._has_header and not tcbdbcurnext(cur):
+                return
+            while True:
+                ret = tcbdbcurkey3(cur, &size)
+                osmid = (<int64_t *>ret)[0]
+                if ids._contains(osmid):
+                    ret = tcbdbcurval3(cur, &size)
+                    yield self._decode(osmid, <char *>ret, size)
+                if not tcbdbcurnext(cur):
+                    break
+        finally:
+            tcbdbcurdel(cur)
+
+    def advise(self, hint):
+        """
+        Hint the access pattern of the next reads: 'sequential', 'random'
+        or 'willneed'. Tokyo Cabinet reads with its own file descriptor,
+        so the only useful hint is to warm up the page cache: 'sequential'
+        and 'willneed' load the whole file, if it fits into memory.
+        Returns True if the hint was passed to the OS.
+        """
+        _check_hint(hint)
+        if hint == 'random':
+            return False
+        return _fadvise_willneed(self.filename)
+
+    def compact(self, int64_t bnum=-1, compress=False):
+        """
+        Rewrite the file with all records in key order, so that the
+        leaves are stored sequentially and without the free blocks of
+        removed or grown records (see tcbdboptimize).
+        `bnum` is the new number of buckets (-1 for the default) and
+        `compress` the new compression (see `_compression`), keeps the
+        current compression if False. Needs a cache opened in 'w' mode.
+        """
+        cdef int opts = 0xff
+        if compress is not False:
+            opts = BDBTLARGE | _compression[compress]
+        if not tcbdboptimize(self.db, -1, -1, bnum, -1, -1, opts):
+            raise IOError(tcbdbecode(self.db))
 
     def close(self):
         if self._opened:
+            if self._appended or self._unordered:
+                log.debug('%s: %d records appended in id order, %d out of order',
+                    self.filename, self._appended, self._unordered)
+            if self._stats.enabled and (self._stats.gets or self._appended or self._unordered):
+                cache_stats.record(self.cache_type, self.io_stats())
             tcbdbclose(self.db)
         self._opened = 0
     
@@ -214,7 +761,154 @@ cdef class BDB:
             tcbdbclose(self.db)
         tcbdbdel(self.db)
 
+ctypedef struct tc_coords:
+    TCBDB *db
+    io_stats *stats
+    bint copy
+
+cdef bint _tc_coord_lookup(void *ctx, int64_t osmid, coord *out) nogil:
+    cdef tc_coords *tc = <tc_coords *>ctx
+    cdef int ret_size
+    cdef coord *value = <coord *>_bdb_get(tc.db, tc.stats, osmid, &ret_size, tc.copy)
+    if not value:
+        return 0
+    out[0] = value[0]
+    if tc.copy:
+        free(value)
+    return 1
+
+def _coords_precision(BDB db, mode):
+    """
+    Return the coords precision from the header of `db`. Stores the
+    configured precision in new caches.
+    """
+    header = db.header()
+    if header is not None:
+        return header.get('coords_precision')
+    precision = coords_precision(imposm.config.imposm_coords_precision)
+    if mode == 'w' and precision is not None and not len(db):
+        db.set_header({'coords_precision': precision})
+        return precision
+    # caches without header use the full precision
+    return None
+
+# coords are sent from the parser to the coords cache writers as packed
+# records in shared memory buffers, see imposm.reader
+ctypedef struct packed_coord:
+    int64_t osmid
+    double x
+    double y
+
+PACKED_COORD_SIZE = sizeof(packed_coord)
+
+def pack_coords(coords, buf):
+    """
+    Pack the ``(osmid, x, y)`` `coords` into the writable buffer `buf`
+    (i.e. a `mmap`). Returns the number of packed bytes.
+    """
+    cdef void *data
+    cdef Py_ssize_t size, i = 0
+    cdef packed_coord *records
+    PyObject_AsWriteBuffer(buf, &data, &size)
+    if len(coords) * sizeof(packed_coord) > size:
+        raise ValueError('%d coords do not fit into %d bytes' % (len(coords), size))
+    records = <packed_coord *>data
+    for osmid, x, y in coords:
+        records[i].osmid = osmid
+        records[i].x = x
+        records[i].y = y
+        i += 1
+    return i * sizeof(packed_coord)
+
+cdef int _cmp_packed_coord(const void *a, const void *b) nogil:
+    cdef int64_t a_id = (<packed_coord *>a).osmid, b_id = (<packed_coord *>b).osmid
+    return (a_id > b_id) - (a_id < b_id)
+
+cdef class PackedCoords:
+    """
+    Growable array of packed coords, the reorder buffer of the coords
+    cache writers.
+    """
+    cdef packed_coord *records
+    cdef Py_ssize_t length
+    cdef Py_ssize_t capacity
+
+    def __cinit__(self):
+        self.records = NULL
+        self.length = 0
+        self.capacity = 0
+
+    def __dealloc__(self):
+        free(self.records)
+
+    def __len__(self):
+        return self.length
+
+    def extend(self, buf, Py_ssize_t size):
+        """
+        Copy the first `size` bytes of packed coords from `buf`.
+        """
+        cdef void *data
+        cdef Py_ssize_t buf_size, n = size // sizeof(packed_coord)
+        cdef Py_ssize_t capacity
+        cdef void *records
+        PyObject_AsReadBuffer(buf, &data, &buf_size)
+        if size > buf_size:
+            raise ValueError('buffer is smaller than %d bytes' % size)
+        if self.length + n > self.capacity:
+            capacity = max(self.length + n, self.capacity * 2)
+            records = realloc(self.records, capacity * sizeof(packed_coord))
+            if not records:
+                raise MemoryError()
+            self.records = <packed_coord *>records
+            self.capacity = capacity
+        memcpy(self.records + self.length, data, n * sizeof(packed_coord))
+        self.length += n
+
+    def sort(self):
+        """
+        Sort the coords by id.
+        """
+        with nogil:
+            qsort(self.records, self.length, sizeof(packed_coord), _cmp_packed_coord)
+
+    def remove(self, Py_ssize_t n):
+        """
+        Remove the first `n` coords.
+        """
+        n = min(max(n, 0), self.length)
+        memmove(self.records, self.records + n, (self.length - n) * sizeof(packed_coord))
+        self.length -= n
+
+    def __iter__(self):
+        """
+        Return an iterator of all ``(osmid, x, y)``.
+        """
+        cdef Py_ssize_t i
+        for i in range(self.length):
+            yield self.records[i].osmid, self.records[i].x, self.records[i].y
+
+    cdef Py_ssize_t _stop(self, Py_ssize_t stop):
+        if stop < 0 or stop > self.length:
+            return self.length
+        return stop
+
 cdef class CoordDB(BDB):
+    """
+    Coords cache that stores each coord as fixed-point ``uint32`` values
+    with the precision from the header of the file
+    (see ``imposm.config.imposm_coords_precision``).
+    """
+    cdef readonly object precision
+    cdef double _factor
+
+    cache_type = 'coords'
+
+    def __init__(self, filename, mode='w', estimated_records=0, tag_dict=None):
+        BDB.__init__(self, filename, mode, estimated_records, tag_dict)
+        self.precision = _coords_precision(self, mode)
+        self._factor = coord_factor(self.precision)
+
     def put(self, osmid, x, y):
         return self._put(osmid, x, y)
     
@@ -222,28 +916,69 @@ cdef class CoordDB(BDB):
         return self._put(osmid, x, y)
     
     cdef bint _put(self, int64_t osmid, double x, double y) nogil:
-        cdef coord p = coord_struct(x, y)
-        return tcbdbput(self.db, <char *>&osmid, sizeof(int64_t), <char *>&p, sizeof(coord))
+        cdef coord p = coord_struct(x, y, self._factor)
+        return self._put_record(osmid, <char *>&p, sizeof(coord))
+
+    def put_packed(self, PackedCoords coords, Py_ssize_t stop=-1):
+        """
+        Store the first `stop` (all by default) `coords`, without the GIL.
+        """
+        cdef Py_ssize_t i
+        stop = coords._stop(stop)
+        with nogil:
+            for i in range(stop):
+                self._put(coords.records[i].osmid, coords.records[i].x, coords.records[i].y)
+        return stop
+
+    cdef tc_coords _lookup_ctx(self):
+        cdef tc_coords ctx
+        ctx.db = self.db
+        ctx.stats = &self._stats
+        ctx.copy = self._threaded
+        return ctx
 
     def get(self, int64_t osmid):
-        cdef coord *value
-        cdef int ret_size
-        value = <coord *>tcbdbget3(self.db, <char *>&osmid, sizeof(int64_t), &ret_size)
-        if not value: return
-        return _uint32_to_coord(value.x), _uint32_to_coord(value.y)
+        cdef coord value
+        cdef tc_coords ctx = self._lookup_ctx()
+        if not _tc_coord_lookup(&ctx, osmid, &value): return
+        return _uint32_to_coord(value.x, self._factor), _uint32_to_coord(value.y, self._factor)
 
     def get_coords(self, refs):
-        cdef coord *value
-        cdef int ret_size
+        cdef coord value
+        cdef tc_coords ctx = self._lookup_ctx()
         cdef int64_t osmid
         coords = list()
         for osmid in refs:
-            value = <coord *>tcbdbget3(self.db, <char *>&osmid, sizeof(int64_t), &ret_size)
-            if not value: return
-            coords.append((_uint32_to_coord(value.x), _uint32_to_coord(value.y)))
+            if not _tc_coord_lookup(&ctx, osmid, &value): return
+            coords.append((_uint32_to_coord(value.x, self._factor),
+                _uint32_to_coord(value.y, self._factor)))
         
         return coords
 
+    def get_coords_array(self, refs):
+        """
+        Return the coords of all `refs` as a flat double array
+        (x0, y0, x1, y1, ...). Returns None if a coord is missing.
+        """
+        coords, offsets, missing = self.get_ways_coords_array([refs])
+        if missing[0]:
+            return None
+        return coords
+
+    def get_ways_coords_array(self, ways_refs):
+        """
+        Return the coords for a list of refs lists, see `_lookup_ways_coords`.
+        """
+        cdef tc_coords ctx = self._lookup_ctx()
+        cdef io_stats st
+        # count in st, the lookup runs without the GIL
+        _init_io_stats(&st, self._stats.enabled)
+        ctx.stats = &st
+        try:
+            return _lookup_ways_coords(_tc_coord_lookup, &ctx, ways_refs, self._factor)
+        finally:
+            _add_io_stats(&self._stats, &st)
+
     cdef object _get_cur(self):
         cdef int size
         cdef int64_t osmid
@@ -252,201 +987,2376 @@ cdef class CoordDB(BDB):
         ret = tcbdbcurkey3(self._cur, &size)
         osmid = (<int64_t *>ret)[0]
         value = <coord *>tcbdbcurval3(self._cur, &size)
-        return osmid, (_uint32_to_coord(value.x), _uint32_to_coord(value.y))
-
-    cdef object _obj(self, int64_t osmid, data):
-        return osmid, data
+        return osmid, (_uint32_to_coord(value.x, self._factor),
+            _uint32_to_coord(value.y, self._factor))
 
-cdef class NodeDB(BDB):
-    def put(self, osmid, tags, pos):
-        return self.put_marshaled(osmid, PyMarshal_WriteObjectToString((tags, pos), 2))
-    
-    def put_marshaled(self, int64_t osmid, data):
-        return tcbdbput(self.db, <char *>&osmid, sizeof(int64_t), <char *>data, len(data))
+DEF DENSE_HEADER_SIZE = 4096
+DEF DENSE_GROW_SLOTS = 8388608 # 64MB
+# offset of the coords precision (double) in the header, 0 for full precision
+DEF DENSE_PRECISION_OFFSET = 64
+DENSE_MAGIC = 'imposm dense coords 1\n'
 
-    cdef object _obj(self, int64_t osmid, data):
-        return Node(osmid, data[0], data[1])
+ctypedef struct dense_coords:
+    coord *coords
+    int64_t size
 
-cdef class InsertedWayDB(BDB):
-    def put(self, int64_t osmid):
-        return tcbdbput(self.db, <char *>&osmid, sizeof(int64_t), 'x', 1);
+cdef coord *_dense_coord_get(dense_coords *dense, int64_t osmid) nogil:
+    if osmid < 0 or osmid >= dense.size or dense.coords[osmid].y == 0:
+        return NULL
+    return &dense.coords[osmid]
 
-    def __next__(self):
-        """
-        Return next item as object.
-        """
-        cdef int64_t osmid
-        cdef int size
-        cdef void *ret
+cdef bint _dense_coord_lookup(void *ctx, int64_t osmid, coord *out) nogil:
+    cdef coord *value = _dense_coord_get(<dense_coords *>ctx, osmid)
+    if not value:
+        return 0
+    out[0] = value[0]
+    return 1
 
-        if not self._cur: raise StopIteration
+def is_dense_coords_file(filename):
+    """
+    Return ``True`` if `filename` was written by `DenseCoordDB`.
+    """
+    with open(filename, 'rb') as f:
+        return f.read(len(DENSE_MAGIC)) == DENSE_MAGIC
 
-        ret = tcbdbcurkey3(self._cur, &size)
-        osmid = (<int64_t *>ret)[0]
+cdef class DenseCoordDB:
+    """
+    Coordinates cache that stores all coords in a memory-mapped file
+    that is indexed by the node id. Puts and gets are simple offset
+    calculations, caching is left to the OS page cache.
 
-        # advance cursor, set to NULL if at the end
-        if tcbdbcurnext(self._cur) == 0:
-            tcbdbcurdel(self._cur)
-            self._cur = NULL
+    The file is sparse and its (apparent) size depends on the highest
+    node id, not on the number of nodes. Negative ids are not supported.
 
-        return osmid
+    Empty slots are detected by ``y == 0``, which is a latitude of -180
+    and does not occur in valid data.
 
-cdef class RefTagDB(BDB):
-    """
-    Database for items with references and tags (i.e. ways/relations).
+    The precision of the coords is stored in the header.
     """
-    def put(self, osmid, tags, refs):
-        return self.put_marshaled(osmid, PyMarshal_WriteObjectToString((tags, refs), 2))
-    
-    def put_marshaled(self, int64_t osmid, data):
-        return tcbdbput(self.db, <char *>&osmid, sizeof(int64_t), <char *>data, len(data))
+    cdef int fd
+    cdef coord *coords
+    cdef int64_t size
+    cdef int64_t max_id
+    cdef int _opened
+    cdef int _writable
+    cdef object filename
+    cdef readonly object precision
+    cdef double _factor
 
-cdef class WayDB(RefTagDB):
-    cdef object _obj(self, int64_t osmid, data):
-        return Way(osmid, data[0], data[1])
+    def __cinit__(self, filename, mode='w', estimated_records=0):
+        self.fd = -1
+        self.coords = NULL
+        self.size = 0
+        self.max_id = -1
+        self._opened = 0
 
-cdef class RelationDB(RefTagDB):
-    cdef object _obj(self, int64_t osmid, data):
-        return Relation(osmid, data[0], data[1])
-
-from imposm.cache.internal import DeltaCoords as _DeltaCoords
-from collections import deque
-import bisect
-
-cdef unzip_nodes(list nodes):
-    cdef int64_t last_lon, last_lat, lon, lat
-    cdef double lon_f, lat_f
-    cdef int64_t last_id, id
-    ids, lons, lats = [], [], []
-    last_id = last_lon = last_lat = 0
-    for id, lon_f, lat_f in nodes:
-        lon = _coord_to_uint32(lon_f)
-        lat = _coord_to_uint32(lat_f)
-        
-        ids.append(id - last_id)
-        lons.append(lon - last_lon)
-        lats.append(lat - last_lat)
-        last_id = id
-        last_lon = lon
-        last_lat = lat
-    
-    return ids, lons, lats
-
-cdef zip_nodes(tuple ids, tuple lons, tuple lats):
-    cdef uint32_t last_lon, last_lat
-    cdef int64_t last_id
-    nodes = []
-    last_id = last_lon = last_lat = 0
-
-    for i in range(len(ids)):
-        last_id += ids[i]
-        last_lon += lons[i]
-        last_lat += lats[i]
-    
-        nodes.append((
-            last_id,
-            _uint32_to_coord(last_lon),
-            _uint32_to_coord(last_lat)
-        ))
-    return nodes
-
-class DeltaNodes(object):
-    def __init__(self, data=None):
-        self.nodes = []
-        self.changed = False
-        if data:
-            self.deserialize(data)
-    
-    def changed(self):
-        return self.changed
-    
-    def get(self, int64_t osmid):
-        i = bisect.bisect(self.nodes, (osmid, ))
-        if i != len(self.nodes) and self.nodes[i][0] == osmid:
-            return self.nodes[i][1:]
-        return None
-    
-    def add(self, int64_t osmid, double lon, double lat):
-        # todo: overwrite
-        self.changed = True
-        if self.nodes and self.nodes[-1][0] < osmid:
-            self.nodes.append((osmid, lon, lat))
+    def __init__(self, filename, mode='w', estimated_records=0):
+        cdef stat st
+        self.filename = filename
+        self._writable = mode == 'w'
+        if self._writable:
+            self.fd = c_open(filename, O_RDWR | O_CREAT, 0644)
         else:
-            bisect.insort(self.nodes, (osmid, lon, lat))
-    
-    def serialize(self):
-        ids, lons, lats = unzip_nodes(self.nodes)
-        nodes = _DeltaCoords()
-        nodes.ids = ids
-        nodes.lons = lons
-        nodes.lats = lats
-        return nodes.SerializeToString()
-    
-    def deserialize(self, data):
-        nodes = _DeltaCoords()
-        nodes.ParseFromString(data)
-        self.nodes = zip_nodes(
-            nodes.ids, nodes.lons, nodes.lats)
+            self.fd = c_open(filename, O_RDONLY, 0)
+        if self.fd < 0:
+            raise IOError('unable to open %s' % filename)
+        self._opened = 1
 
-class DeltaCoordsDB(object):
-    def __init__(self, filename, mode='w', estimated_records=0, delta_nodes_cache_size=100, delta_nodes_size=6):
-        self.db = BDB(filename, mode, estimated_records)
-        self.mode = mode
-        self.delta_nodes = {}
-        self.delta_node_ids = deque()
-        self.delta_nodes_cache_size = delta_nodes_cache_size
-        self.delta_nodes_size = delta_nodes_size
-    
-    def put(self, int64_t osmid, double lon, double lat):
-        if self.mode == 'r':
-            return None
-        delta_id = osmid >> self.delta_nodes_size
-        if delta_id not in self.delta_nodes:
-            self.fetch_delta_node(delta_id)
-        delta_node = self.delta_nodes[delta_id]
-        delta_node.add(osmid, lon, lat)
-        return True
-    
-    put_marshaled = put
-    
-    def get(self, osmid):
-        delta_id = osmid >> self.delta_nodes_size
-        if delta_id not in self.delta_nodes:
-            self.fetch_delta_node(delta_id)
-        return self.delta_nodes[delta_id].get(osmid)
-    
-    def get_coords(self, osmids):
-        coords = []
-        for osmid in osmids:
-            coord = self.get(osmid)
+        if fstat(self.fd, &st) != 0:
+            raise IOError('unable to stat %s' % filename)
+        if st.st_size == 0 and self._writable:
+            self._resize(DENSE_HEADER_SIZE)
+            self._map(DENSE_HEADER_SIZE)
+            header = DENSE_MAGIC.ljust(DENSE_HEADER_SIZE, '\0')
+            memcpy(self._header(), <char *>header, DENSE_HEADER_SIZE)
+            self.precision = coords_precision(imposm.config.imposm_coords_precision)
+            if self.precision is not None:
+                (<double *>(self._header() + DENSE_PRECISION_OFFSET))[0] = self.precision
+        elif not is_dense_coords_file(filename):
+            raise IOError('%s is not a dense coords cache' % filename)
+        else:
+            self._map(st.st_size)
+            self.max_id = self.size - 1
+            if (<double *>(self._header() + DENSE_PRECISION_OFFSET))[0] != 0:
+                self.precision = (<double *>(self._header() + DENSE_PRECISION_OFFSET))[0]
+        self._factor = coord_factor(self.precision)
+
+    cdef char *_header(self):
+        return (<char *>self.coords) - DENSE_HEADER_SIZE
+
+    cdef _resize(self, int64_t fsize):
+        if ftruncate(self.fd, fsize) != 0:
+            raise IOError('unable to resize %s' % self.filename)
+
+    cdef _map(self, int64_t fsize):
+        cdef void *m
+        cdef int prot = PROT_READ
+        if self.coords:
+            munmap(self._header(), self.size * sizeof(coord) + DENSE_HEADER_SIZE)
+            self.coords = NULL
+            self.size = 0
+        if self._writable:
+            prot |= PROT_WRITE
+        m = mmap(NULL, fsize, prot, MAP_SHARED, self.fd, 0)
+        if m == MAP_FAILED:
+            raise IOError('unable to mmap %s' % self.filename)
+        self.coords = <coord *>((<char *>m) + DENSE_HEADER_SIZE)
+        self.size = (fsize - DENSE_HEADER_SIZE) // sizeof(coord)
+
+    cdef _grow(self, int64_t osmid):
+        cdef int64_t slots = ((osmid // DENSE_GROW_SLOTS) + 1) * DENSE_GROW_SLOTS
+        cdef int64_t fsize = DENSE_HEADER_SIZE + slots * sizeof(coord)
+        self._resize(fsize)
+        self._map(fsize)
+
+    def put(self, osmid, x, y):
+        return self._put(osmid, x, y)
+
+    def put_marshaled(self, osmid, x, y):
+        return self._put(osmid, x, y)
+
+    def put_packed(self, PackedCoords coords, Py_ssize_t stop=-1):
+        """
+        Store the first `stop` (all by default) `coords`.
+        """
+        cdef Py_ssize_t i
+        stop = coords._stop(stop)
+        for i in range(stop):
+            self._put(coords.records[i].osmid, coords.records[i].x, coords.records[i].y)
+        return stop
+
+    cdef int _put(self, int64_t osmid, double x, double y) except -1:
+        if not self._writable or osmid < 0:
+            return 0
+        if osmid >= self.size:
+            self._grow(osmid)
+        self.coords[osmid] = coord_struct(x, y, self._factor)
+        if osmid > self.max_id:
+            self.max_id = osmid
+        return 1
+
+    cdef inline coord *_get(self, int64_t osmid) nogil:
+        cdef dense_coords dense
+        dense.coords = self.coords
+        dense.size = self.size
+        return _dense_coord_get(&dense, osmid)
+
+    def get(self, int64_t osmid):
+        cdef coord *value = self._get(osmid)
+        if not value: return
+        return _uint32_to_coord(value.x, self._factor), _uint32_to_coord(value.y, self._factor)
+
+    def get_coords(self, refs):
+        cdef coord *value
+        cdef int64_t osmid
+        coords = list()
+        for osmid in refs:
+            value = self._get(osmid)
+            if not value: return
+            coords.append((_uint32_to_coord(value.x, self._factor),
+                _uint32_to_coord(value.y, self._factor)))
+
+        return coords
+
+    def get_coords_array(self, refs):
+        """
+        Return the coords of all `refs` as a flat double array
+        (x0, y0, x1, y1, ...). Returns None if a coord is missing.
+        """
+        coords, offsets, missing = self.get_ways_coords_array([refs])
+        if missing[0]:
+            return None
+        return coords
+
+    def get_ways_coords_array(self, ways_refs):
+        """
+        Return the coords for a list of refs lists, see `_lookup_ways_coords`.
+        """
+        cdef dense_coords dense
+        dense.coords = self.coords
+        dense.size = self.size
+        return _lookup_ways_coords(_dense_coord_lookup, &dense, ways_refs, self._factor)
+
+    def __contains__(self, int64_t osmid):
+        return self._get(osmid) != NULL
+
+    def advise(self, hint):
+        """
+        Hint the access pattern of the next reads, see `BDB.advise`.
+        """
+        if not self.coords:
+            return False
+        return _madvise(self._header(), self.size * sizeof(coord) + DENSE_HEADER_SIZE, hint)
+
+    def __iter__(self):
+        """
+        Return an iterator of all ``(osmid, (x, y))`` in id order.
+        """
+        cdef int64_t osmid
+        cdef coord *value
+        for osmid in range(self.max_id + 1):
+            value = self._get(osmid)
+            if value:
+                yield osmid, (_uint32_to_coord(value.x, self._factor),
+                    _uint32_to_coord(value.y, self._factor))
+
+    def close(self):
+        if not self._opened:
+            return
+        if self.coords:
+            munmap(self._header(), self.size * sizeof(coord) + DENSE_HEADER_SIZE)
+            self.coords = NULL
+        if self._writable:
+            # remove preallocated slots after the last node
+            self._resize(DENSE_HEADER_SIZE + (self.max_id + 1) * sizeof(coord))
+        self.size = 0
+        c_close(self.fd)
+        self._opened = 0
+
+    def __dealloc__(self):
+        if self.coords:
+            munmap(self._header(), self.size * sizeof(coord) + DENSE_HEADER_SIZE)
+        if self._opened:
+            c_close(self.fd)
+
+DEF TAGS_CODED = 2
+DEF TAGS_FORMAT_VERSION = 2
+
+# Tags of nodes, ways and relations are stored as a varint length
+# followed by the marshaled tags or, with the TAGS_CODED flag, by:
+#
+#  - varint count of key/value pairs
+#  - varint for each key and value: (code << 2) | (is_unicode << 1) for
+#    strings of the tag dictionary, otherwise
+#    (length << 2) | (is_unicode << 1) | 1 followed by the (UTF-8
+#    encoded) string
+#
+# is_unicode keeps the type of each string, the decoded tags are
+# equal to the marshaled tags.
+
+cdef object _encode_tags(tags, tag_dict):
+    """
+    Encode tags with the codes of `tag_dict`. Returns None if
+    the tags contain anything but strings.
+    """
+    cdef Py_ssize_t n = 0, size = 10
+    cdef unsigned char *buf
+    codes = tag_dict.codes
+    items = []
+    for kv in tags.iteritems():
+        for s in kv:
+            code = codes.get(s)
+            if code is not None:
+                items.append((code << 2) | (isinstance(s, unicode) << 1))
+                size += 10
+            elif isinstance(s, unicode):
+                s = s.encode('utf-8')
+                items.append((len(s) << 2) | 3)
+                items.append(s)
+                size += 10 + len(s)
+            elif isinstance(s, str):
+                items.append((len(s) << 2) | 1)
+                items.append(s)
+                size += 10 + len(s)
+            else:
+                return None
+    buf = <unsigned char *>malloc(size)
+    if not buf:
+        raise MemoryError()
+    try:
+        n = _write_varint(buf, len(tags))
+        for item in items:
+            if isinstance(item, str):
+                memcpy(buf + n, <char *>item, len(item))
+                n += len(item)
+            else:
+                n += _write_varint(buf + n, item)
+        return PyString_FromStringAndSize(<char *>buf, n)
+    finally:
+        free(buf)
+
+cdef object _encode_tags_field(tags, tag_dict, int *flags):
+    """
+    Return the encoded tags and add TAGS_CODED to `flags` if the
+    tags are coded.
+    """
+    cdef unsigned char buf[10]
+    data = None
+    if tag_dict is not None:
+        data = _encode_tags(tags, tag_dict)
+    if data is None:
+        data = PyMarshal_WriteObjectToString(tags, 2)
+    else:
+        flags[0] |= TAGS_CODED
+    return PyString_FromStringAndSize(<char *>buf, _write_varint(buf, len(data))) + data
+
+cdef object _decode_tag_string(unsigned char *data, Py_ssize_t size, Py_ssize_t *pos,
+    list strings, list encoded):
+    cdef uint64_t v, length
+    cdef Py_ssize_t p = _read_varint(data, pos[0], size, &v)
+    if p < 0:
+        raise ValueError('invalid record')
+    if not v & 1:
+        if v >> 2 >= <uint64_t>len(strings):
+            raise ValueError('unknown tag code %d' % (v >> 2))
+        pos[0] = p
+        if v & 2:
+            return strings[v >> 2]
+        return encoded[v >> 2]
+    length = v >> 2
+    if p + <Py_ssize_t>length > size:
+        raise ValueError('invalid record')
+    pos[0] = p + length
+    s = PyString_FromStringAndSize(<char *>data + p, length)
+    if v & 2:
+        return s.decode('utf-8')
+    return s
+
+cdef object _decode_tags(unsigned char *data, Py_ssize_t size, Py_ssize_t *pos, tag_dict):
+    """
+    Return the tags of a node/way/relation record and set `pos`
+    to the start of the remaining data.
+    """
+    cdef uint64_t length, count
+    cdef Py_ssize_t i, p = _read_varint(data, 2, size, &length)
+    cdef Py_ssize_t end
+    cdef list strings, encoded
+    if p < 0 or p + <Py_ssize_t>length > size:
+        raise ValueError('invalid record')
+    end = p + length
+    pos[0] = end
+    if not data[1] & TAGS_CODED:
+        return PyMarshal_ReadObjectFromString(<char *>data + p, length)
+    if tag_dict is None:
+        raise ValueError('coded tags but no tag dictionary')
+    strings = tag_dict.strings
+    encoded = tag_dict.encoded
+    p = _read_varint(data, p, end, &count)
+    if p < 0 or count > <uint64_t>length:
+        raise ValueError('invalid record')
+    tags = {}
+    for i in range(<Py_ssize_t>count):
+        key = _decode_tag_string(data, end, &p, strings, encoded)
+        tags[key] = _decode_tag_string(data, end, &p, strings, encoded)
+    return tags
+
+DEF NODE_FORMAT_VERSION = 1
+
+# Nodes are stored in the following format. Records without the
+# version byte were marshaled by older versions.
+#
+#  - version byte (NODE_FORMAT_VERSION)
+#  - flags byte (TAGS_CODED)
+#  - tags
+#  - two doubles with the coordinate
+
+cdef object _encode_node(tags, pos, tag_dict):
+    cdef int flags = 0
+    cdef double xy[2]
+    cdef Py_ssize_t n
+    cdef unsigned char *buf
+    xy[0], xy[1] = pos
+    tags_data = _encode_tags_field(tags, tag_dict, &flags)
+    n = 2 + len(tags_data)
+    buf = <unsigned char *>malloc(n + sizeof(xy))
+    if not buf:
+        raise MemoryError()
+    try:
+        buf[0] = NODE_FORMAT_VERSION
+        buf[1] = flags
+        memcpy(buf + 2, <char *>tags_data, len(tags_data))
+        memcpy(buf + n, xy, sizeof(xy))
+        return PyString_FromStringAndSize(<char *>buf, n + sizeof(xy))
+    finally:
+        free(buf)
+
+cdef object _decode_node(int64_t osmid, char *data, Py_ssize_t size, tag_dict):
+    cdef Py_ssize_t pos
+    cdef double xy[2]
+    tags = _decode_tags(<unsigned char *>data, size, &pos, tag_dict)
+    if pos + <Py_ssize_t>sizeof(xy) != size:
+        raise ValueError('invalid record')
+    memcpy(xy, data + pos, sizeof(xy))
+    return Node(osmid, tags, (xy[0], xy[1]))
+
+cdef object _decode_node_record(int64_t osmid, char *data, Py_ssize_t size, tag_dict):
+    """
+    Decode a node record of any version.
+    """
+    if size and data[0] == NODE_FORMAT_VERSION:
+        return _decode_node(osmid, data, size, tag_dict)
+    tags, pos = PyMarshal_ReadObjectFromString(data, size)
+    return Node(osmid, tags, pos)
+
+def encode_nodes(nodes, tag_dict=None):
+    """
+    Return the records of the (osmid, tags, pos) `nodes` as
+    (osmid, record) tuples, see `NodeDB.put_encoded`.
+    """
+    return [(n[0], _encode_node(n[1], n[2], tag_dict)) for n in nodes]
+
+cdef class NodeDB(BDB):
+    cache_type = 'nodes'
+
+    def put(self, int64_t osmid, tags, pos):
+        data = _encode_node(tags, pos, self.tag_dict)
+        return self._put_record(osmid, <char *>data, len(data))
+
+    def put_marshaled(self, int64_t osmid, data):
+        """
+        Store marshaled (tags, pos). Decodes and encodes the node,
+        the reader sends records of `encode_nodes` instead.
+        """
+        tags, pos = PyMarshal_ReadObjectFromString(data, len(data))
+        return self.put(osmid, tags, pos)
+
+    def put_encoded(self, int64_t osmid, data):
+        """
+        Store a record of `encode_nodes` as-is. The records need to be
+        encoded with the tag dictionary of this cache.
+        """
+        cdef char *c_data = data
+        if len(data) < 2 or c_data[0] != NODE_FORMAT_VERSION:
+            raise ValueError('invalid record')
+        return self._put_record(osmid, c_data, len(data))
+
+    cdef object _decode(self, int64_t osmid, char *data, int size):
+        return _decode_node_record(osmid, data, size, self.tag_dict)
+
+DEF BITMAP_HEADER_SIZE = 4096
+DEF BITMAP_GROW_BYTES = 1048576 # 8M ids
+BITMAP_MAGIC = 'imposm id bitmap 1\n'
+
+# number of set bits of each byte
+cdef unsigned char _bit_counts[256]
+for _i in range(256):
+    _bit_counts[_i] = (_i & 1) + _bit_counts[_i >> 1]
+
+cdef int64_t _count_bits(unsigned char *bits, int64_t size) nogil:
+    cdef int64_t i, n = 0
+    for i in range(size):
+        n += _bit_counts[bits[i]]
+    return n
+
+cdef class IdBitmap:
+    """
+    Set of ids that is stored as a bitmap in a memory-mapped file.
+
+    The file is sparse, only pages with ids use disk space and memory.
+    Membership tests are a single bit lookup and all processes share
+    the mapped pages. Negative ids are not supported.
+    """
+    cdef int fd
+    cdef unsigned char *bits
+    cdef int64_t size
+    cdef int64_t used
+    cdef int _opened
+    cdef int _writable
+    cdef object filename
+
+    def __cinit__(self, filename, mode='w', estimated_records=0):
+        self.fd = -1
+        self.bits = NULL
+        self.size = 0
+        self.used = 0
+        self._opened = 0
+
+    def __init__(self, filename, mode='w', estimated_records=0):
+        cdef stat st
+        self.filename = filename
+        self._writable = mode == 'w'
+        if self._writable:
+            self.fd = c_open(filename, O_RDWR | O_CREAT, 0644)
+        elif not os.path.exists(filename):
+            # nothing was added
+            return
+        else:
+            self.fd = c_open(filename, O_RDONLY, 0)
+        if self.fd < 0:
+            raise IOError('unable to open %s' % filename)
+        self._opened = 1
+
+        if fstat(self.fd, &st) != 0:
+            raise IOError('unable to stat %s' % filename)
+        if st.st_size == 0 and self._writable:
+            self._resize(BITMAP_HEADER_SIZE)
+            self._map(BITMAP_HEADER_SIZE)
+            header = BITMAP_MAGIC.ljust(BITMAP_HEADER_SIZE, '\0')
+            memcpy(self._header(), <char *>header, BITMAP_HEADER_SIZE)
+        else:
+            with open(filename, 'rb') as f:
+                if f.read(len(BITMAP_MAGIC)) != BITMAP_MAGIC:
+                    raise IOError('%s is not an id bitmap' % filename)
+            self._map(st.st_size)
+            self.used = self.size
+
+    cdef unsigned char *_header(self):
+        return self.bits - BITMAP_HEADER_SIZE
+
+    cdef _resize(self, int64_t fsize):
+        if ftruncate(self.fd, fsize) != 0:
+            raise IOError('unable to resize %s' % self.filename)
+
+    cdef _map(self, int64_t fsize):
+        cdef void *m
+        cdef int prot = PROT_READ
+        if self.bits:
+            munmap(self._header(), self.size + BITMAP_HEADER_SIZE)
+            self.bits = NULL
+            self.size = 0
+        if self._writable:
+            prot |= PROT_WRITE
+        m = mmap(NULL, fsize, prot, MAP_SHARED, self.fd, 0)
+        if m == MAP_FAILED:
+            raise IOError('unable to mmap %s' % self.filename)
+        self.bits = (<unsigned char *>m) + BITMAP_HEADER_SIZE
+        self.size = fsize - BITMAP_HEADER_SIZE
+
+    def put(self, int64_t osmid):
+        return bool(self._put(osmid))
+
+    def update(self, ids):
+        """
+        Add all `ids`.
+        """
+        cdef int64_t osmid
+        for osmid in ids:
+            self._put(osmid)
+
+    cdef int _put(self, int64_t osmid) except -1:
+        cdef int64_t pos = osmid >> 3
+        cdef int64_t fsize
+        if not self._writable or osmid < 0:
+            return 0
+        if pos >= self.size:
+            fsize = BITMAP_HEADER_SIZE + ((pos // BITMAP_GROW_BYTES) + 1) * BITMAP_GROW_BYTES
+            self._resize(fsize)
+            self._map(fsize)
+        self.bits[pos] |= 1 << (osmid & 7)
+        if pos >= self.used:
+            self.used = pos + 1
+        return 1
+
+    cdef inline bint _contains(self, int64_t osmid) nogil:
+        if osmid < 0 or (osmid >> 3) >= self.size:
+            return 0
+        return self.bits[osmid >> 3] & (1 << (osmid & 7))
+
+    def __contains__(self, int64_t osmid):
+        return self._contains(osmid)
+
+    def __len__(self):
+        cdef int64_t n
+        if not self.bits:
+            return 0
+        with nogil:
+            n = _count_bits(self.bits, self.used)
+        return n
+
+    def __iter__(self):
+        """
+        Return an iterator of all ids in increasing order.
+        """
+        cdef int64_t i = 0
+        cdef int bit
+        while True:
+            while i < self.used and not self.bits[i]:
+                i += 1
+            if i >= self.used:
+                break
+            for bit in range(8):
+                if self.bits[i] & (1 << bit):
+                    yield (i << 3) + bit
+            i += 1
+
+    def close(self):
+        if not self._opened:
+            return
+        if self.bits:
+            munmap(self._header(), self.size + BITMAP_HEADER_SIZE)
+            self.bits = NULL
+        if self._writable:
+            # remove preallocated bytes after the last id
+            self._resize(BITMAP_HEADER_SIZE + self.used)
+        self.size = 0
+        c_close(self.fd)
+        self._opened = 0
+
+    def __dealloc__(self):
+        if self.bits:
+            munmap(self._header(), self.size + BITMAP_HEADER_SIZE)
+        if self._opened:
+            c_close(self.fd)
+
+DEF REFTAG_FORMAT_VERSION = 1
+DEF REFS_PACKED = 0
+DEF REFS_MARSHALED = 1
+
+# Ways and relations are stored in the following format. Records
+# without the version byte were marshaled by older versions.
+#
+#  - version byte (REFTAG_FORMAT_VERSION)
+#  - flags byte (REFS_PACKED or REFS_MARSHALED, and TAGS_CODED)
+#  - tags
+#  - refs/members: marshaled (REFS_MARSHALED) or packed:
+#    - way refs: varint count, zigzag/varint id deltas
+#    - relation members: varint count, zigzag/varint id deltas,
+#      one byte for each member type and the marshaled list of roles
+
+_member_types = ('node', 'way', 'relation')
+_member_type_codes = {'node': 0, 'way': 1, 'relation': 2}
+
+cdef object _encode_reftag(tags, int flags, ids, types, tail, tag_dict):
+    """
+    Encode a way/relation record. `ids` are packed as deltas, `types`
+    is a string with one byte for each id and `tail` is appended as-is.
+    """
+    cdef Py_ssize_t n = 0, size
+    cdef int64_t last = 0, ref
+    cdef unsigned char *buf
+    tags_data = _encode_tags_field(tags, tag_dict, &flags)
+    size = 2 + len(tags_data) + 10 + len(ids) * 10 + len(types) + len(tail)
+    buf = <unsigned char *>malloc(size)
+    if not buf:
+        raise MemoryError()
+    try:
+        buf[0] = REFTAG_FORMAT_VERSION
+        buf[1] = flags
+        n = 2
+        memcpy(buf + n, <char *>tags_data, len(tags_data))
+        n += len(tags_data)
+        if not flags & REFS_MARSHALED:
+            n += _write_varint(buf + n, len(ids))
+            for ref in ids:
+                n += _write_varint(buf + n, _zigzag(ref - last))
+                last = ref
+            memcpy(buf + n, <char *>types, len(types))
+            n += len(types)
+        memcpy(buf + n, <char *>tail, len(tail))
+        n += len(tail)
+        return PyString_FromStringAndSize(<char *>buf, n)
+    finally:
+        free(buf)
+
+cdef object _encode_way(tags, refs, tag_dict):
+    if refs and isinstance(refs[0], list):
+        # partial refs from --merge-cache
+        return _encode_reftag(tags, REFS_MARSHALED, (), '',
+            PyMarshal_WriteObjectToString(refs, 2), tag_dict)
+    return _encode_reftag(tags, REFS_PACKED, refs, '', '', tag_dict)
+
+cdef object _encode_relation(tags, members, tag_dict):
+    try:
+        ids = [m[0] for m in members]
+        types = ''.join([chr(_member_type_codes[m[1]]) for m in members])
+        roles = [m[2] for m in members]
+    except (KeyError, IndexError, TypeError):
+        return _encode_reftag(tags, REFS_MARSHALED, (), '',
+            PyMarshal_WriteObjectToString(members, 2), tag_dict)
+    return _encode_reftag(tags, REFS_PACKED, ids, types,
+        PyMarshal_WriteObjectToString(roles, 2), tag_dict)
+
+def encode_ways(ways, tag_dict=None):
+    """
+    Return the records of the (osmid, tags, refs) `ways` as
+    (osmid, record) tuples, see `WayDB.put_encoded`.
+    """
+    return [(w[0], _encode_way(w[1], w[2], tag_dict)) for w in ways]
+
+def encode_relations(relations, tag_dict=None):
+    """
+    Return the records of the (osmid, tags, members) `relations` as
+    (osmid, record) tuples, see `RelationDB.put_encoded`.
+    """
+    return [(r[0], _encode_relation(r[1], r[2], tag_dict)) for r in relations]
+
+cdef int _record_has_tags(char *data, Py_ssize_t size, tag_dict) except -1:
+    """
+    Return whether a node/way/relation record has tags. Coded tags
+    are not decoded.
+    """
+    cdef uint64_t length, count
+    cdef Py_ssize_t p = _read_varint(<unsigned char *>data, 2, size, &length)
+    if p < 0 or p + <Py_ssize_t>length > size:
+        raise ValueError('invalid record')
+    if not data[1] & TAGS_CODED:
+        return bool(_decode_tags(<unsigned char *>data, size, &p, tag_dict))
+    if _read_varint(<unsigned char *>data, p, p + length, &count) < 0:
+        raise ValueError('invalid record')
+    return count > 0
+
+cdef list _decode_ids(unsigned char *data, Py_ssize_t size, Py_ssize_t *pos):
+    cdef uint64_t length, v
+    cdef Py_ssize_t i, p
+    cdef int64_t last = 0
+    p = _read_varint(data, pos[0], size, &length)
+    if p < 0 or length > <uint64_t>size:
+        raise ValueError('invalid record')
+    ids = [None] * length
+    for i in range(<Py_ssize_t>length):
+        p = _read_varint(data, p, size, &v)
+        if p < 0:
+            raise ValueError('invalid record')
+        last += _unzigzag(v)
+        ids[i] = last
+    pos[0] = p
+    return ids
+
+cdef object _decode_refs(refs_data, int flags):
+    cdef Py_ssize_t pos = 0
+    if flags & REFS_MARSHALED:
+        return PyMarshal_ReadObjectFromString(refs_data, len(refs_data))
+    return _decode_ids(refs_data, len(refs_data), &pos)
+
+cdef object _decode_way(int64_t osmid, char *data, Py_ssize_t size, tag_dict):
+    cdef Py_ssize_t pos
+    tags = _decode_tags(<unsigned char *>data, size, &pos, tag_dict)
+    return LazyWay(osmid, tags,
+        PyString_FromStringAndSize(data + pos, size - pos), data[1])
+
+cdef object _decode_relation(int64_t osmid, char *data, Py_ssize_t size, tag_dict):
+    cdef Py_ssize_t pos, i
+    tags = _decode_tags(<unsigned char *>data, size, &pos, tag_dict)
+    if data[1] & REFS_MARSHALED:
+        return Relation(osmid, tags,
+            PyMarshal_ReadObjectFromString(data + pos, size - pos))
+    ids = _decode_ids(<unsigned char *>data, size, &pos)
+    if pos + len(ids) > size:
+        raise ValueError('invalid record')
+    types = [_member_types[<unsigned char>data[pos + i]] for i in range(len(ids))]
+    pos += len(ids)
+    roles = PyMarshal_ReadObjectFromString(data + pos, size - pos)
+    return Relation(osmid, tags, zip(ids, types, roles))
+
+cdef object _decode_way_record(int64_t osmid, char *data, Py_ssize_t size, tag_dict):
+    """
+    Decode a way record of any version.
+    """
+    if size and data[0] == REFTAG_FORMAT_VERSION:
+        return _decode_way(osmid, data, size, tag_dict)
+    tags, refs = PyMarshal_ReadObjectFromString(data, size)
+    return Way(osmid, tags, refs)
+
+cdef object _decode_relation_record(int64_t osmid, char *data, Py_ssize_t size, tag_dict):
+    """
+    Decode a relation record of any version.
+    """
+    if size and data[0] == REFTAG_FORMAT_VERSION:
+        return _decode_relation(osmid, data, size, tag_dict)
+    tags, members = PyMarshal_ReadObjectFromString(data, size)
+    return Relation(osmid, tags, members)
+
+class LazyWay(Way):
+    """
+    Way that decodes the refs only when they are accessed.
+    """
+    def __init__(self, osm_id, tags, refs_data, refs_flags, inserted=False):
+        self.osm_id = osm_id
+        self.tags = tags
+        self.inserted = inserted
+        self._refs_data = refs_data
+        self._refs_flags = refs_flags
+        self._refs = None
+        self._partial_refs = None
+
+    def _load_refs(self):
+        if self._refs_data is None:
+            return
+        refs = _decode_refs(self._refs_data, self._refs_flags)
+        self._refs_data = None
+        self._refs = refs
+        if refs and isinstance(refs[0], list):
+            self._refs = refs[0]
+            self._partial_refs = refs
+
+    def _get_refs(self):
+        self._load_refs()
+        return self._refs
+
+    def _set_refs(self, refs):
+        self._load_refs()
+        self._refs = refs
+
+    def _get_partial_refs(self):
+        self._load_refs()
+        return self._partial_refs
+
+    def _set_partial_refs(self, partial_refs):
+        self._load_refs()
+        self._partial_refs = partial_refs
+
+    refs = property(_get_refs, _set_refs)
+    partial_refs = property(_get_partial_refs, _set_partial_refs)
+
+cdef class RefTagDB(BDB):
+    """
+    Database for items with references and tags (i.e. ways/relations).
+    """
+    def put(self, int64_t osmid, tags, refs):
+        data = self._encode(tags, refs)
+        return self._put_record(osmid, <char *>data, len(data))
+    
+    def put_marshaled(self, int64_t osmid, data):
+        """
+        Store marshaled (tags, refs). Decodes and encodes the element,
+        the reader sends records of `encode_ways`/`encode_relations`
+        instead.
+        """
+        tags, refs = PyMarshal_ReadObjectFromString(data, len(data))
+        return self.put(osmid, tags, refs)
+
+    def put_encoded(self, int64_t osmid, data):
+        """
+        Store a record of `encode_ways`/`encode_relations` as-is. The
+        records need to be encoded with the tag dictionary of this cache.
+        """
+        cdef char *c_data = data
+        if len(data) < 2 or c_data[0] != REFTAG_FORMAT_VERSION:
+            raise ValueError('invalid record')
+        return self._put_record(osmid, c_data, len(data))
+
+    cdef object _encode(self, tags, refs):
+        return PyMarshal_WriteObjectToString((tags, refs), 2)
+
+cdef class WayDB(RefTagDB):
+    """
+    Ways cache. The ids of all ways with tags are added to the
+    `IdBitmap` `tagged_ids`, if it is set.
+    """
+    cdef public object tagged_ids
+
+    cache_type = 'ways'
+
+    def put(self, int64_t osmid, tags, refs):
+        if not RefTagDB.put(self, osmid, tags, refs):
+            return False
+        if tags and self.tagged_ids is not None:
+            self.tagged_ids.put(osmid)
+        return True
+
+    def put_encoded(self, int64_t osmid, data):
+        if not RefTagDB.put_encoded(self, osmid, data):
+            return False
+        if self.tagged_ids is not None and _record_has_tags(data, len(data), self.tag_dict):
+            self.tagged_ids.put(osmid)
+        return True
+
+    def close(self):
+        if self.tagged_ids is not None:
+            self.tagged_ids.close()
+            self.tagged_ids = None
+        RefTagDB.close(self)
+
+    cdef object _encode(self, tags, refs):
+        return _encode_way(tags, refs, self.tag_dict)
+
+    cdef object _decode(self, int64_t osmid, char *data, int size):
+        return _decode_way_record(osmid, data, size, self.tag_dict)
+
+cdef class RelationDB(RefTagDB):
+    cache_type = 'relations'
+
+    cdef object _encode(self, tags, refs):
+        return _encode_relation(tags, refs, self.tag_dict)
+
+    cdef object _decode(self, int64_t osmid, char *data, int size):
+        return _decode_relation_record(osmid, data, size, self.tag_dict)
+
+cdef class WayCoordsDB(BDB):
+    """
+    Coords of all refs of each way as consecutive fixed-point coords,
+    written by `join_way_coords`.
+    """
+    cache_type = 'way_coords'
+
+    def put(self, int64_t osmid, coords):
+        """
+        Store the flat `coords` (x0, y0, x1, y1, ...) of the way `osmid`.
+        """
+        cdef Py_ssize_t i, n = len(coords) // 2
+        cdef coord *buf = <coord *>malloc(n * sizeof(coord) + 1)
+        if not buf:
+            raise MemoryError()
+        try:
+            for i in range(n):
+                buf[i] = coord_struct(coords[2*i], coords[2*i+1], COORD_FACTOR)
+            return self._put_record(osmid, <char *>buf, n * sizeof(coord))
+        finally:
+            free(buf)
+
+    cdef object _decode(self, int64_t osmid, char *data, int size):
+        cdef coord *value = <coord *>data
+        cdef Py_ssize_t i, n = size // sizeof(coord)
+        cdef array.array coords = array.clone(_double_array, n * 2, zero=False)
+        cdef double *c = coords.data.as_doubles
+        for i in range(n):
+            c[2*i] = _uint32_to_coord(value[i].x, COORD_FACTOR)
+            c[2*i+1] = _uint32_to_coord(value[i].y, COORD_FACTOR)
+        return coords
+
+    def get_ways_coords_array(self, way_ids):
+        """
+        Return the coords of the ways `way_ids`, in the same format as
+        `CoordDB.get_ways_coords_array` returns the coords of the refs.
+        The records are read and converted without the GIL.
+        """
+        cdef Py_ssize_t i, w, n = 0, n_ways = len(way_ids)
+        cdef int64_t *ids = <int64_t *>malloc(n_ways * sizeof(int64_t) + 1)
+        cdef coord **records = <coord **>calloc(n_ways + 1, sizeof(coord *))
+        cdef int *sizes = <int *>malloc(n_ways * sizeof(int) + 1)
+        cdef io_stats st
+        cdef array.array offsets = array.clone(_long_array, n_ways + 1, zero=False)
+        cdef array.array missing = array.clone(_byte_array, n_ways, zero=True)
+        cdef array.array coords
+        cdef long *o = offsets.data.as_longs
+        cdef signed char *m = missing.data.as_schars
+        cdef double *c
+        cdef coord *value
+        try:
+            if not ids or not records or not sizes:
+                raise MemoryError()
+            for w in range(n_ways):
+                ids[w] = way_ids[w]
+            # count in st, the records are read without the GIL
+            _init_io_stats(&st, self._stats.enabled)
+            with nogil:
+                for w in range(n_ways):
+                    records[w] = <coord *>_bdb_get(self.db, &st, ids[w], &sizes[w], 1)
+                    o[w] = n
+                    if records[w]:
+                        n += sizes[w] // sizeof(coord)
+                    else:
+                        m[w] = 1
+                o[n_ways] = n
+            _add_io_stats(&self._stats, &st)
+
+            coords = array.clone(_double_array, n * 2, zero=False)
+            c = coords.data.as_doubles
+            with nogil:
+                for w in range(n_ways):
+                    value = records[w]
+                    for i in range(o[w], o[w+1]):
+                        c[2*i] = _uint32_to_coord(value.x, COORD_FACTOR)
+                        c[2*i+1] = _uint32_to_coord(value.y, COORD_FACTOR)
+                        value += 1
+            return coords, offsets, missing
+        finally:
+            if records:
+                for w in range(n_ways):
+                    free(records[w])
+            free(records)
+            free(ids)
+            free(sizes)
+
+# Join of the ways with the coords of their refs (--join-way-coords).
+#
+# The writer looks up the coords of the refs of each way in the order of
+# the way ids, which is a random order of the node ids. The join resolves
+# all refs with two external sorts instead:
+#
+#  - the (node id, way id, position) of all refs are sorted by the node id
+#  - the coords are looked up in the order of the node ids, this reads
+#    the coords cache sequentially
+#  - the (way id, position, coord) of all refs are sorted by the way id
+#    and the coords of each way are stored in the `WayCoordsDB`
+#
+# The writer then reads the coords of each way with a single get in the
+# order of the way ids.
+
+# records of each sorted run that are sorted in memory
+JOIN_RUN_RECORDS = 2000000
+# records that are read from each run at once during the merge
+DEF JOIN_BLOCK_RECORDS = 4096
+# refs that are looked up in the coords cache at once
+DEF JOIN_LOOKUP_REFS = 65536
+
+ctypedef int (*record_cmp)(const void *a, const void *b) nogil
+
+ctypedef struct ref_record:
+    int64_t ref
+    int64_t way_id
+    int64_t pos
+
+# pos is -1 for refs without coords, these sort before all refs of the way
+ctypedef struct way_ref_record:
+    int64_t way_id
+    int64_t pos
+    coord value
+
+cdef int _cmp_ref_record(const void *a, const void *b) nogil:
+    cdef int64_t a_ref = (<ref_record *>a).ref, b_ref = (<ref_record *>b).ref
+    return (a_ref > b_ref) - (a_ref < b_ref)
+
+cdef int _cmp_way_ref_record(const void *a, const void *b) nogil:
+    cdef way_ref_record *ra = <way_ref_record *>a
+    cdef way_ref_record *rb = <way_ref_record *>b
+    if ra.way_id != rb.way_id:
+        return (ra.way_id > rb.way_id) - (ra.way_id < rb.way_id)
+    return (ra.pos > rb.pos) - (ra.pos < rb.pos)
+
+ctypedef struct sort_run:
+    int fd
+    char *buf
+    Py_ssize_t length
+    Py_ssize_t pos
+
+cdef class RecordSort:
+    """
+    External sort of fixed-size C records. Records are sorted in runs of
+    `run_records` with qsort, runs are written to temporary files in
+    `tmp_dir` and merged with a heap.
+    """
+    cdef Py_ssize_t record_size
+    cdef Py_ssize_t run_records
+    cdef record_cmp cmp
+    cdef object tmp_dir
+    cdef char *records
+    cdef Py_ssize_t length
+    # temporary files of the runs, the merge reads from their fds
+    cdef list run_files
+    cdef sort_run *runs
+    cdef Py_ssize_t *heap
+    cdef Py_ssize_t heap_size
+    cdef Py_ssize_t pos
+    cdef bint merging
+
+    def __cinit__(self):
+        self.records = NULL
+        self.runs = NULL
+        self.heap = NULL
+        self.heap_size = 0
+
+    def __dealloc__(self):
+        free(self.records)
+        self._free_runs()
+
+    cdef _init(self, Py_ssize_t record_size, record_cmp cmp, tmp_dir, Py_ssize_t run_records):
+        self.record_size = record_size
+        self.cmp = cmp
+        self.tmp_dir = tmp_dir
+        self.run_records = max(1, run_records)
+        self.records = <char *>malloc(self.run_records * record_size)
+        if not self.records:
+            raise MemoryError()
+        self.length = 0
+        self.run_files = []
+        self.merging = False
+
+    cdef int add(self, void *record) except -1:
+        if self.length == self.run_records:
+            self._write_run()
+        memcpy(self.records + self.length * self.record_size, record, self.record_size)
+        self.length += 1
+        return 0
+
+    cdef int _write_run(self) except -1:
+        cdef int fd
+        cdef char *data = self.records
+        cdef Py_ssize_t size = self.length * self.record_size
+        cdef ssize_t n
+        f = tempfile.TemporaryFile(dir=self.tmp_dir)
+        self.run_files.append(f)
+        fd = f.fileno()
+        with nogil:
+            qsort(self.records, self.length, self.record_size, self.cmp)
+            while size > 0:
+                n = c_write(fd, data, size)
+                if n <= 0:
+                    break
+                data += n
+                size -= n
+        if size > 0:
+            raise IOError('unable to write sorted run to %s' % self.tmp_dir)
+        self.length = 0
+        return 0
+
+    cdef int finish(self) except -1:
+        """
+        Sort the remaining records and start the merge of all runs.
+        """
+        cdef Py_ssize_t i, n
+        self.merging = True
+        self.pos = 0
+        if not self.run_files:
+            with nogil:
+                qsort(self.records, self.length, self.record_size, self.cmp)
+            return 0
+        if self.length:
+            self._write_run()
+        free(self.records)
+        self.records = NULL
+        n = len(self.run_files)
+        self.runs = <sort_run *>malloc(n * sizeof(sort_run))
+        self.heap = <Py_ssize_t *>malloc(n * sizeof(Py_ssize_t))
+        if not self.runs or not self.heap:
+            raise MemoryError()
+        for i in range(n):
+            self.runs[i].buf = NULL
+        for i in range(n):
+            self.runs[i].fd = self.run_files[i].fileno()
+            c_lseek(self.runs[i].fd, 0, SEEK_SET)
+            self.runs[i].buf = <char *>malloc(JOIN_BLOCK_RECORDS * self.record_size)
+            if not self.runs[i].buf:
+                raise MemoryError()
+            self.runs[i].length = 0
+            self.runs[i].pos = 0
+            if self._fill(&self.runs[i]):
+                self.heap[self.heap_size] = i
+                self.heap_size += 1
+        for i in range(self.heap_size // 2 - 1, -1, -1):
+            self._sift_down(i)
+        return 0
+
+    cdef bint _fill(self, sort_run *run) except -1:
+        """
+        Read the next block of `run`, returns False at the end of the run.
+        """
+        cdef ssize_t n = 0
+        cdef Py_ssize_t size = 0, block_size = JOIN_BLOCK_RECORDS * self.record_size
+        with nogil:
+            while size < block_size:
+                n = c_read(run.fd, run.buf + size, block_size - size)
+                if n <= 0:
+                    break
+                size += n
+        if n < 0 or size % self.record_size:
+            raise IOError('unable to read sorted run from %s' % self.tmp_dir)
+        run.length = size // self.record_size
+        run.pos = 0
+        return run.length > 0
+
+    cdef inline char *_current(self, Py_ssize_t i) nogil:
+        return self.runs[i].buf + self.runs[i].pos * self.record_size
+
+    cdef void _sift_down(self, Py_ssize_t i) nogil:
+        cdef Py_ssize_t child, tmp
+        while True:
+            child = 2 * i + 1
+            if child >= self.heap_size:
+                break
+            if (child + 1 < self.heap_size and self.cmp(
+                    self._current(self.heap[child + 1]), self._current(self.heap[child])) < 0):
+                child += 1
+            if self.cmp(self._current(self.heap[child]), self._current(self.heap[i])) >= 0:
+                break
+            tmp = self.heap[i]
+            self.heap[i] = self.heap[child]
+            self.heap[child] = tmp
+            i = child
+
+    cdef bint next(self, void *record) except -1:
+        """
+        Copy the next record in sorted order to `record`. Returns False
+        after the last record.
+        """
+        cdef sort_run *run
+        if not self.run_files:
+            if self.pos >= self.length:
+                return False
+            memcpy(record, self.records + self.pos * self.record_size, self.record_size)
+            self.pos += 1
+            return True
+        if not self.heap_size:
+            return False
+        run = &self.runs[self.heap[0]]
+        memcpy(record, run.buf + run.pos * self.record_size, self.record_size)
+        run.pos += 1
+        if run.pos == run.length and not self._fill(run):
+            self.heap_size -= 1
+            self.heap[0] = self.heap[self.heap_size]
+        self._sift_down(0)
+        return True
+
+    cdef _free_runs(self):
+        cdef Py_ssize_t i
+        if self.runs:
+            for i in range(len(self.run_files)):
+                free(self.runs[i].buf)
+            free(self.runs)
+            self.runs = NULL
+        free(self.heap)
+        self.heap = NULL
+        self.heap_size = 0
+
+    def close(self):
+        free(self.records)
+        self.records = NULL
+        self.length = 0
+        self._free_runs()
+        if self.run_files:
+            for f in self.run_files:
+                f.close()
+            self.run_files = []
+
+cdef RecordSort _record_sort(Py_ssize_t record_size, record_cmp cmp, tmp_dir, Py_ssize_t run_records):
+    cdef RecordSort s = RecordSort()
+    s._init(record_size, cmp, tmp_dir, run_records)
+    return s
+
+cdef int _add_refs(RecordSort refs, int64_t way_id, way_refs) except -1:
+    cdef ref_record r
+    r.way_id = way_id
+    r.pos = 0
+    for ref in way_refs:
+        r.ref = ref
+        refs.add(&r)
+        r.pos += 1
+    return 0
+
+cdef int _add_packed_refs(RecordSort refs, int64_t way_id, unsigned char *data, Py_ssize_t size) except -1:
+    """
+    Add the refs of a way record with packed refs without decoding
+    the tags (see `_encode_reftag`).
+    """
+    cdef uint64_t length, count, v
+    cdef Py_ssize_t i, p = _read_varint(data, 2, size, &length)
+    cdef ref_record r
+    if p < 0 or p + <Py_ssize_t>length > size:
+        raise ValueError('invalid record')
+    p = _read_varint(data, p + length, size, &count)
+    if p < 0 or count > <uint64_t>size:
+        raise ValueError('invalid record')
+    r.way_id = way_id
+    r.ref = 0
+    for i in range(<Py_ssize_t>count):
+        p = _read_varint(data, p, size, &v)
+        if p < 0:
+            raise ValueError('invalid record')
+        r.ref += _unzigzag(v)
+        r.pos = i
+        refs.add(&r)
+    return 0
+
+cdef int _add_way_db_refs(RecordSort refs, WayDB db) except -1:
+    """
+    Add the refs of all ways of `db`, reads the records with a cursor.
+    """
+    cdef BDBCUR *cur = tcbdbcurnew(db.db)
+    cdef int size
+    cdef void *ret
+    cdef int64_t osmid
+    cdef unsigned char *data
+    try:
+        if not tcbdbcurfirst(cur):
+            return 0
+        if db._has_header and not tcbdbcurnext(cur):
+            return 0
+        while True:
+            ret = tcbdbcurkey3(cur, &size)
+            osmid = (<int64_t *>ret)[0]
+            data = <unsigned char *>tcbdbcurval3(cur, &size)
+            if size > 1 and data[0] == REFTAG_FORMAT_VERSION and not data[1] & REFS_MARSHALED:
+                _add_packed_refs(refs, osmid, data, size)
+            else:
+                way = db._decode(osmid, <char *>data, size)
+                _add_refs(refs, osmid, way.refs)
+            if not tcbdbcurnext(cur):
+                break
+    finally:
+        tcbdbcurdel(cur)
+    return 0
+
+cdef int _lookup_join_coords(coords, int64_t *ids, Py_ssize_t n, coord *out, bint *found) except -1:
+    """
+    Look up the coords of `ids` and store them with the full precision
+    of the `WayCoordsDB` in `out`.
+    """
+    cdef Py_ssize_t i
+    cdef coord value
+    cdef coord_lookup lookup
+    cdef void *ctx
+    cdef tc_coords tc_ctx
+    cdef io_stats st
+    cdef dense_coords dense_ctx
+    cdef double factor
+    cdef double *c
+    cdef signed char *m
+    st.enabled = 0
+    if isinstance(coords, CoordDB):
+        tc_ctx = (<CoordDB>coords)._lookup_ctx()
+        _init_io_stats(&st, tc_ctx.stats.enabled)
+        tc_ctx.stats = &st
+        lookup = _tc_coord_lookup
+        ctx = &tc_ctx
+        factor = (<CoordDB>coords)._factor
+    elif isinstance(coords, DenseCoordDB):
+        dense_ctx.coords = (<DenseCoordDB>coords).coords
+        dense_ctx.size = (<DenseCoordDB>coords).size
+        lookup = _dense_coord_lookup
+        ctx = &dense_ctx
+        factor = (<DenseCoordDB>coords)._factor
+    else:
+        # DeltaCoordsDB and sharded caches
+        result, offsets, missing = coords.get_ways_coords_array(
+            [(ids[i],) for i in range(n)])
+        c = (<array.array>result).data.as_doubles
+        m = (<array.array>missing).data.as_schars
+        for i in range(n):
+            found[i] = not m[i]
+            if found[i]:
+                out[i] = coord_struct(c[2*i], c[2*i+1], COORD_FACTOR)
+        return 0
+    with nogil:
+        for i in range(n):
+            found[i] = lookup(ctx, ids[i], &value)
+            if found[i]:
+                out[i] = coord_struct(_uint32_to_coord(value.x, factor),
+                    _uint32_to_coord(value.y, factor), COORD_FACTOR)
+    if st.enabled:
+        _add_io_stats(&(<CoordDB>coords)._stats, &st)
+    return 0
+
+cdef int _resolve_refs(RecordSort refs, coords, RecordSort way_refs) except -1:
+    """
+    Look up the coords of the `refs` (sorted by ref) in chunks of
+    `JOIN_LOOKUP_REFS` distinct refs and add them to `way_refs`.
+    """
+    cdef ref_record *chunk = <ref_record *>malloc(JOIN_LOOKUP_REFS * sizeof(ref_record))
+    cdef int64_t *ids = <int64_t *>malloc(JOIN_LOOKUP_REFS * sizeof(int64_t))
+    cdef coord *values = <coord *>malloc(JOIN_LOOKUP_REFS * sizeof(coord))
+    cdef bint *found = <bint *>malloc(JOIN_LOOKUP_REFS * sizeof(bint))
+    cdef Py_ssize_t i, j, n, n_ids
+    cdef bint more = True
+    cdef way_ref_record r
+    try:
+        if not chunk or not ids or not values or not found:
+            raise MemoryError()
+        while more:
+            n = n_ids = 0
+            while n < JOIN_LOOKUP_REFS:
+                more = refs.next(&chunk[n])
+                if not more:
+                    break
+                if not n_ids or ids[n_ids - 1] != chunk[n].ref:
+                    ids[n_ids] = chunk[n].ref
+                    n_ids += 1
+                n += 1
+            if not n:
+                break
+            _lookup_join_coords(coords, ids, n_ids, values, found)
+            j = 0
+            for i in range(n):
+                if chunk[i].ref != ids[j]:
+                    j += 1
+                r.way_id = chunk[i].way_id
+                if found[j]:
+                    r.pos = chunk[i].pos
+                    r.value = values[j]
+                else:
+                    r.pos = -1
+                way_refs.add(&r)
+    finally:
+        free(chunk)
+        free(ids)
+        free(values)
+        free(found)
+    return 0
+
+cdef int64_t _store_way_coords(RecordSort way_refs, WayCoordsDB way_coords) except -1:
+    """
+    Store the coords of each way from `way_refs` (sorted by way id and
+    position). Skips ways with missing coords.
+    """
+    cdef way_ref_record r
+    cdef int64_t way_id = 0, count = 0
+    cdef Py_ssize_t n = 0, capacity = 256
+    cdef bint complete = False, more = True, first = True
+    cdef coord *buf = <coord *>malloc(capacity * sizeof(coord))
+    cdef void *tmp
+    try:
+        if not buf:
+            raise MemoryError()
+        while True:
+            more = way_refs.next(&r)
+            if not more or first or r.way_id != way_id:
+                first = False
+                if complete and n:
+                    if not way_coords._put_record(way_id, <char *>buf, n * sizeof(coord)):
+                        raise IOError('unable to store coords of way %d' % way_id)
+                    count += 1
+                if not more:
+                    break
+                way_id = r.way_id
+                complete = r.pos >= 0
+                n = 0
+            if not complete or r.pos < 0:
+                complete = False
+                continue
+            if n == capacity:
+                capacity *= 2
+                tmp = realloc(buf, capacity * sizeof(coord))
+                if not tmp:
+                    raise MemoryError()
+                buf = <coord *>tmp
+            buf[n] = r.value
+            n += 1
+    finally:
+        free(buf)
+    return count
+
+def join_way_coords(ways, coords, WayCoordsDB way_coords, tmp_dir=None,
+    run_records=JOIN_RUN_RECORDS):
+    """
+    Store the coords of all `ways` (a `WayDB`, a sharded cache of
+    `WayDB` or any iterable of ways) in the `way_coords` cache. Ways
+    with missing coords are not stored. Returns the number of stored ways.
+    """
+    cdef RecordSort refs = _record_sort(sizeof(ref_record), _cmp_ref_record,
+        tmp_dir, run_records)
+    cdef RecordSort way_refs = _record_sort(sizeof(way_ref_record), _cmp_way_ref_record,
+        tmp_dir, run_records)
+    try:
+        for db in getattr(ways, 'caches', [ways]):
+            if isinstance(db, WayDB):
+                _add_way_db_refs(refs, db)
+            else:
+                for way in db:
+                    _add_refs(refs, way.osm_id, way.refs)
+        refs.finish()
+        _resolve_refs(refs, coords, way_refs)
+        refs.close()
+        way_refs.finish()
+        return _store_way_coords(way_refs, way_coords)
+    finally:
+        refs.close()
+        way_refs.close()
+
+DEF FROZEN_HEADER_SIZE = 64
+FROZEN_MAGIC = 'imposm frozen cache 1\n'
+
+# Frozen caches are immutable files with all records of a BDB:
+#
+#  - header: FROZEN_MAGIC, padded to 32 bytes, number of records and
+#    the end of the data (int64), padded to FROZEN_HEADER_SIZE
+#  - the data of all records in id order
+#  - index, aligned to 8 bytes: id and offset of the data of each
+#    record (int64), the data of a record ends at the offset of the
+#    next record or at the end of the data
+
+ctypedef struct frozen_entry:
+    int64_t osmid
+    int64_t offset
+
+def is_frozen_file(filename):
+    """
+    Return ``True`` if `filename` was written by `freeze_db`.
+    """
+    with open(filename, 'rb') as f:
+        return f.read(len(FROZEN_MAGIC)) == FROZEN_MAGIC
+
+def freeze_db(BDB db, filename):
+    """
+    Write all records of `db` into the frozen cache `filename`.
+    Returns the number of records.
+    """
+    cdef int64_t count = 0, offset = FROZEN_HEADER_SIZE
+    cdef frozen_entry index[4096]
+    cdef Py_ssize_t n = 0
+    index_filename = filename + '.index'
+    with open(filename, 'wb') as f:
+        with open(index_filename, 'w+b') as index_f:
+            f.write('\0' * FROZEN_HEADER_SIZE)
+            for osmid, data in db.iter_raw():
+                f.write(data)
+                index[n].osmid = osmid
+                index[n].offset = offset
+                offset += len(data)
+                count += 1
+                n += 1
+                if n == 4096:
+                    index_f.write(PyString_FromStringAndSize(<char *>index, n * sizeof(frozen_entry)))
+                    n = 0
+            index_f.write(PyString_FromStringAndSize(<char *>index, n * sizeof(frozen_entry)))
+            f.write('\0' * (-offset % 8))
+            index_f.seek(0)
+            shutil.copyfileobj(index_f, f, 1024 * 1024)
+        f.seek(0)
+        f.write(struct.pack('=32sqq', FROZEN_MAGIC, count, offset))
+    os.unlink(index_filename)
+    return count
+
+cdef class FrozenDB:
+    """
+    Read-only cache for files written by `freeze_db`.
+
+    The file is memory-mapped and shared with other processes by the OS
+    page cache. `get` is a binary search in the index and the iteration
+    reads the data sequentially.
+    """
+    cdef int fd
+    cdef char *map
+    cdef int64_t map_size
+    cdef frozen_entry *index
+    cdef int64_t count
+    cdef int64_t data_end
+    cdef int _opened
+    cdef object filename
+    cdef object tag_dict
+
+    def __cinit__(self, filename, mode='r', estimated_records=0, tag_dict=None):
+        self.fd = -1
+        self.map = NULL
+        self._opened = 0
+
+    def __init__(self, filename, mode='r', estimated_records=0, tag_dict=None):
+        cdef stat st
+        cdef void *m
+        cdef int64_t *header
+        cdef int64_t index_offset
+        self.filename = filename
+        self.tag_dict = tag_dict
+        if mode != 'r':
+            raise IOError('%s is a frozen cache and can not be modified' % filename)
+        self.fd = c_open(filename, O_RDONLY, 0)
+        if self.fd < 0:
+            raise IOError('unable to open %s' % filename)
+        self._opened = 1
+
+        if fstat(self.fd, &st) != 0:
+            raise IOError('unable to stat %s' % filename)
+        if st.st_size < FROZEN_HEADER_SIZE or not is_frozen_file(filename):
+            raise IOError('%s is not a frozen cache' % filename)
+        m = mmap(NULL, st.st_size, PROT_READ, MAP_SHARED, self.fd, 0)
+        if m == MAP_FAILED:
+            raise IOError('unable to mmap %s' % filename)
+        self.map = <char *>m
+        self.map_size = st.st_size
+
+        header = <int64_t *>(self.map + 32)
+        self.count = header[0]
+        self.data_end = header[1]
+        index_offset = (self.data_end + 7) // 8 * 8
+        if (self.data_end < FROZEN_HEADER_SIZE or self.count < 0
+            or index_offset + self.count * <int64_t>sizeof(frozen_entry) != self.map_size):
+            raise IOError('%s is not a valid frozen cache' % filename)
+        self.index = <frozen_entry *>(self.map + index_offset)
+
+    cdef int64_t _search(self, int64_t osmid) nogil:
+        """
+        Return the index position of `osmid` or -1.
+        """
+        cdef int64_t lo = 0, hi = self.count, mid
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.index[mid].osmid < osmid:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self.index[lo].osmid == osmid:
+            return lo
+        return -1
+
+    cdef char *_record(self, int64_t i, Py_ssize_t *size) nogil:
+        cdef int64_t end = self.data_end
+        if i + 1 < self.count:
+            end = self.index[i + 1].offset
+        size[0] = end - self.index[i].offset
+        return self.map + self.index[i].offset
+
+    cdef object _decode(self, int64_t osmid, char *data, Py_ssize_t size):
+        return PyMarshal_ReadObjectFromString(data, size)
+
+    def get(self, int64_t osmid):
+        """
+        Return object with given id.
+        Returns None if id is not stored.
+        """
+        cdef Py_ssize_t size
+        cdef char *data
+        cdef int64_t i = self._search(osmid)
+        if i < 0: return None
+        data = self._record(i, &size)
+        return self._decode(osmid, data, size)
+
+    def get_raw(self, int64_t osmid):
+        cdef Py_ssize_t size
+        cdef char *data
+        cdef int64_t i = self._search(osmid)
+        if i < 0: return None
+        data = self._record(i, &size)
+        return PyString_FromStringAndSize(data, size)
+
+    def put(self, *args):
+        return False
+
+    put_marshaled = put
+
+    def __contains__(self, int64_t osmid):
+        return self._search(osmid) >= 0
+
+    def __len__(self):
+        return self.count
+
+    def advise(self, hint):
+        """
+        Hint the access pattern of the next reads, see `BDB.advise`.
+        """
+        if not self.map:
+            return False
+        return _madvise(self.map, self.map_size, hint)
+
+    def __iter__(self):
+        """
+        Return an iterator of all objects in id order.
+        """
+        cdef int64_t i
+        cdef Py_ssize_t size
+        cdef char *data
+        for i in range(self.count):
+            data = self._record(i, &size)
+            yield self._decode(self.index[i].osmid, data, size)
+
+    def iter_ids(self, IdBitmap ids):
+        """
+        Return an iterator of all objects with an id in `ids`, in id order.
+        """
+        cdef int64_t i
+        cdef Py_ssize_t size
+        cdef char *data
+        for i in range(self.count):
+            if ids._contains(self.index[i].osmid):
+                data = self._record(i, &size)
+                yield self._decode(self.index[i].osmid, data, size)
+
+    def close(self):
+        if self.map:
+            munmap(self.map, self.map_size)
+            self.map = NULL
+            self.index = NULL
+            self.count = 0
+        if self._opened:
+            c_close(self.fd)
+            self._opened = 0
+
+    def __dealloc__(self):
+        if self.map:
+            munmap(self.map, self.map_size)
+        if self._opened:
+            c_close(self.fd)
+
+cdef class FrozenNodeDB(FrozenDB):
+    cdef object _decode(self, int64_t osmid, char *data, Py_ssize_t size):
+        return _decode_node_record(osmid, data, size, self.tag_dict)
+
+cdef class FrozenWayDB(FrozenDB):
+    cdef object _decode(self, int64_t osmid, char *data, Py_ssize_t size):
+        return _decode_way_record(osmid, data, size, self.tag_dict)
+
+cdef class FrozenRelationDB(FrozenDB):
+    cdef object _decode(self, int64_t osmid, char *data, Py_ssize_t size):
+        return _decode_relation_record(osmid, data, size, self.tag_dict)
+
+from imposm.cache.lru import LRUCache
+
+DEF DELTA_CODEC_VERSION = 1
+
+cdef inline Py_ssize_t _search_ids(int64_t *ids, Py_ssize_t length, int64_t osmid) nogil:
+    """
+    Return the index of the first id >= `osmid` in the sorted `ids`.
+    """
+    cdef Py_ssize_t lo = 0, hi = length, mid
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if ids[mid] < osmid:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+cdef class DeltaNodes:
+    """
+    Block of nodes, sorted by id.
+
+    Serialized blocks start with a version byte (DELTA_CODEC_VERSION)
+    followed by the number of nodes and the zigzag/varint encoded deltas
+    of all ids, lons and lats. Blocks without the version byte were
+    written with the ``DeltaCoords`` protobuf message by older versions.
+    """
+    cdef int64_t *ids
+    cdef uint32_t *lons
+    cdef uint32_t *lats
+    cdef Py_ssize_t length
+    cdef Py_ssize_t capacity
+    cdef public bint changed
+    cdef double factor
+
+    def __cinit__(self, data=None, double factor=COORD_FACTOR):
+        self.factor = factor
+        self.ids = NULL
+        self.lons = NULL
+        self.lats = NULL
+        self.length = 0
+        self.capacity = 0
+        self.changed = False
+
+    def __init__(self, data=None, double factor=COORD_FACTOR):
+        """
+        `factor` of the fixed-point coords, see `coord_factor`.
+        """
+        if data:
+            self.deserialize(data)
+
+    def __dealloc__(self):
+        free(self.ids)
+        free(self.lons)
+        free(self.lats)
+
+    def __len__(self):
+        return self.length
+
+    cdef _reserve(self, Py_ssize_t capacity):
+        cdef void *ids
+        cdef void *lons
+        cdef void *lats
+        if capacity <= self.capacity:
+            return
+        ids = realloc(self.ids, capacity * sizeof(int64_t))
+        if ids: self.ids = <int64_t *>ids
+        lons = realloc(self.lons, capacity * sizeof(uint32_t))
+        if lons: self.lons = <uint32_t *>lons
+        lats = realloc(self.lats, capacity * sizeof(uint32_t))
+        if lats: self.lats = <uint32_t *>lats
+        if not ids or not lons or not lats:
+            raise MemoryError()
+        self.capacity = capacity
+
+    cdef Py_ssize_t _search(self, int64_t osmid) nogil:
+        """
+        Return the index of the first node with an id >= `osmid`.
+        """
+        return _search_ids(self.ids, self.length, osmid)
+
+    def get(self, int64_t osmid):
+        cdef Py_ssize_t i = self._search(osmid)
+        if i < self.length and self.ids[i] == osmid:
+            return _uint32_to_coord(self.lons[i], self.factor), _uint32_to_coord(self.lats[i], self.factor)
+        return None
+
+    def add(self, int64_t osmid, double lon, double lat):
+        self._add(osmid, _coord_to_uint32(lon, self.factor), _coord_to_uint32(lat, self.factor))
+
+    cdef int _add(self, int64_t osmid, uint32_t lon, uint32_t lat) except -1:
+        cdef Py_ssize_t i
+        self.changed = True
+        if self.length and self.ids[self.length-1] < osmid:
+            i = self.length
+        else:
+            i = self._search(osmid)
+            if i < self.length and self.ids[i] == osmid:
+                self.lons[i] = lon
+                self.lats[i] = lat
+                return 0
+        if self.length == self.capacity:
+            self._reserve(max(8, self.capacity * 2))
+        if i < self.length:
+            memmove(&self.ids[i+1], &self.ids[i], (self.length - i) * sizeof(int64_t))
+            memmove(&self.lons[i+1], &self.lons[i], (self.length - i) * sizeof(uint32_t))
+            memmove(&self.lats[i+1], &self.lats[i], (self.length - i) * sizeof(uint32_t))
+        self.ids[i] = osmid
+        self.lons[i] = lon
+        self.lats[i] = lat
+        self.length += 1
+        return 0
+
+    cdef Py_ssize_t _add_packed(self, packed_coord *records, Py_ssize_t n, int shift) except -1:
+        """
+        Add the leading `records` that are in the same block as the first
+        record (same ``osmid >> shift``). Returns the number of added records.
+        """
+        cdef Py_ssize_t i, count = 1
+        cdef int64_t delta_id = records[0].osmid >> shift
+        while count < n and records[count].osmid >> shift == delta_id:
+            count += 1
+        if self.length + count > self.capacity:
+            self._reserve(max(8, self.length + count, self.capacity * 2))
+        for i in range(count):
+            self._add(records[i].osmid, _coord_to_uint32(records[i].x, self.factor),
+                _coord_to_uint32(records[i].y, self.factor))
+        return count
+
+    property nodes:
+        """
+        List of all ``(osmid, lon, lat)``.
+        """
+        def __get__(self):
+            cdef Py_ssize_t i
+            return [(self.ids[i], _uint32_to_coord(self.lons[i], self.factor),
+                _uint32_to_coord(self.lats[i], self.factor)) for i in range(self.length)]
+
+    def serialize(self):
+        cdef Py_ssize_t i, n = 0
+        cdef int64_t last
+        cdef unsigned char *buf = <unsigned char *>malloc(11 + self.length * 30)
+        if not buf:
+            raise MemoryError()
+        try:
+            buf[n] = DELTA_CODEC_VERSION
+            n += 1
+            n += _write_varint(buf + n, self.length)
+            last = 0
+            for i in range(self.length):
+                n += _write_varint(buf + n, _zigzag(self.ids[i] - last))
+                last = self.ids[i]
+            last = 0
+            for i in range(self.length):
+                n += _write_varint(buf + n, _zigzag(<int64_t>self.lons[i] - last))
+                last = self.lons[i]
+            last = 0
+            for i in range(self.length):
+                n += _write_varint(buf + n, _zigzag(<int64_t>self.lats[i] - last))
+                last = self.lats[i]
+            return PyString_FromStringAndSize(<char *>buf, n)
+        finally:
+            free(buf)
+
+    def deserialize(self, data):
+        cdef unsigned char *buf = data
+        cdef Py_ssize_t pos, size = len(data)
+        cdef uint64_t length
+
+        if buf[0] != DELTA_CODEC_VERSION:
+            self._deserialize_protobuf(data)
+            return
+
+        pos = _read_varint(buf, 1, size, &length)
+        if pos < 0 or length > <uint64_t>size:
+            raise ValueError('invalid delta nodes data')
+        self._reserve(length)
+        self.length = 0
+        with nogil:
+            pos = self._decode(buf, pos, size, length)
+        if pos < 0:
+            raise ValueError('invalid delta nodes data')
+        self.length = length
+
+    cdef Py_ssize_t _decode(self, unsigned char *buf, Py_ssize_t pos, Py_ssize_t size,
+        Py_ssize_t length) nogil:
+        """
+        Decode the deltas of the ids, lons and lats of `length` nodes.
+        Returns the position after the nodes or -1 for invalid data.
+        """
+        cdef Py_ssize_t i
+        cdef uint64_t v
+        cdef int64_t last = 0
+        for i in range(length):
+            pos = _read_varint(buf, pos, size, &v)
+            if pos < 0: return -1
+            last += _unzigzag(v)
+            self.ids[i] = last
+        last = 0
+        for i in range(length):
+            pos = _read_varint(buf, pos, size, &v)
+            if pos < 0: return -1
+            last += _unzigzag(v)
+            self.lons[i] = <uint32_t>last
+        last = 0
+        for i in range(length):
+            pos = _read_varint(buf, pos, size, &v)
+            if pos < 0: return -1
+            last += _unzigzag(v)
+            self.lats[i] = <uint32_t>last
+        return pos
+
+    def _deserialize_protobuf(self, data):
+        cdef Py_ssize_t i
+        cdef int64_t last_id = 0
+        cdef uint32_t last_lon = 0, last_lat = 0
+        from imposm.cache.internal import DeltaCoords
+        nodes = DeltaCoords()
+        nodes.ParseFromString(data)
+        ids, lons, lats = nodes.ids, nodes.lons, nodes.lats
+        self._reserve(len(ids))
+        for i in range(len(ids)):
+            last_id += ids[i]
+            last_lon += lons[i]
+            last_lat += lats[i]
+            self.ids[i] = last_id
+            self.lons[i] = last_lon
+            self.lats[i] = last_lat
+        self.length = len(ids)
+
+DEF SHARED_BLOCK_NODES = 64
+
+ctypedef struct shared_block:
+    # even if the slot is unchanged, odd while a process writes the slot,
+    # 0 if the slot is empty
+    int64_t seq
+    int64_t delta_id
+    int64_t length
+    int64_t base
+    # ids relative to base
+    uint8_t offsets[SHARED_BLOCK_NODES]
+    uint32_t lons[SHARED_BLOCK_NODES]
+    uint32_t lats[SHARED_BLOCK_NODES]
+
+cdef class SharedBlockCache:
+    """
+    Cache for decoded `DeltaNodes` blocks in shared memory.
+
+    The cache is created before the worker processes are forked and
+    all workers use the same slots, so each block is only decoded once
+    and the size of the cache does not depend on the number of processes.
+
+    Each block is stored in a single slot (direct-mapped) that is
+    protected by a sequence lock: writers mark the slot with an odd
+    sequence number and readers discard copies of slots that changed
+    while they were copied. Writers skip slots that are written by
+    another process, so no process ever waits for a lock.
+    """
+    cdef shared_block *blocks
+    cdef int64_t slots
+    cdef int slot_bits
+
+    def __cinit__(self, size):
+        self.blocks = NULL
+
+    def __init__(self, size):
+        """
+        `size` of the cache in MB.
+        """
+        cdef void *m
+        cdef int64_t slots = <int64_t>(size * 1024 * 1024) // sizeof(shared_block)
+        self.slot_bits = 1
+        while (<int64_t>2 << self.slot_bits) <= slots:
+            self.slot_bits += 1
+        self.slots = <int64_t>1 << self.slot_bits
+        m = mmap(NULL, self.slots * sizeof(shared_block), PROT_READ | PROT_WRITE,
+            MAP_SHARED | MAP_ANONYMOUS, -1, 0)
+        if m == MAP_FAILED:
+            raise MemoryError('unable to map %dMB shared block cache' % size)
+        self.blocks = <shared_block *>m
+
+    def __dealloc__(self):
+        self.close()
+
+    def __len__(self):
+        return self.slots
+
+    cdef shared_block *_slot(self, int64_t delta_id) nogil:
+        # fibonacci hashing, consecutive block ids are spread over all slots
+        return &self.blocks[(<uint64_t>delta_id * 11400714819323198485ULL) >> (64 - self.slot_bits)]
+
+    def get(self, int64_t delta_id, double factor=COORD_FACTOR):
+        """
+        Return a copy of the cached `DeltaNodes` for `delta_id` or None.
+        """
+        cdef shared_block *b = self._slot(delta_id)
+        cdef int64_t seq = b.seq
+        cdef Py_ssize_t i, length
+        cdef DeltaNodes nodes
+        __sync_synchronize()
+        if seq == 0 or seq & 1 or b.delta_id != delta_id:
+            return None
+        length = min(b.length, SHARED_BLOCK_NODES)
+        nodes = DeltaNodes(factor=factor)
+        nodes._reserve(max(8, length))
+        for i in range(length):
+            nodes.ids[i] = b.base + b.offsets[i]
+        memcpy(nodes.lons, b.lons, length * sizeof(uint32_t))
+        memcpy(nodes.lats, b.lats, length * sizeof(uint32_t))
+        nodes.length = length
+        __sync_synchronize()
+        if b.seq != seq:
+            return None
+        return nodes
+
+    def put(self, int64_t delta_id, DeltaNodes nodes):
+        """
+        Store a copy of `nodes`. Returns False if the block does not fit
+        into a slot or if the slot is written by another process.
+        """
+        cdef shared_block *b = self._slot(delta_id)
+        cdef int64_t seq = b.seq
+        cdef Py_ssize_t i
+        if nodes.length > SHARED_BLOCK_NODES:
+            return False
+        if nodes.length and nodes.ids[nodes.length-1] - nodes.ids[0] > 255:
+            return False
+        if seq & 1 or not __sync_bool_compare_and_swap(&b.seq, seq, seq + 1):
+            return False
+        b.delta_id = delta_id
+        b.length = nodes.length
+        b.base = nodes.ids[0] if nodes.length else 0
+        for i in range(nodes.length):
+            b.offsets[i] = <uint8_t>(nodes.ids[i] - b.base)
+        memcpy(b.lons, nodes.lons, nodes.length * sizeof(uint32_t))
+        memcpy(b.lats, nodes.lats, nodes.length * sizeof(uint32_t))
+        __sync_synchronize()
+        b.seq = seq + 2
+        return True
+
+    def close(self):
+        if self.blocks:
+            munmap(self.blocks, self.slots * sizeof(shared_block))
+            self.blocks = NULL
+
+# versions of the record formats, caches with other versions need to be read again
+CACHE_FORMAT_VERSIONS = dict(nodes=NODE_FORMAT_VERSION, ways=REFTAG_FORMAT_VERSION,
+    relations=REFTAG_FORMAT_VERSION, coords_blocks=DELTA_CODEC_VERSION,
+    tags=TAGS_FORMAT_VERSION, dense_coords=DENSE_MAGIC, frozen=FROZEN_MAGIC)
+
+# memory usage of a node in DeltaNodes and of each block (objects, LRU item)
+DEF DELTA_NODE_BYTES = 16
+DEF DELTA_BLOCK_BYTES = 256
+
+cdef class DeltaBlocksDB(BDB):
+    """
+    Stores the serialized `DeltaNodes` blocks of the `DeltaCoordsDB`.
+    """
+    cache_type = 'coords_blocks'
+
+ctypedef struct delta_block:
+    int64_t delta_id
+    int64_t *ids
+    uint32_t *lons
+    uint32_t *lats
+    Py_ssize_t length
+
+ctypedef struct delta_lookup:
+    # the DeltaCoordsDB and a list that keeps the DeltaNodes of `blocks` alive
+    void *db
+    void *nodes
+    # blocks of all refs, sorted by delta_id
+    delta_block *blocks
+    Py_ssize_t n_blocks
+    # block of the last lookup
+    Py_ssize_t last
+    int shift
+    int64_t gets
+    int64_t misses
+
+cdef int _cmp_int64(const void *a, const void *b) nogil:
+    cdef int64_t a_id = (<int64_t *>a)[0], b_id = (<int64_t *>b)[0]
+    return (a_id > b_id) - (a_id < b_id)
+
+cdef int _prepare_delta_lookup(void *ctx, int64_t *ids, Py_ssize_t n) except -1:
+    """
+    Load the blocks of all `ids` in the order of the block ids, so that
+    the B+ tree is read sequentially.
+    """
+    cdef delta_lookup *d = <delta_lookup *>ctx
+    cdef DeltaCoordsDB db = <DeltaCoordsDB>d.db
+    cdef list nodes = <list>d.nodes
+    cdef DeltaNodes node
+    cdef Py_ssize_t i, n_ids = 0
+    cdef int64_t *delta_ids = <int64_t *>malloc(n * sizeof(int64_t) + 1)
+    if not delta_ids:
+        raise MemoryError()
+    try:
+        with nogil:
+            for i in range(n):
+                delta_ids[i] = ids[i] >> d.shift
+            qsort(delta_ids, n, sizeof(int64_t), _cmp_int64)
+            for i in range(n):
+                if not n_ids or delta_ids[n_ids-1] != delta_ids[i]:
+                    delta_ids[n_ids] = delta_ids[i]
+                    n_ids += 1
+        d.blocks = <delta_block *>malloc(n_ids * sizeof(delta_block) + 1)
+        if not d.blocks:
+            raise MemoryError()
+        for i in range(n_ids):
+            node = db._block(delta_ids[i])
+            nodes.append(node)
+            d.blocks[i].delta_id = delta_ids[i]
+            d.blocks[i].ids = node.ids
+            d.blocks[i].lons = node.lons
+            d.blocks[i].lats = node.lats
+            d.blocks[i].length = node.length
+            d.n_blocks = i + 1
+    finally:
+        free(delta_ids)
+    return 0
+
+cdef bint _delta_coord_lookup(void *ctx, int64_t osmid, coord *out) nogil:
+    cdef delta_lookup *d = <delta_lookup *>ctx
+    cdef int64_t delta_id = osmid >> d.shift
+    cdef Py_ssize_t lo, hi, mid, i
+    cdef delta_block *b
+    d.gets += 1
+    if d.blocks[d.last].delta_id != delta_id:
+        # the blocks of all refs are loaded
+        lo = 0
+        hi = d.n_blocks - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if d.blocks[mid].delta_id < delta_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        d.last = lo
+    b = &d.blocks[d.last]
+    i = _search_ids(b.ids, b.length, osmid)
+    if i < b.length and b.ids[i] == osmid:
+        out.x = b.lons[i]
+        out.y = b.lats[i]
+        return 1
+    d.misses += 1
+    return 0
+
+cdef class DeltaCoordsDB:
+    """
+    Coords cache that stores blocks of ``2**delta_nodes_size`` nodes with
+    delta encoding.
+
+    Decoded blocks are kept in a LRU cache of `block_cache_size` MB
+    (defaults to ``imposm.config.imposm_coords_block_cache_size``).
+
+    The precision of the coords is stored in the header of the file,
+    coarser precisions result in smaller deltas.
+
+    In read mode, blocks that are not in the LRU cache are looked up in
+    the `SharedBlockCache` `shared_blocks` before they are decoded.
+
+    Threads of caches that are opened for reading share the block cache.
+    Its lock is only held while a block is looked up or added, the blocks
+    are read and decoded and the coords are looked up without the GIL.
+    Threads that miss the same block at once both load it.
+    """
+    cdef readonly DeltaBlocksDB db
+    cdef readonly object mode
+    cdef readonly object precision
+    cdef readonly object delta_nodes
+    cdef readonly int delta_nodes_size
+    cdef readonly object shared_blocks
+    cdef double _factor
+    cdef bint _writable
+    cdef bint _threaded
+    cdef int64_t _write_block_bytes
+    cdef bint _stats_enabled
+    cdef int64_t _gets
+    cdef int64_t _misses
+    cdef int64_t _bytes_decoded
+    cdef double _decode_time
+    cdef int64_t _prefetched
+    cdef int64_t _shared_hits
+    cdef object _lock
+
+    def __init__(self, filename, mode='w', estimated_records=0, block_cache_size=None,
+        delta_nodes_size=6, shared_blocks=None):
+        self.db = DeltaBlocksDB(filename, mode, (estimated_records or 0) >> delta_nodes_size)
+        self.mode = mode
+        self._writable = mode != 'r'
+        self._threaded = mode == 'r' and threaded_reads()
+        self.precision = _coords_precision(self.db, mode)
+        self._factor = coord_factor(self.precision)
+        if block_cache_size is None:
+            block_cache_size = imposm.config.imposm_coords_block_cache_size
+        self.delta_nodes = LRUCache(block_cache_size * 1024 * 1024,
+            on_evict=self._evict_delta_node)
+        self.delta_nodes_size = delta_nodes_size
+        # blocks are still growing in write mode, reserve the full size
+        self._write_block_bytes = (1 << delta_nodes_size) * DELTA_NODE_BYTES + DELTA_BLOCK_BYTES
+        self._stats_enabled = cache_stats.enabled()
+        self._gets = 0
+        self._misses = 0
+        self._bytes_decoded = 0
+        self._decode_time = 0.0
+        self._prefetched = 0
+        self.shared_blocks = shared_blocks if mode == 'r' else None
+        self._shared_hits = 0
+        self._lock = threading.Lock()
+    
+    def put(self, int64_t osmid, double lon, double lat):
+        if not self._writable:
+            return None
+        self._block(osmid >> self.delta_nodes_size).add(osmid, lon, lat)
+        return True
+    
+    def put_marshaled(self, int64_t osmid, double lon, double lat):
+        return self.put(osmid, lon, lat)
+
+    def put_packed(self, PackedCoords coords, Py_ssize_t stop=-1):
+        """
+        Store the first `stop` (all by default) `coords`. Adds all coords
+        of a block at once.
+        """
+        cdef Py_ssize_t i = 0
+        stop = coords._stop(stop)
+        if not self._writable:
+            return stop
+        while i < stop:
+            i += self._block(coords.records[i].osmid >> self.delta_nodes_size)._add_packed(
+                coords.records + i, stop - i, self.delta_nodes_size)
+        return stop
+    
+    def get(self, int64_t osmid):
+        value = self._block(osmid >> self.delta_nodes_size).get(osmid)
+        self._gets += 1
+        if value is None:
+            self._misses += 1
+        return value
+
+    cdef DeltaNodes _block(self, int64_t delta_id):
+        """
+        Return the block `delta_id` from the block cache or from the file.
+        """
+        cdef DeltaNodes delta_node
+        if not self._threaded:
+            delta_node = self.delta_nodes.get(delta_id)
+            if delta_node is None:
+                delta_node = self._load_block(delta_id)
+                self._cache_block(delta_id, delta_node)
+            return delta_node
+        with self._lock:
+            delta_node = self.delta_nodes.get(delta_id)
+        if delta_node is None:
+            delta_node = self._load_block(delta_id)
+            with self._lock:
+                self._cache_block(delta_id, delta_node)
+        return delta_node
+    
+    def get_coords(self, osmids):
+        coords = []
+        for osmid in osmids:
+            coord = self.get(osmid)
             if coord is None:
                 return
             coords.append(coord)
         return coords
+
+    def get_coords_array(self, refs):
+        coords, offsets, missing = self.get_ways_coords_array([refs])
+        if missing[0]:
+            return None
+        return coords
+
+    def __iter__(self):
+        """
+        Return an iterator of all ``(osmid, (x, y))`` in id order.
+        """
+        for delta_id, data in self.db.iter_raw():
+            for osmid, x, y in DeltaNodes(data=data, factor=self._factor).nodes:
+                yield osmid, (x, y)
+
+    def get_ways_coords_array(self, ways_refs):
+        """
+        Return the coords for a list of refs lists, see `_lookup_ways_coords`.
+        Loads the blocks of all refs at once and looks up the coords in
+        the decoded blocks without the GIL.
+        """
+        cdef delta_lookup ctx
+        nodes = []
+        ctx.db = <void *>self
+        ctx.nodes = <void *>nodes
+        ctx.blocks = NULL
+        ctx.n_blocks = 0
+        ctx.last = 0
+        ctx.shift = self.delta_nodes_size
+        ctx.gets = ctx.misses = 0
+        try:
+            return _lookup_ways_coords(_delta_coord_lookup, &ctx, ways_refs,
+                self._factor, _prepare_delta_lookup)
+        finally:
+            free(ctx.blocks)
+            self._gets += ctx.gets
+            self._misses += ctx.misses
+
+    def prefetch(self, refs):
+        """
+        Load the blocks of all `refs` into the block cache in the order
+        of the block ids, so that the B+ tree is read sequentially.
+        Loads only as many blocks as fit into half of the block cache.
+        """
+        cdef int delta_nodes_size = self.delta_nodes_size
+        delta_nodes = self.delta_nodes
+        budget = delta_nodes.max_bytes // 2
+        start_bytes = delta_nodes.bytes
+        for delta_id in sorted(set([ref >> delta_nodes_size for ref in refs])):
+            with self._lock:
+                if delta_id in delta_nodes:
+                    continue
+            self.fetch_delta_node(delta_id)
+            self._prefetched += 1
+            if delta_nodes.bytes - start_bytes > budget:
+                break
+
+    def advise(self, hint):
+        """
+        Hint the access pattern of the next reads, see `BDB.advise`.
+        """
+        return self.db.advise(hint)
+
+    def stats(self):
+        """
+        Return hits, misses and evictions of the block cache.
+        """
+        return self.delta_nodes.stats()
     
+    def io_stats(self):
+        """
+        Return the counters of the coords and of the block cache,
+        see `imposm.cache.stats`. `gets` and `misses` count the coords
+        that were looked up, the block counters include the blocks that
+        `put` loads.
+        """
+        stats = self.stats()
+        return dict(gets=self._gets, misses=self._misses, block_hits=stats['hits'],
+            block_misses=stats['misses'], block_evictions=stats['evictions'],
+            block_prefetches=self._prefetched, shared_block_hits=self._shared_hits,
+            bytes_decoded=self._bytes_decoded, decode_time=self._decode_time)
+
     def close(self):
-        for node_id, node in self.delta_nodes.iteritems():
-            self._put(node_id, node)
-        self.delta_nodes = {}
-        self.delta_node_ids = deque()
+        stats = self.stats()
+        log.debug('coords block cache: %d hits, %d misses, %d evictions (%.1fMB)',
+            stats['hits'], stats['misses'], stats['evictions'],
+            self.delta_nodes.max_bytes / 1024.0 / 1024.0)
+        if self._stats_enabled:
+            cache_stats.record('coords', self.io_stats())
+        # writes all changed blocks
+        self.delta_nodes.clear()
         self.db.close()
     
     def _put(self, delta_id, delta_node):
         data = delta_node.serialize()
         self.db.put_marshaled(delta_id, data)
     
-    def _get(self, delta_id):
-        return DeltaNodes(data=self.db.get_raw(delta_id))
+    cdef DeltaNodes _get(self, int64_t delta_id):
+        cdef double start
+        data = self.db.get_raw(delta_id)
+        if not self._stats_enabled or data is None:
+            return DeltaNodes(data=data, factor=self._factor)
+        start = _now()
+        delta_node = DeltaNodes(data=data, factor=self._factor)
+        self._decode_time += _now() - start
+        self._bytes_decoded += len(data)
+        return delta_node
+
+    def _evict_delta_node(self, delta_id, delta_node):
+        if delta_node.changed:
+            self._put(delta_id, delta_node)
     
-    def fetch_delta_node(self, delta_id):
-        if len(self.delta_node_ids) >= self.delta_nodes_cache_size:
-            rm_id = self.delta_node_ids.popleft()
-            rm_node = self.delta_nodes.pop(rm_id)
-            if rm_node.changed:
-                self._put(rm_id, rm_node)
-        new_node = self._get(delta_id)
-        if new_node is None:
-            new_node = DeltaNodes()
-        self.delta_nodes[delta_id] = new_node
-        self.delta_node_ids.append(delta_id)
+    def fetch_delta_node(self, int64_t delta_id):
+        """
+        Load the block `delta_id` into the block cache and return it.
+        """
+        cdef DeltaNodes delta_node = self._load_block(delta_id)
+        with self._lock:
+            self._cache_block(delta_id, delta_node)
+        return delta_node
 
+    cdef DeltaNodes _load_block(self, int64_t delta_id):
+        """
+        Return the block `delta_id` from the shared block cache or from
+        the file, without the block cache.
+        """
+        cdef DeltaNodes delta_node
+        if self.shared_blocks is not None:
+            delta_node = self.shared_blocks.get(delta_id, self._factor)
+            if delta_node is None:
+                delta_node = self._get(delta_id)
+                self.shared_blocks.put(delta_id, delta_node)
+            else:
+                self._shared_hits += 1
+        else:
+            delta_node = self._get(delta_id)
+        return delta_node
+
+    cdef _cache_block(self, int64_t delta_id, DeltaNodes delta_node):
+        """
+        Add `delta_node` to the block cache. Threads need to hold the lock.
+        """
+        if not self._writable:
+            size = delta_node.length * DELTA_NODE_BYTES + DELTA_BLOCK_BYTES
+        else:
+            size = self._write_block_bytes
+        self.delta_nodes.put(delta_id, delta_node, size)
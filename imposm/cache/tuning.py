@@ -0,0 +1,189 @@
+# Copyright 2011 Omniscale (http://omniscale.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Tuning parameters for the Tokyo Cabinet B+ tree caches.
+
+The parameters are derived from the (estimated) size of the records of
+each cache type, the number of records and the memory that is available
+for the leaf/non-leaf node caches of each process.
+All values can be overwritten with ``imposm.config.imposm_cache_tuning``.
+"""
+
+from __future__ import with_statement
+
+import os
+import multiprocessing
+
+import imposm.config
+
+# (average record size with key in bytes, share of the cache memory of
+# a process, compression) for each cache type, the shares of all cache
+# types that are open at the same time sum to 1 (see `total_share`)
+CACHE_TYPES = {
+    'coords': (16, 0.4, 'deflate'),
+    # blocks of the DeltaCoordsDB, already delta encoded
+    'coords_blocks': (600, 0.3, None),
+    'nodes': (48, 0.1, 'deflate'),
+    'ways': (64, 0.2, 'deflate'),
+    'relations': (160, 0.1, 'deflate'),
+    # coords of all refs of a way, see imposm.cache.tc.join_way_coords
+    'way_coords': (96, 0.2, None),
+}
+DEFAULT_CACHE_TYPE = (64, 0.1, 'deflate')
+
+# cache types that store the same data, only one of them is used
+ALTERNATIVE_CACHE_TYPES = [('coords', 'coords_blocks')]
+
+# uncompressed size of a leaf page
+LEAF_PAGE_BYTES = 8192
+# memory overhead of each cached record and non-leaf index entry
+RECORD_OVERHEAD_BYTES = 32
+NODE_ENTRY_BYTES = 32
+
+PROFILE_KEYS = ('lmemb', 'nmemb', 'bnum', 'apow', 'fpow', 'lcnum', 'ncnum', 'compress')
+
+def _clamp(value, min_value, max_value):
+    return max(min_value, min(max_value, value))
+
+def _power_of_two(value):
+    """
+    >>> _power_of_two(1), _power_of_two(200), _power_of_two(256)
+    (1, 128, 256)
+    """
+    result = 1
+    while result * 2 <= value:
+        result *= 2
+    return result
+
+_available_memory = None
+
+def available_memory():
+    """
+    Return the available memory in bytes. Only checked once for each
+    process, so that all caches use the same value.
+    """
+    global _available_memory
+    if _available_memory is None:
+        _available_memory = _read_available_memory()
+    return _available_memory
+
+def _read_available_memory():
+    try:
+        meminfo = {}
+        with open('/proc/meminfo') as f:
+            for line in f:
+                key, value = line.split(':', 1)
+                meminfo[key] = int(value.split()[0]) * 1024
+        if 'MemAvailable' in meminfo:
+            return meminfo['MemAvailable']
+        return meminfo['MemFree'] + meminfo.get('Cached', 0)
+    except (IOError, ValueError, KeyError):
+        pass
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return 1024 * 1024 * 1024
+
+def cache_memory():
+    """
+    Return the memory for the caches of all processes in bytes.
+    """
+    if imposm.config.imposm_cache_memory:
+        return imposm.config.imposm_cache_memory * 1024 * 1024
+    return available_memory() // 4
+
+def cache_processes():
+    if imposm.config.imposm_cache_processes:
+        return imposm.config.imposm_cache_processes
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 2
+
+def total_share():
+    """
+    Return the sum of the shares of all cache types that can be open at
+    the same time.
+
+    >>> round(total_share(), 6)
+    1.0
+    """
+    shares = dict((cache_type, share) for cache_type, (_, share, _)
+        in CACHE_TYPES.iteritems())
+    for cache_types in ALTERNATIVE_CACHE_TYPES:
+        share = max(shares.pop(cache_type) for cache_type in cache_types)
+        shares[cache_types] = share
+    return sum(shares.values())
+
+def memory_share(cache_type):
+    """
+    Return the share of the cache memory for `cache_type`. The shares
+    are scaled down if they sum to more than 1.
+
+    >>> memory_share('coords'), memory_share('nodes')
+    (0.4, 0.1)
+    """
+    share = CACHE_TYPES.get(cache_type, DEFAULT_CACHE_TYPE)[1]
+    return share / max(1.0, round(total_share(), 6))
+
+def tuning_profile(cache_type, estimated_records=None, memory=None, processes=None):
+    """
+    Return the tuning parameters for a cache as a dict with `PROFILE_KEYS`.
+
+    `memory` (in bytes) is shared by all `processes`, defaults to
+    `cache_memory` and `cache_processes`.
+
+    >>> p = tuning_profile('coords', 1000000, memory=512*1024*1024, processes=4)
+    >>> p['lmemb'], p['bnum'], p['lcnum'], p['ncnum'], p['compress']
+    (512, 5859, 1966, 655, 'deflate')
+    """
+    record_bytes, _, compress = CACHE_TYPES.get(cache_type, DEFAULT_CACHE_TYPE)
+    if imposm.config.imposm_memory_cache:
+        # no I/O to save, compression only costs CPU time
+        compress = None
+    if memory is None:
+        memory = cache_memory()
+    if processes is None:
+        processes = cache_processes()
+
+    lmemb = _clamp(_power_of_two(LEAF_PAGE_BYTES // record_bytes), 64, 1024)
+    nmemb = 256
+    if estimated_records:
+        # leaves are only half full after a split
+        bnum = _clamp(estimated_records * 3 // lmemb, 1024, 2**31 - 1)
+    else:
+        bnum = -1
+
+    budget = memory * memory_share(cache_type) / processes
+    leaf_bytes = lmemb * (record_bytes + RECORD_OVERHEAD_BYTES)
+    lcnum = _clamp(int(budget * 0.9 // leaf_bytes), 256, 2**18)
+    ncnum = _clamp(int(budget * 0.1 // (nmemb * NODE_ENTRY_BYTES)), 512, 2**16)
+
+    profile = dict(lmemb=lmemb, nmemb=nmemb, bnum=bnum, apow=5, fpow=13,
+        lcnum=lcnum, ncnum=ncnum, compress=compress)
+    overrides = imposm.config.imposm_cache_tuning.get(cache_type, {})
+    for key in overrides:
+        if key not in profile:
+            raise ValueError('unknown tuning parameter %r for %s cache' % (key, cache_type))
+    profile.update(overrides)
+    return profile
+
+def describe_profile(profile):
+    """
+    >>> describe_profile(dict(lmemb=128, nmemb=256, bnum=-1, apow=5, fpow=13,
+    ...     lcnum=1024, ncnum=512, compress=None))
+    'lmemb=128 nmemb=256 bnum=-1 apow=5 fpow=13 lcnum=1024 ncnum=512 compress=None'
+    """
+    return ' '.join('%s=%s' % (key, profile[key]) for key in PROFILE_KEYS)
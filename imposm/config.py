@@ -34,4 +34,73 @@ imposm_pg_serial_id = True
 
 # cache coords in a compact storage (with delta encoding)
 # use this when memory is limited (default)
-imposm_compact_coords_cache = True
\ No newline at end of file
+imposm_compact_coords_cache = True
+
+# size of the cache for decoded coords blocks of the compact coords cache
+# in MB. each reader/writer process uses its own cache
+imposm_coords_block_cache_size = 16
+
+# size of the cache for decoded coords blocks in MB that is shared by all
+# writer processes (in addition to imposm_coords_block_cache_size).
+# 0 disables the shared cache
+imposm_coords_shared_cache_size = 0
+
+# cache coords in a memory-mapped file that is indexed by the node id
+# (without delta encoding or compression). the file size depends on the
+# highest node id, use this for large (planet) imports.
+# overrides imposm_compact_coords_cache
+imposm_dense_coords_cache = False
+
+# precision of the cached coords in degrees, or 'osm' (1e-7) or 'render' (1e-6).
+# coarser precisions result in a smaller coords cache. uses the full 32bit
+# precision (about 8.4e-8 degrees) if None. stored in new caches only
+imposm_coords_precision = None
+
+# number of files for each of the coords/nodes/ways/relations caches.
+# each file is written by its own process while reading, use more
+# shards if the cache writers are slower than the parser processes.
+# existing caches keep their number of shards, 1 for new caches if None
+imposm_cache_shards = None
+
+# number of threads of each way/relation writer process (same as
+# --write-threads). the threads share the caches of their process and look
+# up the coords without the GIL, use more threads and less processes
+# (--concurrency) to reduce the memory of the writer
+imposm_write_threads = 1
+
+# memory for the leaf/node caches of all Tokyo Cabinet caches in MB,
+# shared by all processes. uses 1/4 of the available memory if None
+imposm_cache_memory = None
+
+# number of processes that share the imposm_cache_memory,
+# the number of CPUs if None
+imposm_cache_processes = None
+
+# overwrite the tuning parameters of each cache type (see
+# imposm/cache/tuning.py), e.g. {'coords': {'lcnum': 4096, 'compress': None}}
+imposm_cache_tuning = {}
+
+# keep all caches in shared memory (imposm_memory_cache_path, a tmpfs)
+# instead of the --cache-dir and store them without compression.
+# for imports that fit into the RAM (same as --memory-cache)
+imposm_memory_cache = False
+imposm_memory_cache_path = '/dev/shm'
+
+# join the ways with the coords of their refs after reading (same as
+# --join-way-coords). the writer reads the coords of each way with a single
+# lookup instead of one lookup for each ref, see join_way_coords in
+# imposm/cache/tc.pyx
+imposm_join_way_coords = False
+
+# rewrite the caches in key order after reading (same as --compact-cache),
+# speeds up the sequential scans of the writer after --merge-cache
+imposm_compact_cache = False
+
+# collect gets/puts/misses, bytes and timings of all caches and print
+# them at the end of each phase (see imposm/cache/stats.py)
+imposm_cache_stats = False
+
+# sample the depths and blocked put/get times of the queues between the
+# stages of the read and write pipelines and print them at the end of
+# each phase (see imposm/pipeline.py)
+imposm_pipeline_stats = False
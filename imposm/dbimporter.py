@@ -12,14 +12,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import sys
 from collections import defaultdict
 from multiprocessing import Process
 
 import threading
 from Queue import Queue
 
+import imposm.config
+from imposm import pipeline
 from imposm.base import OSMElem
-from imposm.geom import IncompletePolygonError
+from imposm.geom import IncompletePolygonError, flat_coords
 from imposm.mapping import DropElem, PolygonTable
 from imposm.multipolygon import RelationBuilder
 from imposm.util import setproctitle
@@ -41,7 +44,7 @@ class ImporterProcess(Process):
         self.osm_cache = osm_cache
         self.db = db
         self.dry_run = dry_run
-        self.db_queue = Queue(256)
+        self.db_queue = pipeline.instrument(Queue(256), '%s db' % self.name, 256)
 
     def run(self):
         self.setup()
@@ -50,6 +53,7 @@ class ImporterProcess(Process):
         self.teardown()
 
     def setup(self):
+        self.sampler = pipeline.start_sampler([self.db_queue])
         self.db_importer = threading.Thread(target=self.db_importer,
             args=(self.db_queue, self.db),
             kwargs=dict(dry_run=self.dry_run))
@@ -58,10 +62,61 @@ class ImporterProcess(Process):
     def doit(self):
         pass
 
+    def process_batches(self, handle):
+        """
+        Call `handle` for each batch of elements from the `in_queue`.
+        Uses ``imposm.config.imposm_write_threads`` threads that share
+        the opened caches of this process. Stops after the first
+        exception of `handle` and raises it.
+        """
+        n_threads = imposm.config.imposm_write_threads or 1
+        if n_threads <= 1:
+            while True:
+                batch = self.in_queue.get()
+                if batch is None:
+                    break
+                handle(batch)
+            return
+
+        batches = Queue(n_threads * 2)
+        errors = []
+        def worker():
+            while True:
+                batch = batches.get()
+                if batch is None:
+                    break
+                if errors:
+                    # drop the remaining batches after an error, but keep
+                    # consuming so that the main thread does not block
+                    continue
+                try:
+                    handle(batch)
+                except Exception:
+                    errors.append(sys.exc_info())
+        threads = [threading.Thread(target=worker) for _ in xrange(n_threads)]
+        for t in threads:
+            t.start()
+        while not errors:
+            batch = self.in_queue.get()
+            if batch is None:
+                break
+            batches.put(batch)
+        for t in threads:
+            batches.put(None)
+        for t in threads:
+            t.join()
+        if errors:
+            # same exception as without threads
+            exc_type, exc_value, exc_tb = errors[0]
+            raise exc_type, exc_value, exc_tb
+
     def teardown(self):
         self.osm_cache.close_all()
+        self.osm_cache.dump_stats()
         self.db_queue.put(None)
         self.db_importer.join()
+        if self.sampler:
+            self.sampler.stop()
 
 class TupleBasedImporter(ImporterProcess):
     def db_importer(self, queue, db, dry_run=False):
@@ -209,45 +264,43 @@ class WayProcess(ImporterProcess):
 
     def doit(self):
         coords_cache = self.osm_cache.coords_cache(mode='r')
-        inserted_ways_cache = self.osm_cache.inserted_ways_cache(mode='r')
-        inserted_ways = iter(inserted_ways_cache)
-
-        try:
-            skip_id = inserted_ways.next()
-        except StopIteration:
-            skip_id = 2**64
-
-        while True:
-            ways = self.in_queue.get()
-            if ways is None:
-                break
+        way_coords_cache = self.osm_cache.way_coords_cache(mode='r')
+        inserted_ways = self.osm_cache.inserted_ways_cache(mode='r')
 
+        def handle(ways):
+            candidates = []
             for way in ways:
-                # forward to the next skip id that is not smaller
-                # than our current id
-                while skip_id < way.osm_id:
-                    try:
-                        skip_id = inserted_ways.next()
-                    except StopIteration:
-                        skip_id = 2**64
-
                 mappings = self.mapper.for_ways(way.tags)
                 if not mappings:
                     continue
 
-                if skip_id == way.osm_id:
+                if way.osm_id in inserted_ways:
                     # skip polygon mappings, way was already inserted as MultiPolygon
                     mappings = filter_out_polygon_mappings(mappings)
                     if not mappings:
                         continue
 
-                coords = coords_cache.get_coords(way.refs)
+                candidates.append((way, mappings))
+
+            if not candidates:
+                return
 
-                if not coords:
+            # resolve coords of all ways in one batch
+            if way_coords_cache is not None:
+                coords, offsets, missing = way_coords_cache.get_ways_coords_array(
+                    [way.osm_id for way, _ in candidates])
+            else:
+                coords, offsets, missing = coords_cache.get_ways_coords_array(
+                    [way.refs for way, _ in candidates])
+
+            for i, (way, mappings) in enumerate(candidates):
+                if missing[i] or offsets[i] == offsets[i+1]:
                     log.debug('missing coords for way %s', way.osm_id)
                     continue
 
-                self.insert(mappings, way.osm_id, coords, way.tags)
+                self.insert(mappings, way.osm_id, flat_coords(coords, offsets, i), way.tags)
+
+        self.process_batches(handle)
 
 class WayProcessDict(WayProcess, DictBasedImporter):
     pass
@@ -265,14 +318,13 @@ class RelationProcess(ImporterProcess):
     def doit(self):
         coords_cache = self.osm_cache.coords_cache(mode='r')
         ways_cache = self.osm_cache.ways_cache(mode='r')
+        way_coords_cache = self.osm_cache.way_coords_cache(mode='r')
 
-        while True:
-            relations = self.in_queue.get()
-            if relations is None:
-                break
-
+        def handle(relations):
+            inserted_ways = []
             for relation in relations:
-                builder = RelationBuilder(relation, ways_cache, coords_cache)
+                builder = RelationBuilder(relation, ways_cache, coords_cache,
+                    way_coords_cache=way_coords_cache)
                 try:
                     builder.build()
                 except IncompletePolygonError, ex:
@@ -287,7 +339,11 @@ class RelationProcess(ImporterProcess):
                 if inserted and any(m.skip_inserted_ways for _, ms in mappings for m in ms):
                     for w in relation.ways:
                         if mappings_intersect(mappings, self.mapper.for_relations(w.tags)):
-                            self.inserted_way_queue.put(w.osm_id)
+                            inserted_ways.append(w.osm_id)
+            if inserted_ways:
+                self.inserted_way_queue.put(inserted_ways)
+
+        self.process_batches(handle)
 
 
 def mappings_intersect(a, b):
@@ -45,6 +45,20 @@ from imposm.mapping import (
 # # cache coords in a compact storage (with delta encoding)
 # # use this when memory is limited (default)
 # imposm.config.imposm_compact_coords_cache = True
+#
+# # cache size for decoded coords blocks of the compact coords cache
+# # in MB (for each process)
+# imposm.config.imposm_coords_block_cache_size = 16
+#
+# # cache size for decoded coords blocks in MB that is shared by
+# # all writer processes (0 to disable)
+# imposm.config.imposm_coords_shared_cache_size = 512
+#
+# # precision of the cached coords in degrees ('osm' is 1e-7)
+# imposm.config.imposm_coords_precision = 'osm'
+#
+# # overwrite the Tokyo Cabinet tuning of a cache type
+# imposm.config.imposm_cache_tuning = {'ways': {'lcnum': 8192}}
 
 # set_default_name_type(LocalizedName(['name:en', 'int_name', 'name']))
 
@@ -17,6 +17,8 @@ from __future__ import division
 import math
 import codecs
 import os
+import sys
+from array import array
 import shapely.geometry
 import shapely.geos
 import shapely.prepared
@@ -73,6 +75,63 @@ def validate_and_simplify(geom, meter_units=False):
                                        orig_geom)
     return geom
 
+class FlatCoords(object):
+    """
+    Sequence of (x, y) tuples backed by a flat double array
+    (x0, y0, x1, y1, ...), as returned by the ``get_ways_coords_array``
+    method of the coords caches.
+
+    Exposes the array interface, so that Shapely can build geometries
+    directly from the buffer without creating a tuple for each coordinate.
+    """
+    __slots__ = ('data', )
+
+    _typestr = ('<' if sys.byteorder == 'little' else '>') + 'f8'
+
+    def __init__(self, data):
+        self.data = data
+
+    @property
+    def __array_interface__(self):
+        return {
+            'version': 3,
+            'shape': (len(self), 2),
+            'typestr': self._typestr,
+            'data': (self.data.buffer_info()[0], False),
+        }
+
+    def __len__(self):
+        return len(self.data) // 2
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            if step == 1:
+                return FlatCoords(self.data[start*2:stop*2])
+            data = array('d')
+            for i in xrange(start, stop, step):
+                data.extend(self.data[i*2:i*2+2])
+            return FlatCoords(data)
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('coordinate index out of range')
+        return self.data[idx*2], self.data[idx*2+1]
+
+    def __iter__(self):
+        data = self.data
+        for i in xrange(0, len(data), 2):
+            yield data[i], data[i+1]
+
+    def __repr__(self):
+        return 'FlatCoords(%r)' % (list(self), )
+
+def flat_coords(coords, offsets, i):
+    """
+    Return `FlatCoords` of way `i` from the result of ``get_ways_coords_array``.
+    """
+    return FlatCoords(coords[offsets[i]*2:offsets[i+1]*2])
+
 class GeomBuilder(object):
     def build(self, osm_elem):
         # TODO is this method still in use?
@@ -15,6 +15,7 @@
 
 from __future__ import division
 import math
+import hashlib
 import imposm.geom
 
 ANY = '__any__'
@@ -217,6 +218,29 @@ class TagMapper(object):
     def for_relations(self, tags):
         return self._mapping_for_tags(self.polygon_mappings, tags)
 
+    def tag_strings(self):
+        """
+        Return all keys and values of the tag filters. These are the
+        most frequent strings in the tags of the cached elements.
+        """
+        strings = set(['type', 'multipolygon', 'boundary', 'land_area'])
+        for tags in (self.point_tags, self.line_tags, self.polygon_tags):
+            for key, values in tags.iteritems():
+                strings.add(key)
+                strings.update(values)
+        strings.discard(ANY)
+        return sorted(strings)
+
+    def tag_filter_hash(self):
+        """
+        Return a hash of all keys and values of the tag filters.
+        Caches that were read with the same hash contain the same tags.
+        """
+        h = hashlib.sha1()
+        for tags in (self.point_tags, self.line_tags, self.polygon_tags):
+            h.update(repr(sorted((key, sorted(values)) for key, values in tags.iteritems())))
+        return h.hexdigest()
+
     def _tag_filter(self, filter_tags):
         def filter(tags):
             for k in tags.keys():
@@ -12,20 +12,124 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import difflib
+from bisect import bisect_left
+
+def _longest_match(a, b, b_index, alo, ahi, blo, bhi):
+    """
+    Return the longest run ``(i, j, n)`` with ``a[i:i+n] == b[j:j+n]``
+    in ``a[alo:ahi]`` and ``b[blo:bhi]``, the earliest run if there are
+    multiple runs with the same length.
+
+    Each ref of `a` is anchored at its positions in `b` (from `b_index`)
+    and the run is extended from there. Refs that are only once in `b`
+    can only continue the current run, so the refs within a run are
+    skipped and each ref of `a` is visited once if the refs are unique.
+    """
+    best_i, best_j, best_n = alo, blo, 0
+    i = alo
+    while i < ahi:
+        positions = b_index.get(a[i])
+        if not positions:
+            i += 1
+            continue
+        run_n = 1
+        for k in xrange(bisect_left(positions, blo), len(positions)):
+            j = positions[k]
+            if j >= bhi:
+                break
+            n = 1
+            while i + n < ahi and j + n < bhi and a[i+n] == b[j+n]:
+                n += 1
+            if n > best_n:
+                best_i, best_j, best_n = i, j, n
+            run_n = n
+        if len(positions) == 1:
+            i += run_n
+        else:
+            i += 1
+    return best_i, best_j, best_n
+
+def matching_blocks(a, b):
+    """
+    Return the runs ``(i, j, n)`` of refs that are in `a` and `b` in
+    the same order. Like ``difflib.SequenceMatcher.get_matching_blocks``,
+    but each level of the recursion only needs a single pass over the
+    refs, instead of a pass for each ref of `a`.
+
+    >>> matching_blocks([1, 2, 3, 4], [3, 4, 5])
+    [(2, 0, 2)]
+    >>> matching_blocks([1, 2, 3, 4, 5], [0, 2, 3, 7, 5])
+    [(1, 1, 2), (4, 4, 1)]
+    >>> matching_blocks([1, 2], [3, 4])
+    []
+    """
+    b_index = {}
+    for j, ref in enumerate(b):
+        b_index.setdefault(ref, []).append(j)
+
+    blocks = []
+    queue = [(0, len(a), 0, len(b))]
+    while queue:
+        alo, ahi, blo, bhi = queue.pop()
+        i, j, n = _longest_match(a, b, b_index, alo, ahi, blo, bhi)
+        if n:
+            blocks.append((i, j, n))
+            if alo < i and blo < j:
+                queue.append((alo, i, blo, j))
+            if i + n < ahi and j + n < bhi:
+                queue.append((i + n, ahi, j + n, bhi))
+    blocks.sort()
+    return blocks
+
+def _overlap(a, b):
+    """
+    Return `a` extended with `b` if `b` starts with the end of `a` (or if
+    `b` is part of `a`) and all other refs are different, else None.
+
+    This is the common case for parts of a way from neighbouring extracts
+    and it only needs list and set operations that run in C.
+    """
+    try:
+        i = a.index(b[0])
+    except (IndexError, ValueError):
+        return None
+    n = min(len(a) - i, len(b))
+    if a[i:i+n] != b[:n]:
+        return None
+    if n == len(b):
+        return list(a)
+    if not set(a[:i]).isdisjoint(b):
+        return None
+    return a + b[n:]
 
 def merge(a, b):
-    sqm = difflib.SequenceMatcher(None, a, b)
-    matching_blocks = sqm.get_matching_blocks()
-    matching_blocks.pop(-1)
-    
-    if not matching_blocks:
+    """
+    Merge the refs of two parts of a way (e.g. from different extracts).
+    Returns None if `a` and `b` have no common refs.
+
+    >>> merge([1, 2, 3], [3, 4])
+    [1, 2, 3, 4]
+    >>> merge([3, 4, 5], [1, 2, 3, 4])
+    [1, 2, 3, 4, 5]
+    >>> merge([1, 2, 3, 4, 5], [0, 2, 3, 7, 5])
+    [1, 0, 2, 3, 4, 7, 5]
+    >>> merge([1, 2], [3, 4]) is None
+    True
+    """
+    result = _overlap(a, b)
+    if result is None:
+        result = _overlap(b, a)
+    if result is not None:
+        return result
+
+    blocks = matching_blocks(a, b)
+    if not blocks:
         return None
-    
+
     a_idx = b_idx = 0
     result = []
 
-    for block in matching_blocks:
+    for block in blocks:
         if a_idx < block[0]:
             result.extend(a[a_idx:block[0]])
         if b_idx < block[1]:
@@ -43,23 +147,62 @@ def merge(a, b):
 
 
 def multimerge(candidates, merge_func=merge):
+    """
+    Merge all `candidates` (lists of refs) with `merge_func`, which
+    needs to return None for candidates without common refs.
+    Returns the remaining candidates if not all could be merged.
+
+    >>> multimerge([[5, 6, 7], [1, 2, 3], [3, 4, 5]])
+    [1, 2, 3, 4, 5, 6, 7]
+    >>> multimerge([[1, 2], [3, 4]])
+    [[1, 2], [3, 4]]
+    """
     candidates = list(candidates)
+    ref_sets = [set(c) for c in candidates]
     while len(candidates) > 1:
-        a, b, res = multimerge_(candidates, merge_func)
+        ia, ib, res = multimerge_(candidates, ref_sets, merge_func)
         if res is None:
             return candidates
-        candidates.remove(b)
+        a = candidates[ia]
+        del candidates[ib]
+        del ref_sets[ib]
+        if ib < ia:
+            ia -= 1
         if a is not res:
-            candidates.remove(a)
+            del candidates[ia]
+            del ref_sets[ia]
             candidates.append(res)
-        # else: in place merge
+            ref_sets.append(set(res))
+        else:
+            # in place merge
+            ref_sets[ia] = set(res)
     return candidates[0]
 
-def multimerge_(candidates, merge_func):
-    for a, b in permutations(candidates, 2):
-        res = merge_func(a, b)
-        if res is not None:
-            return a, b, res
+def multimerge_(candidates, ref_sets, merge_func):
+    """
+    Return the indices of the first pair of `candidates` that can be
+    merged and the merged refs.
+
+    Parts of a way from neighbouring extracts share an endpoint, these
+    pairs are tried first. All other pairs with common refs (`ref_sets`)
+    are only tried if none of these pairs can be merged.
+    """
+    def shares_endpoint(ia, ib):
+        a, b = candidates[ia], candidates[ib]
+        return bool(a and b) and (a[0] in ref_sets[ib] or a[-1] in ref_sets[ib]
+            or b[0] in ref_sets[ia] or b[-1] in ref_sets[ia])
+
+    pairs = list(permutations(range(len(candidates)), 2))
+    for ia, ib in pairs:
+        if shares_endpoint(ia, ib):
+            res = merge_func(candidates[ia], candidates[ib])
+            if res is not None:
+                return ia, ib, res
+    for ia, ib in pairs:
+        if not shares_endpoint(ia, ib) and not ref_sets[ia].isdisjoint(ref_sets[ib]):
+            res = merge_func(candidates[ia], candidates[ib])
+            if res is not None:
+                return ia, ib, res
     return None, None, None
 
 
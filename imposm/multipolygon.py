@@ -21,6 +21,7 @@ from imposm.geom import (
     LineStringBuilder,
     InvalidGeometryError,
     IncompletePolygonError,
+    flat_coords,
 )
 from imposm.merge import merge
 
@@ -45,12 +46,13 @@ def RelationBuilder(*args, **kw):
 
 class RelationBuilderBase(object):
     validate_rings = True
-    def __init__(self, relation, ways_cache, coords_cache):
+    def __init__(self, relation, ways_cache, coords_cache, way_coords_cache=None):
         self.relation = relation
         self.polygon_builder = PolygonBuilder()
         self.linestring_builder = LineStringBuilder()
         self.ways_cache = ways_cache
         self.coords_cache = coords_cache
+        self.way_coords_cache = way_coords_cache
 
     def fetch_ways(self):
         ways = []
@@ -69,13 +71,32 @@ class RelationBuilderBase(object):
                        member[0], self.relation.osm_id)
                 raise IncompletePolygonError()
 
-            way.coords = self.fetch_way_coords(way)
-            if way.coords is None:
+            ways.append(way)
+        return self.fetch_ways_coords(ways)
+
+    def fetch_ways_coords(self, ways):
+        """
+        Fetch the coordinates of all ways in one batch. Returns all ways
+        with complete coordinates.
+        """
+        if self.way_coords_cache is not None:
+            coords, offsets, missing = self.way_coords_cache.get_ways_coords_array(
+                [way.osm_id for way in ways])
+        else:
+            coords, offsets, missing = self.coords_cache.get_ways_coords_array(
+                [way.refs for way in ways])
+        result = []
+        for i, way in enumerate(ways):
+            if missing[i]:
+                log.debug('missing coord from way %s in relation %s',
+                    way.osm_id, self.relation.osm_id)
                 if not imposm.config.import_partial_relations:
                     raise IncompletePolygonError()
-            else:
-                ways.append(way)
-        return ways
+                continue
+            # rings are merged with list operations
+            way.coords = list(flat_coords(coords, offsets, i))
+            result.append(way)
+        return result
 
     def build_rings(self, ways):
         rings = []
@@ -109,17 +130,6 @@ class RelationBuilderBase(object):
             ring.geom = self.polygon_builder.build_checked_geom(ring, validate=self.validate_rings)
         return rings
 
-    def fetch_way_coords(self, way):
-        """
-        Fetch all coordinates of way.refs.
-        """
-        coords = self.coords_cache.get_coords(way.refs)
-        if coords is None:
-            log.debug('missing coord from way %s in relation %s',
-                way.osm_id, self.relation.osm_id)
-            return None
-        return coords
-
     def build_relation_geometry(self, rings):
         """
         Build relation geometry from rings.
@@ -0,0 +1,198 @@
+# Copyright 2011 Omniscale (http://omniscale.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Stats of the queues between the stages of the read and write pipelines.
+
+Queues are only instrumented if ``imposm.config.imposm_pipeline_stats``
+is enabled. All processes that put into or get from an instrumented
+queue add the time they were blocked to the `QueueStats` of the queue,
+which are kept in shared memory. A `Sampler` thread records the depth
+of the queues at a fixed interval. The main process prints a summary
+with `report` at the end of each phase:
+
+ - queues that are full most of the time and producers that are blocked
+   in put: the consumers are the bottleneck
+ - queues that are empty most of the time and consumers that are
+   blocked in get: the producers are the bottleneck
+"""
+
+from __future__ import with_statement
+
+import time
+import threading
+import multiprocessing
+
+import imposm.config
+
+# seconds between two samples of the queue depths
+SAMPLE_INTERVAL = 0.2
+
+# order of the counters in the shared memory of QueueStats
+FIELDS = ['puts', 'put_time', 'gets', 'get_time',
+    'samples', 'depth', 'max_depth', 'full', 'empty']
+
+_stats = {}
+_order = []
+
+def enabled():
+    return imposm.config.imposm_pipeline_stats
+
+class QueueStats(object):
+    """
+    Counters of all queues with the same name, in shared memory.
+    `consumers` is the number of processes/threads that get from
+    these queues.
+    """
+    def __init__(self, name, maxsize):
+        self.name = name
+        self.maxsize = maxsize
+        self.consumers = 0
+        self.start_time = time.time()
+        self.values = multiprocessing.RawArray('d', len(FIELDS))
+        self.lock = multiprocessing.Lock()
+
+    def add(self, field, count, seconds):
+        """
+        Count a put or get (`field`) that took `seconds`.
+        """
+        i = FIELDS.index(field)
+        with self.lock:
+            self.values[i] += count
+            self.values[i + 1] += seconds
+
+    def add_sample(self, depth):
+        with self.lock:
+            self.values[4] += 1
+            self.values[5] += depth
+            if depth > self.values[6]:
+                self.values[6] = depth
+            if self.maxsize and depth >= self.maxsize:
+                self.values[7] += 1
+            elif depth == 0:
+                self.values[8] += 1
+
+    def stats(self):
+        with self.lock:
+            stats = dict(zip(FIELDS, self.values))
+        stats['elapsed'] = time.time() - self.start_time
+        return stats
+
+class InstrumentedQueue(object):
+    """
+    Wraps a `multiprocessing` or `Queue` queue and adds the time of
+    each put and get to the `stats`.
+    """
+    def __init__(self, queue, stats):
+        self.queue = queue
+        self.stats = stats
+
+    def put(self, item, *args, **kw):
+        start = time.time()
+        self.queue.put(item, *args, **kw)
+        self.stats.add('puts', 1, time.time() - start)
+
+    def get(self, *args, **kw):
+        start = time.time()
+        item = self.queue.get(*args, **kw)
+        self.stats.add('gets', 1, time.time() - start)
+        return item
+
+    def sample(self):
+        try:
+            self.stats.add_sample(self.queue.qsize())
+        except NotImplementedError:
+            # qsize of multiprocessing queues is not available on OS X
+            pass
+
+    def __getattr__(self, name):
+        return getattr(self.queue, name)
+
+def instrument(queue, name, maxsize, consumers=1):
+    """
+    Return `queue` with stats, or `queue` itself if the pipeline
+    stats are disabled. Queues with the same `name` share their stats
+    (i.e. the queues of all shards). Call this in the main process.
+    """
+    if not enabled():
+        return queue
+    stats = _stats.get(name)
+    if stats is None:
+        stats = _stats[name] = QueueStats(name, maxsize)
+        _order.append(name)
+    stats.consumers += consumers
+    return InstrumentedQueue(queue, stats)
+
+class Sampler(threading.Thread):
+    """
+    Thread that samples the depth of the instrumented `queues` of
+    this process every `interval` seconds until it is stopped.
+    """
+    def __init__(self, queues, interval=SAMPLE_INTERVAL):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.queues = [q for q in queues if isinstance(q, InstrumentedQueue)]
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            for queue in self.queues:
+                queue.sample()
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+def start_sampler(queues):
+    """
+    Start a `Sampler` for the `queues`. Returns None if the pipeline
+    stats are disabled.
+    """
+    if not enabled():
+        return None
+    sampler = Sampler(queues)
+    sampler.start()
+    return sampler
+
+def format_stats(name, stats, maxsize, consumers):
+    """
+    >>> format_stats('ways', dict(puts=10, put_time=1.0, gets=10, get_time=3.0,
+    ...     samples=4, depth=20, max_depth=16, full=1, empty=0, elapsed=10.0), 16, 2)
+    'ways queue: 10 puts, depth avg 5.0 max 16/16, full 25% empty 0%, put blocked 1.0s, get blocked 3.0s, consumers busy 85%'
+    """
+    samples = stats['samples'] or 1
+    busy = 1.0
+    if consumers and stats['elapsed'] > 0:
+        busy = max(0.0, 1.0 - stats['get_time'] / (consumers * stats['elapsed']))
+    return ('%s queue: %d puts, depth avg %.1f max %d/%d, full %.0f%% empty %.0f%%, '
+        'put blocked %.1fs, get blocked %.1fs, consumers busy %.0f%%' % (
+        name, stats['puts'], stats['depth'] / samples, stats['max_depth'], maxsize,
+        100.0 * stats['full'] / samples, 100.0 * stats['empty'] / samples,
+        stats['put_time'], stats['get_time'], 100 * busy))
+
+def report(phase, message):
+    """
+    Pass a line for each instrumented queue to `message` and reset
+    all stats.
+    """
+    if not enabled():
+        return
+    for name in _order:
+        stats = _stats[name]
+        message('%s pipeline %s' % (phase, format_stats(name, stats.stats(),
+            stats.maxsize, stats.consumers)))
+    _stats.clear()
+    del _order[:]
@@ -13,10 +13,21 @@
 # limitations under the License.
 
 from functools import partial
+from operator import itemgetter
 from multiprocessing import Process, JoinableQueue
 
 from imposm.parser import OSMParser
-from imposm.util import setproctitle
+from imposm.util import setproctitle, MMapRing
+from imposm import pipeline
+from imposm.cache.tc import pack_coords, PackedCoords, PACKED_COORD_SIZE
+from imposm.cache.tc import encode_nodes, encode_ways, encode_relations
+from imposm.cache.shard import SHARD_ID_BITS
+from imposm.cache.tuning import describe_profile
+
+# the coords are sent to the cache writers in a ring of shared memory
+# buffers (of COORDS_BUFFER_SIZE bytes, COORDS_BUFFERS for each writer)
+COORDS_BUFFER_SIZE = 256 * 1024
+COORDS_BUFFERS = 32
 
 class ImposmReader(object):
     def __init__(self, mapping, cache, pool_size=2, merge=False, logger=None):
@@ -29,18 +40,18 @@ class ImposmReader(object):
         self.estimated_coords = 0
 
     def read(self, filename):
-        nodes_queue = JoinableQueue(128)
-        coords_queue = JoinableQueue(512)
-        ways_queue = JoinableQueue(128)
-        relations_queue = JoinableQueue(128)
-
         log_proc = self.logger()
         log_proc.start()
 
-        marshal = True
-        if self.merge:
-            # merging needs access to unmarshaled data
-            marshal = False
+        # tags are stored with the codes of the mapped keys/values,
+        # the writer processes inherit the dictionary
+        self.cache.update_tag_dict(self.mapper.tag_strings())
+
+        # the parser processes encode the records (with the tag codes),
+        # the writers store them as they arrive. merging needs
+        # access to the elements
+        encode = not self.merge
+        tag_dict = self.cache.tag_dict()
 
         estimates = {
             'coords': self.estimated_coords,
@@ -49,59 +60,143 @@ class ImposmReader(object):
             'relations': self.estimated_coords//1000,
         }
 
-        coords_writer = CacheWriterProcess(coords_queue, self.cache.coords_cache,
-            estimates['coords'], log=partial(log_proc.log, 'coords'),
-            marshaled_data=marshal)
-        coords_writer.start()
+        # keep one CPU free for writer proc on hosts with 4 or more CPUs
+        pool_size = self.pool_size if self.pool_size < 4 else self.pool_size - 1
 
-        nodes_writer = CacheWriterProcess(nodes_queue, self.cache.nodes_cache,
-            estimates['nodes'], log=partial(log_proc.log, 'nodes'),
-            marshaled_data=marshal)
-        nodes_writer.start()
+        coords_ring = MMapRing(COORDS_BUFFERS * self.cache.shards('coords'),
+            COORDS_BUFFER_SIZE)
+        # the parser processes get the free buffers
+        coords_ring.free_queue = pipeline.instrument(coords_ring.free_queue,
+            'coords free buffers', coords_ring.n, consumers=pool_size)
+        coords_put, coords_writers = self._start_writers('coords', 512,
+            self.cache.coords_cache, estimates['coords'], log_proc,
+            ring=coords_ring)
 
+        nodes_put, nodes_writers = self._start_writers('nodes', 128,
+            self.cache.nodes_cache, estimates['nodes'], log_proc,
+            encoded_data=encode)
 
-        ways_writer = CacheWriterProcess(ways_queue, self.cache.ways_cache,
-            estimates['ways'], merge=self.merge, log=partial(log_proc.log, 'ways'),
-            marshaled_data=marshal)
-        ways_writer.start()
+        ways_put, ways_writers = self._start_writers('ways', 128,
+            self.cache.ways_cache, estimates['ways'], log_proc,
+            merge=self.merge, encoded_data=encode)
 
-        relations_writer = CacheWriterProcess(relations_queue, self.cache.relations_cache,
-            estimates['relations'], merge=self.merge, log=partial(log_proc.log, 'relations'),
-            marshaled_data=marshal)
-        relations_writer.start()
+        relations_put, relations_writers = self._start_writers('relations', 128,
+            self.cache.relations_cache, estimates['relations'], log_proc,
+            merge=self.merge, encoded_data=encode)
+
+        if encode:
+            nodes_put = RecordEncoder(nodes_put, encode_nodes, tag_dict)
+            ways_put = RecordEncoder(ways_put, encode_ways, tag_dict)
+            relations_put = RecordEncoder(relations_put, encode_relations, tag_dict)
 
         log_proc.message('coords: %dk nodes: %dk ways: %dk relations: %dk (estimated)' % (
             estimates['coords']/1000, estimates['nodes']/1000, estimates['ways']/1000,
             estimates['relations']/1000)
         )
 
-        # keep one CPU free for writer proc on hosts with 4 or more CPUs
-        pool_size = self.pool_size if self.pool_size < 4 else self.pool_size - 1
-
-        parser = OSMParser(pool_size, nodes_callback=nodes_queue.put, coords_callback=coords_queue.put,
-            ways_callback=ways_queue.put, relations_callback=relations_queue.put, marshal_elem_data=marshal)
+        parser = OSMParser(pool_size, nodes_callback=nodes_put, coords_callback=coords_put,
+            ways_callback=ways_put, relations_callback=relations_put)
 
         parser.nodes_tag_filter = self.mapper.tag_filter_for_nodes()
         parser.ways_tag_filter = self.mapper.tag_filter_for_ways()
         parser.relations_tag_filter = self.mapper.tag_filter_for_relations()
 
+        writers = coords_writers + nodes_writers + ways_writers + relations_writers
+        sampler = pipeline.start_sampler([queue for queue, writer in writers]
+            + [coords_ring.free_queue])
+
         parser.parse(filename)
 
-        coords_queue.put(None)
-        nodes_queue.put(None)
-        ways_queue.put(None)
-        relations_queue.put(None)
-        coords_writer.join()
-        nodes_writer.join()
-        ways_writer.join()
-        relations_writer.join()
+        for queue, writer in writers:
+            queue.put(None)
+        for queue, writer in writers:
+            writer.join()
+        if sampler:
+            sampler.stop()
         log_proc.stop()
         log_proc.join()
+        self.cache.report_stats('reading', log_proc.message)
+        pipeline.report('reading', log_proc.message)
+
+    def _start_writers(self, name, queue_size, cache, estimated_records, log_proc,
+        ring=None, **kw):
+        """
+        Start a `CacheWriterProcess` for each shard of the `name` cache.
+        Starts a `PackedCoordsWriterProcess` instead if the coords are sent
+        in the `ring` of shared memory buffers.
+        Returns the callback for the parser and a list with the
+        queue and process of each writer.
+        """
+        shards = self.cache.shards(name)
+        profile = self.cache.tuning_profile(name, estimated_records)
+        if profile:
+            log_proc.message('%s cache: %s' % (name, describe_profile(profile)))
+        writers = []
+        senders = []
+        for shard in range(shards):
+            queue = pipeline.instrument(JoinableQueue(queue_size), name, queue_size)
+            shard_cache = cache
+            if shards > 1:
+                shard_cache = partial(cache, shard=shard)
+            if ring is not None:
+                writer = PackedCoordsWriterProcess(queue, ring, shard_cache,
+                    estimated_records // shards, log=partial(log_proc.log, name),
+                    dump_stats=self.cache.dump_stats, **kw)
+                senders.append(PackedCoordsSender(queue, ring))
+            else:
+                writer = CacheWriterProcess(queue, shard_cache, estimated_records // shards,
+                    log=partial(log_proc.log, name), dump_stats=self.cache.dump_stats, **kw)
+                senders.append(queue)
+            writer.start()
+            writers.append((queue, writer))
+
+        if shards == 1:
+            return senders[0].put, writers
+        return ShardRouter(senders), writers
+
+
+class ShardRouter(object):
+    """
+    Parser callback that splits each batch into the queues (or
+    `PackedCoordsSender`) of the shards.
+    """
+    def __init__(self, queues):
+        self.queues = queues
+
+    def __call__(self, data):
+        n = len(self.queues)
+        batches = [[] for _ in xrange(n)]
+        for d in data:
+            batches[(d[0] >> SHARD_ID_BITS) % n].append(d)
+        for queue, batch in zip(self.queues, batches):
+            if batch:
+                queue.put(batch)
+
+
+class RecordEncoder(object):
+    """
+    Parser callback that encodes each batch into cache records with
+    `encode` (e.g. `encode_ways`) before it is passed to `put`.
+    The parser processes call the callbacks, the writer processes
+    only store the records (see `NodeDB.put_encoded`).
+    """
+    def __init__(self, put, encode, tag_dict):
+        self.put = put
+        self.encode = encode
+        self.tag_dict = tag_dict
+
+    def __call__(self, data):
+        self.put(self.encode(data, self.tag_dict))
 
 
 class CacheWriterProcess(Process):
+    # number of records that are buffered and sorted by id before they are
+    # written. the parser processes return their blocks out of order, but
+    # the caches are faster if the ids are increasing (see BDB.stats)
+    reorder_buffer_size = 65536
+
     def __init__(self, queue, cache, estimated_records=None, merge=False, log=None,
-        marshaled_data=False):
+        encoded_data=False, dump_stats=None):
         Process.__init__(self)
         self.daemon = True
         setproctitle('imposm writer')
@@ -109,34 +204,107 @@ class CacheWriterProcess(Process):
         self.cache = cache
         self.merge = merge
         self.log = log
-        self.marshaled_data = marshaled_data
+        self.encoded_data = encoded_data
         self.estimated_records = estimated_records
+        self.dump_stats = dump_stats
 
     def run(self):
         # print 'creating %s (%d)' % (self.filename, self.estimated_records or 0)
         cache = self.cache(mode='w', estimated_records=self.estimated_records)
-        if self.marshaled_data:
-            cache_put = cache.put_marshaled
+        if self.encoded_data:
+            cache_put = cache.put_encoded
         else:
             cache_put = cache.put
+        buffered = []
         while True:
             data = self.queue.get()
             if data is None:
+                buffered.sort(key=itemgetter(0))
+                self._write(cache, cache_put, buffered)
                 self.queue.task_done()
                 break
-            if self.merge:
-                for d in data:
-                    if d[0] in cache:
-                        elem = cache.get(d[0])
-                        elem.merge(*d[1:])
-                        d = elem.to_tuple()
-                    cache_put(*d)
-            else:
-                for d in data:
-                    cache_put(*d)
+            buffered.extend(data)
+            if len(buffered) >= self.reorder_buffer_size:
+                buffered.sort(key=itemgetter(0))
+                # only write the smaller half, the next blocks can
+                # still contain ids that are smaller than the rest
+                half = len(buffered) // 2
+                self._write(cache, cache_put, buffered[:half])
+                del buffered[:half]
             if self.log:
                 self.log(len(data))
             self.queue.task_done()
         cache.close()
+        if self.dump_stats:
+            self.dump_stats()
 
+    def _write(self, cache, cache_put, data):
+        if self.merge:
+            for d in data:
+                if d[0] in cache:
+                    elem = cache.get(d[0])
+                    elem.merge(*d[1:])
+                    d = elem.to_tuple()
+                cache_put(*d)
+        else:
+            for d in data:
+                cache_put(*d)
+
+
+
+
+class PackedCoordsSender(object):
+    """
+    Parser callback that packs the coords into free buffers of the
+    `ring` and puts only the index and size of each buffer into the
+    `queue` of the `PackedCoordsWriterProcess`.
+    """
+    def __init__(self, queue, ring):
+        self.queue = queue
+        self.ring = ring
+        self.batch_size = ring.mmap_size // PACKED_COORD_SIZE
+
+    def put(self, coords):
+        for start in xrange(0, len(coords), self.batch_size):
+            idx, buf = self.ring.acquire()
+            size = pack_coords(coords[start:start + self.batch_size], buf)
+            self.queue.put((idx, size))
+
+    __call__ = put
+
+
+class PackedCoordsWriterProcess(CacheWriterProcess):
+    """
+    Writes the packed coords from the buffers of the `ring` into the
+    coords cache, see `PackedCoordsSender`. The coords are copied into
+    the reorder buffer and the buffer is released right away.
+    """
+    def __init__(self, queue, ring, cache, estimated_records=None, **kw):
+        CacheWriterProcess.__init__(self, queue, cache, estimated_records, **kw)
+        self.ring = ring
 
+    def run(self):
+        cache = self.cache(mode='w', estimated_records=self.estimated_records)
+        buffered = PackedCoords()
+        while True:
+            data = self.queue.get()
+            if data is None:
+                buffered.sort()
+                cache.put_packed(buffered)
+                self.queue.task_done()
+                break
+            idx, size = data
+            buffered.extend(self.ring.get(idx), size)
+            self.ring.release(idx)
+            if len(buffered) >= self.reorder_buffer_size:
+                buffered.sort()
+                # only write the smaller half, see CacheWriterProcess
+                half = len(buffered) // 2
+                cache.put_packed(buffered, half)
+                buffered.remove(half)
+            if self.log:
+                self.log(size // PACKED_COORD_SIZE)
+            self.queue.task_done()
+        cache.close()
+        if self.dump_stats:
+            self.dump_stats()
@@ -0,0 +1,92 @@
+# Copyright 2011 Omniscale (http://omniscale.com)
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+
+import imposm.app
+import imposm.config
+from imposm.cache.osm import OSMCache
+from imposm.cache.tc import FrozenWayDB
+
+from nose.tools import eq_
+
+class TestCacheOptions(object):
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+        imposm.config.imposm_memory_cache = False
+        imposm.config.imposm_memory_cache_path = '/dev/shm'
+
+    def test_freeze_cache(self):
+        cache = OSMCache(self.dir)
+        ways = cache.ways_cache('w')
+        assert ways.put(1, {'highway': 'primary'}, [1, 2])
+        cache.close_all()
+
+        imposm.app.main(['--freeze-cache', '--cache-dir', self.dir, '--quiet'])
+        ways = cache.ways_cache('r')
+        assert isinstance(ways, FrozenWayDB)
+        eq_(ways.get(1).refs, [1, 2])
+        cache.close_all()
+
+    def test_memory_cache_without_tmpfs(self):
+        imposm.config.imposm_memory_cache_path = os.path.join(self.dir, 'missing')
+        try:
+            imposm.app.main(['--memory-cache', '--freeze-cache', '--cache-dir', self.dir,
+                '--quiet'])
+        except SystemExit, ex:
+            eq_(ex.code, 2)
+        else:
+            assert False, 'expected SystemExit'
+        eq_(os.listdir(self.dir), [])
+
+    def test_memory_cache_existing_files(self):
+        cache = OSMCache(self.dir)
+        assert cache.ways_cache('w').put(1, {'highway': 'primary'}, [1, 2])
+        cache.close_all()
+        memory_path = os.path.join(self.dir, 'shm')
+        os.mkdir(memory_path)
+        imposm.config.imposm_memory_cache_path = memory_path
+        osm_file = os.path.join(self.dir, 'empty.osm')
+        open(osm_file, 'w').close()
+        try:
+            imposm.app.main(['--memory-cache', '--read', osm_file,
+                '--cache-dir', self.dir, '--quiet'])
+        except SystemExit, ex:
+            eq_(ex.code, 2)
+        else:
+            assert False, 'expected SystemExit'
+        # exits before the caches are copied into memory
+        eq_([os.listdir(os.path.join(memory_path, d)) for d in os.listdir(memory_path)], [[]])
+
+    def test_read_and_merge_cache_dirs(self):
+        cache = OSMCache(self.dir)
+        assert cache.ways_cache('w').put(1, {'highway': 'primary'}, [1, 2])
+        cache.close_all()
+        cache_files = cache.files()
+        osm_file = os.path.join(self.dir, 'empty.osm')
+        open(osm_file, 'w').close()
+        try:
+            imposm.app.main(['--read', osm_file, '--merge-cache-dirs', self.dir,
+                '--overwrite-cache', '--cache-dir', self.dir, '--quiet'])
+        except SystemExit, ex:
+            eq_(ex.code, 2)
+        else:
+            assert False, 'expected SystemExit'
+        # fails before any cache is removed
+        eq_(cache.files(), cache_files)
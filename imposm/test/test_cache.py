@@ -12,11 +12,31 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from __future__ import with_statement
+
 import os
+import mmap
+import shutil
+import logging
+import threading
 import tempfile
-from imposm.cache.tc import NodeDB, CoordDB, DeltaCoordsDB
+import marshal
+
+import imposm.config
+from imposm.base import Way
+
+from imposm.cache.tc import BDB, NodeDB, WayDB, RelationDB, CoordDB, DeltaCoordsDB, DenseCoordDB, DeltaNodes, IdBitmap
+from imposm.cache.tc import FrozenNodeDB, FrozenWayDB, freeze_db, is_frozen_file
+from imposm.cache.tc import coords_precision, SharedBlockCache, WayCoordsDB, join_way_coords
+from imposm.cache.tc import pack_coords, PackedCoords, PACKED_COORD_SIZE
+from imposm.cache.tc import encode_nodes, encode_ways, encode_relations
+from imposm.cache.tagdict import TagDictionary
+from imposm.cache.osm import OSMCache, copy_sparse, memory_cache_dir
+from imposm.cache.shard import ShardedCache
+from imposm.cache.tuning import tuning_profile, memory_share, total_share, CACHE_TYPES
+from imposm.cache import stats as cache_stats
 
-from nose.tools import eq_, assert_almost_equal
+from nose.tools import eq_, assert_almost_equal, assert_raises
 
 
 class TestNodeDB(object):
@@ -69,6 +89,895 @@ class TestNodeDB(object):
         eq_(nd.coord, (123, 456))
 
 
+class TestWayDB(object):
+    def setup(self):
+        fd_, self.fname = tempfile.mkstemp('.db')
+        self.db = WayDB(self.fname)
+
+    def teardown(self):
+        os.unlink(self.fname)
+
+    def test_insert(self):
+        assert self.db.put(1000, {'highway': 'primary'}, [5, 2**40, -3, 4])
+        assert self.db.put_marshaled(1001, marshal.dumps(({}, [1, 2]), 2))
+        assert self.db.put(1002, {}, [[1, 2], [3, 4]])
+        self.db.close()
+        self.db = WayDB(self.fname, 'r')
+
+        way = self.db.get(1000)
+        eq_(way.osm_id, 1000)
+        eq_(way.tags, {'highway': 'primary'})
+        eq_(way.refs, [5, 2**40, -3, 4])
+        eq_(way.partial_refs, None)
+
+        way = self.db.get(1002)
+        eq_(way.refs, [1, 2])
+        eq_(way.partial_refs, [[1, 2], [3, 4]])
+
+        eq_([(w.osm_id, w.refs) for w in self.db],
+            [(1000, [5, 2**40, -3, 4]), (1001, [1, 2]), (1002, [1, 2])])
+
+    def test_merge(self):
+        assert self.db.put(1000, {'highway': 'primary'}, [1, 2, 3])
+        way = self.db.get(1000)
+        way.merge({'name': 'foo'}, [3, 4])
+        eq_(way.to_tuple(), (1000, {'highway': 'primary', 'name': 'foo'}, [1, 2, 3, 4]))
+
+    def test_marshaled_records(self):
+        # records of older versions
+        self.db.close()
+        db = BDB(self.fname)
+        db.put_marshaled(1000, marshal.dumps(({'highway': 'primary'}, [1, 2]), 2))
+        db.close()
+        self.db = WayDB(self.fname, 'r')
+        way = self.db.get(1000)
+        eq_(way.tags, {'highway': 'primary'})
+        eq_(way.refs, [1, 2])
+
+
+class TestRelationDB(object):
+    def setup(self):
+        fd_, self.fname = tempfile.mkstemp('.db')
+        self.db = RelationDB(self.fname)
+
+    def teardown(self):
+        os.unlink(self.fname)
+
+    def test_insert(self):
+        members = [(1, 'way', 'outer'), (2**40, 'node', 'label'), (5, 'relation', '')]
+        assert self.db.put(1000, {'type': 'multipolygon'}, members)
+        assert self.db.put(1001, {}, [(1, 'unknown', 'outer')])
+        self.db.close()
+        self.db = RelationDB(self.fname, 'r')
+
+        rel = self.db.get(1000)
+        eq_(rel.tags, {'type': 'multipolygon'})
+        eq_(rel.members, members)
+
+        rel = self.db.get(1001)
+        eq_(rel.members, [(1, 'unknown', 'outer')])
+
+
+class TestTagDictionary(object):
+    def setup(self):
+        fd_, self.fname = tempfile.mkstemp('.db')
+        self.tag_dict = TagDictionary(['highway', 'residential', 'type', 'multipolygon'])
+
+    def teardown(self):
+        os.unlink(self.fname)
+
+    def test_save_load(self):
+        self.tag_dict.save(self.fname)
+        tag_dict = TagDictionary.load(self.fname)
+        eq_(tag_dict.strings, self.tag_dict.strings)
+        eq_(tag_dict.codes['type'], 2)
+
+    def test_nodes(self):
+        db = NodeDB(self.fname, tag_dict=self.tag_dict)
+        assert db.put(1000, {'highway': 'residential', 'name': u'Stra\xdfe'}, (1.5, 2.5))
+        assert db.put(1001, {'highway': 2}, (1, 2))
+        db.close()
+        db = NodeDB(self.fname, 'r', tag_dict=self.tag_dict)
+        nd = db.get(1000)
+        eq_(nd.tags, {'highway': 'residential', 'name': u'Stra\xdfe'})
+        eq_(type(nd.tags['name']), unicode)
+        eq_(nd.coord, (1.5, 2.5))
+        # strings from the dictionary are shared
+        assert nd.tags['highway'] is self.tag_dict.encoded[1]
+        eq_(db.get(1001).tags, {'highway': 2})
+        db.close()
+
+    def test_encoded_nodes(self):
+        db = NodeDB(self.fname, tag_dict=self.tag_dict)
+        for osmid, data in encode_nodes([(1000, {'highway': 'residential'}, (1.5, 2.5)),
+            (1001, {'highway': 2}, (1, 2))], self.tag_dict):
+            assert db.put_encoded(osmid, data)
+        assert_raises(ValueError, db.put_encoded, 1002, marshal.dumps(({}, (1, 2)), 2))
+        db.close()
+        db = NodeDB(self.fname, 'r', tag_dict=self.tag_dict)
+        nd = db.get(1000)
+        eq_(nd.tags, {'highway': 'residential'})
+        eq_(nd.coord, (1.5, 2.5))
+        assert nd.tags['highway'] is self.tag_dict.encoded[1]
+        eq_(db.get(1001).tags, {'highway': 2})
+        db.close()
+
+    def test_string_types(self):
+        tags = {'highway': u'residential', u'type': 'multipolygon',
+            'name': 'Bahnhofstr.', u'name:de': u'Stra\xdfe'}
+        db = NodeDB(self.fname, tag_dict=self.tag_dict)
+        assert db.put(1000, tags, (1, 2))
+        db.close()
+        db = NodeDB(self.fname, 'r', tag_dict=self.tag_dict)
+        coded_tags = db.get(1000).tags
+        db.close()
+        eq_(coded_tags, tags)
+        # same types as the marshaled tags of caches without a dictionary
+        eq_(sorted((type(k), type(v)) for k, v in coded_tags.iteritems()),
+            sorted((type(k), type(v)) for k, v in tags.iteritems()))
+
+    def test_ways_relations(self):
+        db = WayDB(self.fname, tag_dict=self.tag_dict)
+        assert db.put(1000, {'highway': 'residential', 'ref': 'B1'}, [1, 2, 3])
+        db.close()
+        db = WayDB(self.fname, 'r', tag_dict=self.tag_dict)
+        way = db.get(1000)
+        eq_(way.tags, {'highway': 'residential', 'ref': 'B1'})
+        eq_(type(way.tags['ref']), str)
+        eq_(way.refs, [1, 2, 3])
+        db.close()
+        os.unlink(self.fname)
+
+        db = RelationDB(self.fname, tag_dict=self.tag_dict)
+        assert db.put(1000, {'type': 'multipolygon'}, [(1, 'way', 'outer')])
+        db.close()
+        db = RelationDB(self.fname, 'r', tag_dict=self.tag_dict)
+        rel = db.get(1000)
+        eq_(rel.tags, {'type': 'multipolygon'})
+        eq_(rel.members, [(1, 'way', 'outer')])
+        db.close()
+
+    def test_encoded_ways_relations(self):
+        for tag_dict in [self.tag_dict, None]:
+            db = WayDB(self.fname, tag_dict=tag_dict)
+            db.tagged_ids = IdBitmap(self.fname + '.tagged')
+            for osmid, data in encode_ways([(1000, {'highway': 'residential'}, [1, 2, 3]),
+                (1001, {}, [3, 4]), (1002, {'name': u'Stra\xdfe'}, [[1, 2], [3, 4]])], tag_dict):
+                assert db.put_encoded(osmid, data)
+            assert_raises(ValueError, db.put_encoded, 1003, marshal.dumps(({}, [1, 2]), 2))
+            db.close()
+            db = WayDB(self.fname, 'r', tag_dict=tag_dict)
+            eq_([(w.osm_id, w.tags, w.refs) for w in db],
+                [(1000, {'highway': 'residential'}, [1, 2, 3]), (1001, {}, [3, 4]),
+                 (1002, {'name': u'Stra\xdfe'}, [1, 2])])
+            db.close()
+            tagged_ids = IdBitmap(self.fname + '.tagged', 'r')
+            eq_(list(tagged_ids), [1000, 1002])
+            tagged_ids.close()
+            os.unlink(self.fname)
+            os.unlink(self.fname + '.tagged')
+
+        db = RelationDB(self.fname, tag_dict=self.tag_dict)
+        members = [(1, 'way', 'outer'), (2, 'unknown', 'inner')]
+        for osmid, data in encode_relations([(1000, {'type': 'multipolygon'}, members[:1]),
+            (1001, {}, members)], self.tag_dict):
+            assert db.put_encoded(osmid, data)
+        db.close()
+        db = RelationDB(self.fname, 'r', tag_dict=self.tag_dict)
+        eq_(db.get(1000).tags, {'type': 'multipolygon'})
+        eq_(db.get(1000).members, members[:1])
+        eq_(db.get(1001).members, members)
+        db.close()
+
+
+class TestShardedCache(object):
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        self.old_shards = imposm.config.imposm_cache_shards
+        imposm.config.imposm_cache_shards = 3
+
+    def teardown(self):
+        imposm.config.imposm_cache_shards = self.old_shards
+        shutil.rmtree(self.dir)
+
+    def test_coords(self):
+        cache = OSMCache(self.dir)
+        eq_(cache.shards('coords'), 3)
+        for shard in range(3):
+            coords = cache.coords_cache('w', shard=shard)
+            # write the blocks of 64 ids of this shard
+            for start in range(shard * 64, 1024, 3 * 64):
+                for osmid in range(start, start + 64):
+                    assert coords.put(osmid, osmid / 10.0, 1.0)
+        cache.close_all()
+
+        imposm.config.imposm_cache_shards = 1
+        cache = OSMCache(self.dir)
+        eq_(cache.shards('coords'), 3)
+        coords = cache.coords_cache('r')
+        assert isinstance(coords, ShardedCache)
+        assert_almost_equal(coords.get(100)[0], 10.0, 6)
+        eq_(len(coords.get_coords([63, 64, 200])), 3)
+        assert coords.get_coords([63, 5000]) is None
+        coords, offsets, missing = coords.get_ways_coords_array([[1, 65, 129], [1, 5000], []])
+        eq_(list(missing), [0, 1, 0])
+        eq_(list(offsets)[:2], [0, 3])
+        for i, c in enumerate([0.1, 1.0, 6.5, 1.0, 12.9, 1.0]):
+            assert_almost_equal(coords[i], c, 6)
+        cache.close_all()
+
+    def test_ways(self):
+        cache = OSMCache(self.dir)
+        ways = cache.ways_cache('w')
+        for osmid in [1, 1000, 70, 200, 130]:
+            assert ways.put(osmid, {'highway': 'primary'}, [1, 2])
+        cache.close_all()
+
+        ways = OSMCache(self.dir).ways_cache('r')
+        eq_([w.osm_id for w in ways], [1, 70, 130, 200, 1000])
+        eq_(ways.get(130).refs, [1, 2])
+        assert 1000 in ways
+        assert 1001 not in ways
+        ways.close()
+
+    def test_configured_shards(self):
+        cache = OSMCache(self.dir)
+        cache.ways_cache('w').put(1, {}, [1, 2])
+        cache.close_all()
+
+        warnings = []
+        class Handler(logging.Handler):
+            def emit(self, record):
+                warnings.append(record.getMessage())
+        handler = Handler()
+        log = logging.getLogger('imposm.cache.osm')
+        log.addHandler(handler)
+        try:
+            imposm.config.imposm_cache_shards = 2
+            cache = OSMCache(self.dir)
+            eq_(cache.shards('ways'), 3)
+            eq_(cache.shards('ways'), 3)
+            eq_(cache.shards('nodes'), 2)
+            # existing shards are used without a warning if not configured
+            imposm.config.imposm_cache_shards = None
+            eq_(OSMCache(self.dir).shards('ways'), 3)
+            eq_(OSMCache(self.dir).shards('nodes'), 1)
+        finally:
+            log.removeHandler(handler)
+        eq_(len(warnings), 1)
+        assert 'existing ways cache' in warnings[0], warnings
+
+
+class TestFrozenDB(object):
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.dir, 'test.cache')
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def test_freeze(self):
+        db = WayDB(self.fname)
+        for osmid in [5, -3, 2**40, 100]:
+            assert db.put(osmid, {'highway': 'primary'}, [osmid, 1])
+        db.close()
+
+        db = BDB(self.fname, 'r')
+        eq_(freeze_db(db, self.fname + '.frozen'), 4)
+        db.close()
+        assert is_frozen_file(self.fname + '.frozen')
+        assert not is_frozen_file(self.fname)
+
+        db = FrozenWayDB(self.fname + '.frozen')
+        eq_(len(db), 4)
+        eq_(db.get(100).refs, [100, 1])
+        eq_(db.get(2**40).tags, {'highway': 'primary'})
+        assert db.get(6) is None
+        assert -3 in db
+        assert 4 not in db
+        eq_([w.osm_id for w in db], [-3, 5, 100, 2**40])
+        assert not db.put(1, {}, [])
+        db.close()
+
+    def test_empty(self):
+        db = NodeDB(self.fname)
+        db.close()
+        db = BDB(self.fname, 'r')
+        eq_(freeze_db(db, self.fname + '.frozen'), 0)
+        db.close()
+        db = FrozenNodeDB(self.fname + '.frozen')
+        eq_(len(db), 0)
+        eq_(list(db), [])
+        assert db.get(1) is None
+        db.close()
+
+    def test_osm_cache(self):
+        cache = OSMCache(self.dir)
+        nodes = cache.nodes_cache('w')
+        assert nodes.put(1, {'amenity': 'pub'}, (8.0, 53.0))
+        cache.close_all()
+
+        eq_(cache.freeze(), 1)
+        nodes = cache.nodes_cache('r')
+        assert isinstance(nodes, FrozenNodeDB)
+        eq_(nodes.get(1).tags, {'amenity': 'pub'})
+        eq_(nodes.get(1).coord, (8.0, 53.0))
+        cache.close_all()
+
+        try:
+            cache.nodes_cache('w')
+        except IOError:
+            pass
+        else:
+            assert False, 'expected IOError'
+
+
+class TestTuning(object):
+    def teardown(self):
+        imposm.config.imposm_cache_tuning = {}
+
+    def test_profiles(self):
+        coords = tuning_profile('coords', 10**6, memory=2**30, processes=4)
+        ways = tuning_profile('ways', 10**6, memory=2**30, processes=4)
+        assert coords['lmemb'] > ways['lmemb']
+        assert coords['bnum'] < ways['bnum']
+        assert tuning_profile('coords', None)['bnum'] == -1
+        small = tuning_profile('coords', 10**6, memory=2**30, processes=16)
+        assert small['lcnum'] < coords['lcnum']
+
+    def test_memory_shares(self):
+        shares = [memory_share(t) for t in ('coords', 'nodes', 'ways', 'relations', 'way_coords')]
+        assert sum(shares) <= 1.0 + 1e-9, shares
+        assert memory_share('coords_blocks') <= memory_share('coords')
+
+        # shares are scaled down if the cache types sum to more than 1
+        orig = CACHE_TYPES['ways']
+        CACHE_TYPES['ways'] = (orig[0], 0.7, orig[2])
+        try:
+            eq_(round(total_share(), 6), 1.5)
+            shares = [memory_share(t) for t in ('coords', 'nodes', 'ways', 'relations', 'way_coords')]
+            assert_almost_equal(sum(shares), 1.0)
+            assert_almost_equal(memory_share('ways'), 0.7 / 1.5)
+        finally:
+            CACHE_TYPES['ways'] = orig
+
+    def test_override(self):
+        imposm.config.imposm_cache_tuning = {'ways': {'lcnum': 100, 'compress': None}}
+        profile = tuning_profile('ways', 10**6)
+        eq_(profile['lcnum'], 100)
+        eq_(profile['compress'], None)
+        eq_(tuning_profile('nodes', 10**6)['compress'], 'deflate')
+
+        imposm.config.imposm_cache_tuning = {'ways': {'foo': 1}}
+        try:
+            tuning_profile('ways')
+        except ValueError:
+            pass
+        else:
+            assert False, 'expected ValueError'
+
+    def test_cache_with_override(self):
+        imposm.config.imposm_cache_tuning = {'coords': {'lmemb': 64, 'compress': None}}
+        fd_, fname = tempfile.mkstemp('.db')
+        try:
+            db = CoordDB(fname, estimated_records=1000)
+            assert db.put(1, 2, 3)
+            db.close()
+        finally:
+            os.unlink(fname)
+
+
+class TestCacheStats(object):
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        imposm.config.imposm_cache_stats = True
+
+    def teardown(self):
+        imposm.config.imposm_cache_stats = False
+        shutil.rmtree(self.dir)
+
+    def test_coords(self):
+        db = CoordDB(os.path.join(self.dir, 'coords.cache'))
+        db.put(1, 10, 20)
+        db.put(2, 11, 21)
+        assert db.get(1)
+        assert not db.get(3)
+        coords, offsets, missing = db.get_ways_coords_array([[1, 2]])
+        stats = db.io_stats()
+        eq_(stats['puts'], 2)
+        eq_(stats['gets'], 4)
+        eq_(stats['misses'], 1)
+        eq_(stats['bytes_read'], 3 * 8)
+        eq_(sum(stats['get_latency']), 4)
+        db.close()
+
+        eq_(cache_stats.collect(self.dir)['coords']['gets'], 4)
+        eq_(cache_stats.collect(self.dir), {})
+
+    def test_threads(self):
+        db = CoordDB(os.path.join(self.dir, 'coords.cache'))
+        for osmid in range(1, 101):
+            db.put(osmid, 10, 20)
+        db.close()
+        imposm.config.imposm_write_threads = 4
+        try:
+            db = CoordDB(os.path.join(self.dir, 'coords.cache'), 'r')
+        finally:
+            imposm.config.imposm_write_threads = 1
+        def lookup():
+            for _ in range(50):
+                db.get_ways_coords_array([range(1, 102)])
+        threads = [threading.Thread(target=lookup) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        stats = db.io_stats()
+        eq_(stats['gets'], 4 * 50 * 101)
+        eq_(stats['misses'], 4 * 50)
+        eq_(sum(stats['get_latency']), 4 * 50 * 101)
+        db.close()
+
+    def test_disabled(self):
+        imposm.config.imposm_cache_stats = False
+        db = CoordDB(os.path.join(self.dir, 'coords.cache'))
+        db.put(1, 10, 20)
+        assert db.get(1)
+        eq_(db.io_stats()['gets'], 0)
+        db.close()
+        eq_(cache_stats.collect(self.dir), {})
+
+    def test_delta_coords(self):
+        db = DeltaCoordsDB(os.path.join(self.dir, 'coords.cache'))
+        db.put(1, 10, 20)
+        db.put(100, 10, 20)
+        # the puts fetch blocks, but are no gets
+        eq_(db.io_stats()['gets'], 0)
+        eq_(db.io_stats()['block_misses'], 2)
+        db.close()
+        db = DeltaCoordsDB(os.path.join(self.dir, 'coords.cache'), 'r')
+        assert db.get(1)
+        assert db.get(2) is None
+        coords, offsets, missing = db.get_ways_coords_array([[1, 100], [3, 1]])
+        stats = db.io_stats()
+        eq_(stats['gets'], 2 + 3)
+        eq_(stats['misses'], 1 + 1)
+        eq_(stats['block_misses'], 2)
+        eq_(stats['block_hits'], 2)
+        assert stats['bytes_decoded'] > 0
+        db.close()
+
+        stats = cache_stats.collect(self.dir)
+        eq_(stats['coords']['gets'], 5)
+        eq_(stats['coords_blocks']['gets'], 2 + 2)
+
+    def test_dump_collect(self):
+        cache_stats.record('ways', {'gets': 2, 'get_latency': [1, 1]})
+        cache_stats.dump(self.dir)
+        cache_stats.record('ways', {'gets': 1, 'get_latency': [0, 0, 1]})
+        stats = cache_stats.collect(self.dir)
+        eq_(stats['ways'], {'gets': 3, 'get_latency': [1, 1, 1]})
+        eq_(os.listdir(self.dir), [])
+
+class TestCompact(object):
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def test_compact(self):
+        cache = OSMCache(self.dir)
+        ways = cache.ways_cache('w')
+        for i in [5, 3, 9, 1, 7]:
+            ways.put(i, {'highway': 'primary'}, [i, i + 1])
+        cache.close_all()
+
+        results = cache.compact(['ways'])
+        eq_(len(results), 1)
+        fname, records, size_before, size_after, scan_before, scan_after = results[0]
+        eq_(fname, os.path.join(self.dir, 'imposm_ways.cache'))
+        eq_(records, 5)
+
+        ways = cache.ways_cache('r')
+        eq_([w.osm_id for w in ways], [1, 3, 5, 7, 9])
+        eq_(ways.get(7).refs, [7, 8])
+
+    def test_skip_frozen(self):
+        cache = OSMCache(self.dir)
+        nodes = cache.nodes_cache('w')
+        nodes.put(1, {'amenity': 'pub'}, (1, 2))
+        cache.freeze(['nodes'])
+        eq_(cache.compact(['nodes']), [])
+
+class TestCacheManifest(object):
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        self.inputs = []
+        for name in ('a.osm', 'b.osm'):
+            fname = os.path.join(self.dir, name)
+            with open(fname, 'w') as f:
+                f.write(name * 100)
+            self.inputs.append(fname)
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def create_cache(self):
+        cache = OSMCache(self.dir)
+        cache.ways_cache('w').put(1, {'highway': 'primary'}, [1, 2])
+        cache.close_all()
+        return cache
+
+    def test_no_manifest(self):
+        cache = self.create_cache()
+        eq_(cache.unread_inputs(self.inputs, 'abc'), None)
+
+    def test_matching(self):
+        cache = self.create_cache()
+        cache.write_manifest(self.inputs, 'abc')
+        eq_(cache.unread_inputs(self.inputs, 'abc'), [])
+        eq_(cache.unread_inputs(self.inputs + ['c.osm'], 'abc'), ['c.osm'])
+        eq_(cache.unread_inputs(self.inputs, 'def'), None)
+        eq_(cache.unread_inputs(self.inputs[:1], 'abc'), None)
+
+    def test_changed_input(self):
+        cache = self.create_cache()
+        cache.write_manifest(self.inputs, 'abc')
+        with open(self.inputs[1], 'w') as f:
+            f.write('c.osm' * 100)
+        os.utime(self.inputs[1], (0, 0))
+        eq_(cache.unread_inputs(self.inputs, 'abc'), None)
+
+    def test_touched_input(self):
+        cache = self.create_cache()
+        cache.write_manifest(self.inputs, 'abc')
+        os.utime(self.inputs[1], (0, 0))
+        eq_(cache.unread_inputs(self.inputs, 'abc'), [])
+
+    def test_changed_cache(self):
+        cache = self.create_cache()
+        cache.write_manifest(self.inputs, 'abc')
+        cache.ways_cache('w').put(2, {'highway': 'primary'}, [1, 2])
+        cache.close_all()
+        eq_(cache.unread_inputs(self.inputs, 'abc'), None)
+
+    def test_remove(self):
+        cache = self.create_cache()
+        cache.write_manifest(self.inputs[:1], 'abc')
+        previous = cache.remove_manifest()
+        eq_(cache.unread_inputs(self.inputs, 'abc'), None)
+        cache.write_manifest(self.inputs, 'abc', previous)
+        eq_(cache.unread_inputs(self.inputs, 'abc'), [])
+
+class TestJoinWayCoords(object):
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def test_way_coords_db(self):
+        db = WayCoordsDB(os.path.join(self.dir, 'way_coords.cache'))
+        assert db.put(5, [1.0, 2.0, 3.0, 4.0])
+        assert_almost_equal(db.get(5)[3], 4.0, 6)
+        coords, offsets, missing = db.get_ways_coords_array([5, 6, 5])
+        eq_(list(offsets), [0, 2, 2, 4])
+        eq_(list(missing), [0, 1, 0])
+        assert_almost_equal(coords[6], 3.0, 6)
+        eq_(list(db.get_ways_coords_array([])[1]), [0])
+        db.close()
+
+    def test_join(self):
+        cache = OSMCache(self.dir)
+        coords = cache.coords_cache('w')
+        for osmid in range(1, 10):
+            coords.put(osmid, osmid, -osmid)
+        ways = cache.ways_cache('w')
+        ways.put(1, {'highway': 'primary'}, [3, 1, 2])
+        ways.put(2, {}, [9, 4, 99])
+        ways.put(3, {}, [5, 5])
+        cache.close_all()
+        assert cache.way_coords_cache() is None
+
+        eq_(cache.join_way_coords(), 2)
+        way_coords = cache.way_coords_cache()
+        for c, expected in zip(way_coords.get(1), [3.0, -3.0, 1.0, -1.0, 2.0, -2.0]):
+            assert_almost_equal(c, expected, 6)
+        assert way_coords.get(2) is None
+        eq_(len(way_coords.get(3)), 4)
+        cache.close_all()
+
+        cache.remove_way_coords_cache()
+        assert cache.way_coords_cache() is None
+
+    def check_join(self, coords, ways):
+        way_coords = WayCoordsDB(os.path.join(self.dir, 'way_coords.cache'))
+        tmp_dir = os.path.join(self.dir, 'tmp')
+        os.mkdir(tmp_dir)
+        # sorts in runs of 7 records
+        eq_(join_way_coords(ways, coords, way_coords, tmp_dir, run_records=7), 40)
+        # all runs are removed
+        eq_(os.listdir(tmp_dir), [])
+        for way_id in range(1, 51):
+            if way_id % 5 == 0:
+                assert way_coords.get(way_id) is None
+                continue
+            refs = [(way_id * 7 + i) % 60 + 1 for i in range(way_id % 4 + 1)]
+            expected = [c for ref in refs for c in (ref / 10.0, -ref / 10.0)]
+            for c, e in zip(way_coords.get(way_id), expected):
+                assert_almost_equal(c, e, 6)
+        way_coords.close()
+
+    def join_ways(self):
+        for way_id in range(1, 51):
+            refs = [(way_id * 7 + i) % 60 + 1 for i in range(way_id % 4 + 1)]
+            if way_id % 5 == 0:
+                refs.append(1000)
+            yield way_id, refs
+
+    def test_join_runs(self):
+        coords = CoordDB(os.path.join(self.dir, 'coords'))
+        for osmid in range(1, 61):
+            coords.put(osmid, osmid / 10.0, -osmid / 10.0)
+        ways = WayDB(os.path.join(self.dir, 'ways'))
+        for way_id, refs in self.join_ways():
+            ways.put(way_id, {}, refs)
+        self.check_join(coords, ways)
+        ways.close()
+        coords.close()
+        os.unlink(os.path.join(self.dir, 'coords'))
+        os.unlink(os.path.join(self.dir, 'ways'))
+
+    def test_join_iterable(self):
+        coords = DeltaCoordsDB(os.path.join(self.dir, 'coords'))
+        for osmid in range(1, 61):
+            coords.put(osmid, osmid / 10.0, -osmid / 10.0)
+        coords.close()
+        coords = DeltaCoordsDB(os.path.join(self.dir, 'coords'), 'r')
+        self.check_join(coords, [Way(way_id, {}, refs) for way_id, refs in self.join_ways()])
+        coords.close()
+        os.unlink(os.path.join(self.dir, 'coords'))
+
+
+class TestMergeCaches(object):
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def source(self, name):
+        path = os.path.join(self.dir, name)
+        os.mkdir(path)
+        return OSMCache(path)
+
+    def test_merge(self):
+        a = self.source('a')
+        a.update_tag_dict(['highway'])
+        coords = a.coords_cache('w')
+        for osmid in (1, 2, 3):
+            coords.put(osmid, osmid, 1)
+        a.nodes_cache('w').put(1, {'highway': 'stop'}, (1, 1))
+        a.ways_cache('w').put(10, {'highway': 'primary'}, [1, 2, 3])
+        a.close_all()
+
+        b = self.source('b')
+        coords = b.coords_cache('w')
+        for osmid in (3, 4):
+            coords.put(osmid, osmid, 2)
+        b.ways_cache('w').put(10, {'name': 'foo'}, [3, 4])
+        b.ways_cache('w').put(11, {}, [4, 3])
+        b.relations_cache('w').put(20, {'type': 'multipolygon'}, [(10, 'way', 'outer')])
+        b.close_all()
+
+        cache = OSMCache(self.dir)
+        counts = cache.merge_caches([a, b])
+        eq_(counts, {'coords': 4, 'nodes': 1, 'ways': 2, 'relations': 1})
+
+        coords = cache.coords_cache()
+        eq_([osmid for osmid, _ in coords], [1, 2, 3, 4])
+        # coords of the first cache are used
+        assert_almost_equal(coords.get(3)[1], 1.0, 6)
+        way = cache.ways_cache().get(10)
+        eq_(way.tags, {'highway': 'primary', 'name': 'foo'})
+        eq_(way.refs, [1, 2, 3, 4])
+        eq_(cache.ways_cache().get(11).refs, [4, 3])
+        eq_(cache.nodes_cache().get(1).tags, {'highway': 'stop'})
+        eq_(cache.relations_cache().get(20).members, [(10, 'way', 'outer')])
+        cache.close_all()
+
+
+class TestTaggedWays(object):
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        self.old_shards = imposm.config.imposm_cache_shards
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+        imposm.config.imposm_cache_shards = self.old_shards
+
+    def check_tagged_ways(self):
+        cache = OSMCache(self.dir)
+        ways = cache.ways_cache('w')
+        for osmid in range(1, 200):
+            tags = {}
+            if osmid % 3 == 0:
+                tags = {'highway': 'primary'}
+            ways.put(osmid, tags, [1, 2])
+        cache.close_all()
+
+        tagged = cache.tagged_ways_cache()
+        eq_(len(tagged), 66)
+        eq_([way.osm_id for way in tagged], range(3, 200, 3))
+        # member ways are still in the ways cache
+        eq_(cache.ways_cache().get(4).refs, [1, 2])
+        cache.close_all()
+
+    def test_tagged_ways(self):
+        self.check_tagged_ways()
+
+    def test_iter_ids(self):
+        ways = WayDB(os.path.join(self.dir, 'ways.cache'))
+        for osmid in range(1, 10):
+            ways.put(osmid, {'name': str(osmid)}, [1, 2])
+        ids = IdBitmap(os.path.join(self.dir, 'ids.cache'))
+        ids.update([2, 5, 42])
+        eq_([way.osm_id for way in ways.iter_ids(ids)], [2, 5])
+        freeze_db(ways, os.path.join(self.dir, 'frozen.cache'))
+        ways.close()
+        frozen = FrozenWayDB(os.path.join(self.dir, 'frozen.cache'))
+        eq_([way.tags['name'] for way in frozen.iter_ids(ids)], ['2', '5'])
+        frozen.close()
+        ids.close()
+
+    def test_sharded(self):
+        imposm.config.imposm_cache_shards = 3
+        self.check_tagged_ways()
+
+    def test_without_index(self):
+        cache = OSMCache(self.dir)
+        cache.ways_cache('w').put(1, {'highway': 'primary'}, [1, 2])
+        cache.close_all()
+        os.unlink(os.path.join(self.dir, 'imposm_tagged_ways.cache'))
+        assert cache.tagged_ways_cache() is None
+
+        # no index for ways that are added to the existing cache
+        cache.ways_cache('w').put(2, {'highway': 'primary'}, [1, 2])
+        cache.close_all()
+        assert cache.tagged_ways_cache() is None
+
+    def test_stale_index(self):
+        cache = OSMCache(self.dir)
+        cache.ways_cache('w').put(1, {'highway': 'primary'}, [1, 2])
+        cache.close_all()
+        assert os.path.join(self.dir, 'imposm_tagged_ways.cache') in cache.files()
+        os.unlink(os.path.join(self.dir, 'imposm_ways.cache'))
+
+        # the index of the removed cache is not reused for the new cache
+        ways = cache.ways_cache('w')
+        ways.put(1, {}, [1, 2])
+        ways.put(2, {'highway': 'primary'}, [1, 2])
+        cache.close_all()
+        eq_([way.osm_id for way in cache.tagged_ways_cache()], [2])
+        cache.close_all()
+
+
+
+class TestMemoryCache(object):
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+        imposm.config.imposm_memory_cache = False
+        imposm.config.imposm_memory_cache_path = '/dev/shm'
+
+    def test_memory_cache_dir(self):
+        imposm.config.imposm_memory_cache_path = self.dir
+        path = memory_cache_dir()
+        eq_(os.path.dirname(path), self.dir)
+        imposm.config.imposm_memory_cache_path = os.path.join(self.dir, 'missing')
+        assert_raises(IOError, memory_cache_dir)
+
+    def test_copy_sparse(self):
+        src = os.path.join(self.dir, 'src')
+        dst = os.path.join(self.dir, 'dst')
+        with open(src, 'wb') as f:
+            f.write('foo')
+            f.seek(8 * 1024 * 1024)
+            f.write('bar')
+            f.seek(16 * 1024 * 1024)
+            f.truncate()
+        copy_sparse(src, dst)
+        eq_(os.path.getsize(dst), 16 * 1024 * 1024)
+        with open(dst, 'rb') as f:
+            eq_(f.read(3), 'foo')
+            f.seek(8 * 1024 * 1024)
+            eq_(f.read(3), 'bar')
+        assert os.stat(dst).st_blocks * 512 < 8 * 1024 * 1024
+
+    def test_copy_files(self):
+        memory = os.path.join(self.dir, 'memory')
+        os.mkdir(memory)
+        cache = OSMCache(memory)
+        db = cache.coords_cache('w')
+        db.put(1, 2, 3)
+        cache.update_tag_dict(['highway'])
+        with open(os.path.join(self.dir, 'imposm_old.cache'), 'w') as f:
+            f.write('old')
+
+        copied = cache.copy_files(self.dir)
+        eq_([os.path.basename(f) for f in copied], ['imposm_coords.cache', 'imposm_tags.cache'])
+        eq_(OSMCache(self.dir).files(), copied)
+        assert_almost_equal(OSMCache(self.dir).coords_cache().get(1)[0], 2.0, 6)
+
+    def test_uncompressed(self):
+        imposm.config.imposm_memory_cache = True
+        eq_(tuning_profile('ways', 10**6)['compress'], None)
+
+
+class TestCoordsPrecision(object):
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.dir, 'coords.cache')
+
+    def teardown(self):
+        imposm.config.imposm_coords_precision = None
+        shutil.rmtree(self.dir)
+
+    def test_coords_precision(self):
+        eq_(coords_precision(None), None)
+        eq_(coords_precision('osm'), 1e-7)
+        eq_(coords_precision('1e-5'), 1e-5)
+        for invalid in ('foo', 1e-8):
+            try:
+                coords_precision(invalid)
+            except ValueError:
+                pass
+            else:
+                assert False, 'expected ValueError'
+
+    def check_precision(self, coords_db):
+        imposm.config.imposm_coords_precision = 'render'
+        db = coords_db(self.fname)
+        eq_(db.precision, 1e-6)
+        db.put(1, 8.1234567, -53.1234567)
+        db.put(2, 180, 90)
+        db.close()
+
+        # stored precision is used for existing caches
+        imposm.config.imposm_coords_precision = None
+        db = coords_db(self.fname, 'r')
+        eq_(db.precision, 1e-6)
+        x, y = db.get(1)
+        assert_almost_equal(x, 8.123457, 6)
+        assert_almost_equal(y, -53.123457, 6)
+        assert_almost_equal(db.get(2)[0], 180.0, 6)
+        eq_(list(db.get_ways_coords_array([[1, 2]])[0])[2:], [180.0, 90.0])
+        return db
+
+    def test_coord_db(self):
+        db = self.check_precision(CoordDB)
+        eq_(len(db), 2)
+        eq_([osmid for osmid, _ in db], [1, 2])
+        eq_([osmid for osmid, _ in db.iter_raw()], [1, 2])
+        eq_(db.header(), {'coords_precision': 1e-6})
+        db.close()
+
+    def test_delta_coords_db(self):
+        self.check_precision(DeltaCoordsDB).close()
+
+    def test_dense_coord_db(self):
+        self.check_precision(DenseCoordDB).close()
+
+    def test_default_without_header(self):
+        db = CoordDB(self.fname)
+        db.put(1, 8, 53)
+        eq_(db.precision, None)
+        eq_(db.header(), None)
+        db.close()
+
 class TestCoordDB(object):
     testclass = CoordDB
     def setup(self):
@@ -118,6 +1027,81 @@ class TestCoordDB(object):
         assert not self.db.put(2001, 123, 456)
         assert not self.db.get(2001)
 
+    def test_threaded_lookups(self):
+        for osmid in range(1000):
+            assert self.db.put(osmid, osmid / 10.0, 1)
+        self.db.close()
+        imposm.config.imposm_write_threads = 4
+        try:
+            self.db = self.testclass(self.fname, 'r')
+        finally:
+            imposm.config.imposm_write_threads = 1
+
+        errors = []
+        def lookup():
+            for _ in range(20):
+                coords, offsets, missing = self.db.get_ways_coords_array(
+                    [range(1000), [999, 1001]])
+                if list(missing) != [0, 1] or abs(coords[999 * 2] - 99.9) > 1e-6:
+                    errors.append((list(missing), coords[999 * 2]))
+                if abs(self.db.get(500)[0] - 50.0) > 1e-6:
+                    errors.append(self.db.get(500))
+        threads = [threading.Thread(target=lookup) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        eq_(errors, [])
+
+    def test_put_packed(self):
+        buf = mmap.mmap(-1, 4096)
+        size = pack_coords([(3, 3.0, 30.0), (1, 1.0, 10.0), (2, 2.0, 20.0)], buf)
+        eq_(size, 3 * PACKED_COORD_SIZE)
+        coords = PackedCoords()
+        coords.extend(buf, size)
+        coords.sort()
+        eq_([osmid for osmid, _, _ in coords], [1, 2, 3])
+
+        eq_(self.db.put_packed(coords, 2), 2)
+        coords.remove(2)
+        eq_(len(coords), 1)
+        eq_(self.db.put_packed(coords), 1)
+        for osmid in (1, 2, 3):
+            assert_almost_equal(self.db.get(osmid)[1], osmid * 10.0, 6)
+
+        assert_raises(ValueError, pack_coords, [(1, 1.0, 1.0)] * 1000, buf)
+
+    def test_append_stats(self):
+        for osmid in [1, 2, 5, 3, 6]:
+            assert self.db.put(osmid, 10, 20)
+        eq_(self.db.stats(), {'appended': 4, 'unordered': 1})
+
+    def test_get_ways_coords_array(self):
+        assert self.db.put(1000, 10, 20)
+        assert self.db.put(1001, 11, 21)
+        assert self.db.put(1002, 12, 22)
+
+        coords, offsets, missing = self.db.get_ways_coords_array(
+            [[1000, 1001], [1000, 2000], [1002, 1000]])
+        eq_(list(offsets), [0, 2, 4, 6])
+        eq_(list(missing), [0, 1, 0])
+        for i, c in enumerate([10, 20, 11, 21]):
+            assert_almost_equal(coords[i], c, 6)
+        for i, c in enumerate([12, 22, 10, 20]):
+            assert_almost_equal(coords[8+i], c, 6)
+
+        eq_(len(self.db.get_coords_array([1002, 1001])), 4)
+        assert self.db.get_coords_array([1002, 2000]) is None
+
+    def test_advise(self):
+        assert self.db.put(1000, 10, 20)
+        self.db.close()
+        self.db = self.testclass(self.fname, 'r')
+        for hint in ('sequential', 'willneed', 'random'):
+            self.db.advise(hint)
+        assert_raises(ValueError, self.db.advise, 'unknown')
+        assert_almost_equal(self.db.get(1000)[0], 10.0, 6)
+
 
 class TestDeltaCoordDB(TestCoordDB):
     testclass = DeltaCoordsDB
@@ -125,3 +1109,323 @@ class TestDeltaCoordDB(TestCoordDB):
     def setup(self):
         fd_, self.fname = tempfile.mkstemp('.db')
         self.db = DeltaCoordsDB(self.fname)
+
+    def test_append_stats(self):
+        # unordered coords are added to their block, there is no
+        # append/unordered distinction
+        for osmid in [1, 2, 5, 3, 6]:
+            assert self.db.put(osmid, 10, 20)
+        stats = self.db.stats()
+        eq_((stats['items'], stats['misses'], stats['hits']), (1, 1, 4))
+        self.db.close()
+
+        self.db = DeltaCoordsDB(self.fname, 'r')
+        eq_([self.db.get(osmid) is not None for osmid in range(1, 7)],
+            [True, True, True, False, True, True])
+
+    def test_block_cache_eviction(self):
+        self.db.close()
+        # room for two blocks
+        self.db = DeltaCoordsDB(self.fname, block_cache_size=0.02)
+        for i in range(1000):
+            assert self.db.put(i * 20, i / 10.0, 0)
+        assert self.db.stats()['evictions'] > 100
+        self.db.close()
+
+        self.db = DeltaCoordsDB(self.fname, 'r', block_cache_size=0.02)
+        for i in range(1000):
+            assert_almost_equal(self.db.get(i * 20)[0], i / 10.0, 6)
+        assert self.db.get(1) is None
+        stats = self.db.stats()
+        eq_(stats['hits'] + stats['misses'], 1001)
+
+    def test_prefetch(self):
+        for i in range(1000):
+            assert self.db.put(i * 20, i / 10.0, 0)
+        self.db.close()
+
+        self.db = DeltaCoordsDB(self.fname, 'r')
+        self.db.prefetch([980, 20, 500, 19980])
+        eq_(len(self.db.delta_nodes), 4)
+        coords, offsets, missing = self.db.get_ways_coords_array([[500, 20], [19980]])
+        eq_(list(missing), [0, 0])
+        assert_almost_equal(coords[0], 2.5, 6)
+        assert_almost_equal(coords[4], 99.9, 6)
+        stats = self.db.stats()
+        eq_((stats['hits'], stats['misses']), (3, 0))
+        eq_(self.db.io_stats()['block_prefetches'], 4)
+
+    def test_put_packed_blocks(self):
+        buf = mmap.mmap(-1, 4 * 4096)
+        coords = PackedCoords()
+        # unsorted ids of four blocks
+        ids = [i * 37 % 200 for i in range(200)]
+        coords.extend(buf, pack_coords([(osmid, i / 10.0, 1.0) for i, osmid in enumerate(ids)], buf))
+        eq_(self.db.put_packed(coords), 200)
+        eq_(len(self.db.delta_nodes), 4)
+        self.db.close()
+
+        self.db = DeltaCoordsDB(self.fname, 'r')
+        eq_([osmid for osmid, _ in self.db], range(200))
+        for i, osmid in enumerate(ids):
+            assert_almost_equal(self.db.get(osmid)[0], i / 10.0, 6)
+
+    def test_threaded_block_cache(self):
+        for i in range(2000):
+            assert self.db.put(i * 5, i / 20.0, 0)
+        self.db.close()
+        imposm.config.imposm_write_threads = 4
+        try:
+            # the threads evict the blocks of each other
+            self.db = DeltaCoordsDB(self.fname, 'r', block_cache_size=0.02)
+        finally:
+            imposm.config.imposm_write_threads = 1
+
+        errors = []
+        def lookup(offset):
+            for n in range(20):
+                ids = [(offset + n + j * 37) % 2000 for j in range(100)]
+                coords, offsets, missing = self.db.get_ways_coords_array(
+                    [[i * 5 for i in ids]])
+                for j, i in enumerate(ids):
+                    if abs(coords[j * 2] - i / 20.0) > 1e-6:
+                        errors.append((i, coords[j * 2]))
+                if abs(self.db.get(ids[0] * 5)[0] - ids[0] / 20.0) > 1e-6:
+                    errors.append(ids[0])
+        threads = [threading.Thread(target=lookup, args=(i * 500, )) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        eq_(errors, [])
+        assert self.db.stats()['evictions'] > 0
+
+    def test_get_ways_coords_array_blocks(self):
+        for i in range(1000):
+            assert self.db.put(i * 3, i / 10.0, -i / 10.0)
+        ways_refs = [range(0, 3000, 7), [2997, 0, 1500], [6, 64, 3000], []]
+        coords, offsets, missing = self.db.get_ways_coords_array(ways_refs)
+        eq_(list(offsets), [0, 429, 432, 435, 435])
+        eq_(list(missing), [1, 0, 1, 0])
+        for i, ref in enumerate([2997, 0, 1500]):
+            x, y = self.db.get(ref)
+            assert_almost_equal(coords[(429 + i) * 2], x, 6)
+            assert_almost_equal(coords[(429 + i) * 2 + 1], y, 6)
+
+    def test_iter(self):
+        for i in range(200):
+            assert self.db.put(i * 3, i / 2.0, 0)
+        self.db.close()
+
+        self.db = DeltaCoordsDB(self.fname, 'r')
+        items = list(self.db)
+        eq_([osmid for osmid, _ in items], range(0, 600, 3))
+        assert_almost_equal(items[-1][1][0], 99.5, 6)
+
+
+class TestDeltaNodes(object):
+    def test_serialize(self):
+        nodes = DeltaNodes()
+        nodes.add(1005, 10.0, 50.0)
+        nodes.add(1000, -180.0, -90.0)
+        nodes.add(1010, 180.0, 90.0)
+        nodes.add(1005, 11.0, 51.0) # overwrite
+
+        data = nodes.serialize()
+        eq_(data[0], '\x01')
+        nodes = DeltaNodes(data)
+        eq_([n[0] for n in nodes.nodes], [1000, 1005, 1010])
+        assert_almost_equal(nodes.get(1005)[0], 11.0, 6)
+        assert_almost_equal(nodes.get(1000)[1], -90.0, 6)
+        assert_almost_equal(nodes.get(1010)[0], 180.0, 6)
+        assert nodes.get(1001) is None
+
+    def test_protobuf_data(self):
+        from imposm.cache.internal import DeltaCoords
+        data = DeltaCoords()
+        data.ids = [1000, 5]
+        data.lons = [2147483647, 11930464]
+        data.lats = [2147483647, -11930464]
+        nodes = DeltaNodes(data.SerializeToString())
+        eq_(len(nodes), 2)
+        assert_almost_equal(nodes.get(1000)[0], 0.0, 6)
+        assert_almost_equal(nodes.get(1005)[0], 1.0, 6)
+        assert_almost_equal(nodes.get(1005)[1], -1.0, 6)
+
+
+class TestSharedBlockCache(object):
+    def setup(self):
+        self.cache = SharedBlockCache(1)
+
+    def teardown(self):
+        self.cache.close()
+
+    def test_put_get(self):
+        nodes = DeltaNodes()
+        for i in range(64):
+            nodes.add(640 + i, i / 10.0, -i / 10.0)
+        assert self.cache.get(10) is None
+        assert self.cache.put(10, nodes)
+        eq_(self.cache.get(10).nodes, nodes.nodes)
+        assert self.cache.get(11) is None
+
+    def test_too_large_block(self):
+        nodes = DeltaNodes()
+        for i in range(65):
+            nodes.add(i * 2, 0, 0)
+        assert not self.cache.put(1, nodes)
+        assert self.cache.get(1) is None
+
+    def test_shared_with_child_process(self):
+        pid = os.fork()
+        if pid == 0:
+            nodes = DeltaNodes()
+            nodes.add(1000, 1.0, 2.0)
+            self.cache.put(15, nodes)
+            os._exit(0)
+        os.waitpid(pid, 0)
+        nodes = self.cache.get(15)
+        assert_almost_equal(nodes.get(1000)[1], 2.0, 6)
+
+    def test_delta_coords_db(self):
+        fd_, fname = tempfile.mkstemp('.db')
+        try:
+            db = DeltaCoordsDB(fname)
+            for i in range(100):
+                assert db.put(i, i / 10.0, 0)
+            db.close()
+
+            db = DeltaCoordsDB(fname, 'r', shared_blocks=self.cache)
+            assert_almost_equal(db.get(50)[0], 5.0, 6)
+            db.close()
+            eq_(len(self.cache.get(0)), 64)
+
+            db = DeltaCoordsDB(fname, 'r', shared_blocks=self.cache)
+            assert_almost_equal(db.get(70)[0], 7.0, 6)
+            assert_almost_equal(db.get(20)[0], 2.0, 6)
+            eq_(db.io_stats()['shared_block_hits'], 1)
+            db.close()
+        finally:
+            os.unlink(fname)
+
+
+class TestDenseCoordDB(object):
+    def setup(self):
+        fd_, self.fname = tempfile.mkstemp('.db')
+        os.unlink(self.fname)
+        self.db = DenseCoordDB(self.fname)
+
+    def teardown(self):
+        self.db.close()
+        os.unlink(self.fname)
+
+    def test_put_packed(self):
+        buf = mmap.mmap(-1, 4096)
+        coords = PackedCoords()
+        coords.extend(buf, pack_coords([(5, 5.0, 50.0), (1000, 1.0, 10.0)], buf))
+        eq_(self.db.put_packed(coords), 2)
+        assert_almost_equal(self.db.get(1000)[1], 10.0, 6)
+        assert_almost_equal(self.db.get(5)[0], 5.0, 6)
+
+    def test_insert(self):
+        assert self.db.put(1000, 123, 179.123456789)
+        assert self.db.put(2**31, 123, 179.123456789)
+
+        pos = self.db.get(1000)
+        assert_almost_equal(pos[0], 123.0, 6)
+        assert_almost_equal(pos[1], 179.123456789, 6)
+
+        assert self.db.get(2**31)
+        assert not self.db.get(999)
+        assert not self.db.get(2**32)
+        assert not self.db.get(-1)
+        assert not self.db.put(-1, 123, 0)
+
+    def test_read_only(self):
+        assert self.db.put(1000, 123, 0)
+        assert self.db.put(1001, -180.0, -90)
+        assert self.db.put(1010, 180, 90)
+        self.db.close()
+        eq_(os.path.getsize(self.fname), 4096 + 1011 * 8)
+
+        self.db = DenseCoordDB(self.fname, 'r')
+
+        pos = self.db.get(1001)
+        assert_almost_equal(pos[0], -180.0, 6)
+        assert_almost_equal(pos[1], -90.0, 6)
+
+        pos = self.db.get(1010)
+        assert_almost_equal(pos[0], 180.0, 6)
+        assert_almost_equal(pos[1], 90.0, 6)
+
+        assert 1000 in self.db
+        assert 1002 not in self.db
+        eq_([osmid for osmid, _ in self.db], [1000, 1001, 1010])
+
+        eq_(len(self.db.get_coords([1000, 1001, 1010])), 3)
+        assert self.db.get_coords([1000, 1002]) is None
+
+        coords, offsets, missing = self.db.get_ways_coords_array(
+            [[1000, 1001], [1010, 2**40], []])
+        eq_(list(offsets), [0, 2, 4, 4])
+        eq_(list(missing), [0, 1, 0])
+        assert_almost_equal(coords[2], -180.0, 6)
+
+        assert not self.db.put(2001, 123, 456)
+        assert not self.db.get(2001)
+
+    def test_not_a_dense_file(self):
+        self.db.close()
+        with open(self.fname, 'wb') as f:
+            f.write('ToKyO CaBiNeT\n')
+        try:
+            DenseCoordDB(self.fname, 'r')
+        except IOError:
+            pass
+        else:
+            assert False, 'expected IOError'
+
+class TestIdBitmap(object):
+    def setup(self):
+        fd_, self.fname = tempfile.mkstemp('.db')
+        os.unlink(self.fname)
+        self.db = IdBitmap(self.fname)
+
+    def teardown(self):
+        self.db.close()
+        if os.path.exists(self.fname):
+            os.unlink(self.fname)
+
+    def test_insert(self):
+        assert self.db.put(1000)
+        assert self.db.put(2**31)
+        self.db.update([7, 8, 1000])
+        assert not self.db.put(-1)
+
+        assert 1000 in self.db
+        assert 2**31 in self.db
+        assert 7 in self.db and 8 in self.db
+        assert 999 not in self.db
+        assert 2**32 not in self.db
+        assert -1 not in self.db
+        eq_(len(self.db), 4)
+        eq_(list(self.db), [7, 8, 1000, 2**31])
+
+    def test_read_only(self):
+        self.db.update([0, 15, 1000])
+        self.db.close()
+        eq_(os.path.getsize(self.fname), 4096 + 1000 // 8 + 1)
+
+        self.db = IdBitmap(self.fname, 'r')
+        eq_(list(self.db), [0, 15, 1000])
+        assert 1000 in self.db
+        assert 1001 not in self.db
+        assert not self.db.put(1001)
+
+    def test_missing_file(self):
+        self.db.close()
+        os.unlink(self.fname)
+        self.db = IdBitmap(self.fname, 'r')
+        assert 1 not in self.db
+        eq_(len(self.db), 0)
+        eq_(list(self.db), [])
@@ -12,10 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from imposm.dbimporter import DictBasedImporter, TupleBasedImporter
+import threading
+from Queue import Queue
+
+import imposm.config
+from imposm.dbimporter import ImporterProcess, DictBasedImporter, TupleBasedImporter
 from imposm import defaultmapping
 
-from nose.tools import eq_, assert_almost_equal
+from nose.tools import eq_, assert_almost_equal, assert_raises
 
 class TestDictBasedImporter(object):
     def setup(self):
@@ -98,3 +102,54 @@ class TestTupleBasedImporter(object):
         eq_(landusages_item[0], defaultmapping.landusages)
         eq_(landusages_item[1], 1234)
         eq_(landusages_item[3], ['roundabout', 'grass', 6195822904.182782, 27])
+
+class TestProcessBatches(object):
+    def teardown(self):
+        imposm.config.imposm_write_threads = 1
+
+    def check_process_batches(self):
+        in_queue = Queue()
+        for i in range(100):
+            in_queue.put([i])
+        in_queue.put(None)
+        importer = ImporterProcess(in_queue, None, None, None, dry_run=False)
+
+        handled = []
+        handled_by = set()
+        def handle(batch):
+            handled.extend(batch)
+            handled_by.add(threading.current_thread())
+        importer.process_batches(handle)
+        eq_(sorted(handled), range(100))
+        return handled_by
+
+    def test_without_threads(self):
+        eq_(self.check_process_batches(), set([threading.current_thread()]))
+
+    def test_threads(self):
+        imposm.config.imposm_write_threads = 4
+        assert threading.current_thread() not in self.check_process_batches()
+
+    def check_error(self, fails):
+        in_queue = Queue()
+        for i in range(100):
+            in_queue.put([i])
+        in_queue.put(None)
+        importer = ImporterProcess(in_queue, None, None, None, dry_run=False)
+
+        handled = []
+        def handle(batch):
+            if fails(batch[0]):
+                raise ValueError(batch[0])
+            handled.extend(batch)
+        assert_raises(ValueError, importer.process_batches, handle)
+        assert len(handled) < 100
+
+    def test_error(self):
+        self.check_error(lambda i: i == 3)
+
+    def test_error_threads(self):
+        imposm.config.imposm_write_threads = 4
+        self.check_error(lambda i: i == 3)
+        # does not block if all threads fail
+        self.check_error(lambda i: True)
@@ -0,0 +1,61 @@
+# Copyright 2011 Omniscale (http://omniscale.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from array import array
+
+from imposm.base import OSMElem
+from imposm.geom import FlatCoords, flat_coords, LineStringBuilder, PolygonBuilder
+
+from nose.tools import eq_
+
+class TestFlatCoords(object):
+    def setup(self):
+        self.coords = FlatCoords(array('d', [0, 0, 10, 0, 10, 10, 0, 10, 0, 0]))
+
+    def test_sequence(self):
+        eq_(len(self.coords), 5)
+        eq_(self.coords[0], (0, 0))
+        eq_(self.coords[-1], (0, 0))
+        eq_(self.coords[2], (10, 10))
+        eq_(list(self.coords), [(0, 0), (10, 0), (10, 10), (0, 10), (0, 0)])
+        eq_(list(self.coords[1:3]), [(10, 0), (10, 10)])
+        eq_(list(self.coords[::-2]), [(0, 0), (10, 10), (0, 0)])
+        try:
+            self.coords[5]
+        except IndexError:
+            pass
+        else:
+            assert False, 'expected IndexError'
+
+    def test_flat_coords(self):
+        coords = array('d', [1, 2, 3, 4, 5, 6])
+        offsets = array('l', [0, 1, 1, 3])
+        eq_(list(flat_coords(coords, offsets, 0)), [(1, 2)])
+        eq_(list(flat_coords(coords, offsets, 1)), [])
+        eq_(list(flat_coords(coords, offsets, 2)), [(3, 4), (5, 6)])
+
+    def test_linestring(self):
+        elem = OSMElem(1, self.coords[:3], ('highway', 'primary'), {})
+        geom = LineStringBuilder().build_checked_geom(elem)
+        eq_(list(geom.coords), [(0, 0), (10, 0), (10, 10)])
+
+    def test_split_linestring(self):
+        geoms = LineStringBuilder().to_geom(self.coords, max_length=3)
+        eq_([list(g.coords) for g in geoms],
+            [[(0, 0), (10, 0), (10, 10)], [(10, 10), (0, 10), (0, 0)]])
+
+    def test_polygon(self):
+        elem = OSMElem(1, self.coords, ('landuse', 'forest'), {})
+        geom = PolygonBuilder().build_checked_geom(elem, validate=True)
+        eq_(geom.area, 100)
@@ -0,0 +1,59 @@
+# Copyright 2011 Omniscale (http://omniscale.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+
+from imposm.base import Way
+from imposm.merge import merge, multimerge
+
+from nose.tools import eq_
+
+def test_merge():
+    eq_(merge([1, 2, 3], [3, 4]), [1, 2, 3, 4])
+    eq_(merge([3, 4], [1, 2, 3]), [1, 2, 3, 4])
+    eq_(merge([1, 2, 3, 4], [2, 3]), [1, 2, 3, 4])
+    eq_(merge([2, 3], [1, 2, 3, 4]), [1, 2, 3, 4])
+    eq_(merge([1, 2, 3], [1, 2, 3]), [1, 2, 3])
+    assert merge([1, 2], [3, 4]) is None
+    assert merge([], [1]) is None
+
+def test_merge_closed_way():
+    eq_(merge([1, 2, 3, 1], [1, 5]), [1, 2, 3, 1, 5])
+    eq_(merge([3, 4, 1], [1, 2, 3]), [1, 2, 3, 4, 1])
+
+def test_merge_multiple_blocks():
+    # same results as difflib.SequenceMatcher
+    eq_(merge([1, 2, 3, 4, 5], [0, 2, 3, 7, 5]), [1, 0, 2, 3, 4, 7, 5])
+    eq_(merge([7, 8, 9, 1], [1, 7, 8, 9]), [1, 7, 8, 9, 1])
+
+def test_multimerge_extracts():
+    random.seed(42)
+    for _ in range(100):
+        way = range(1000, 1000 + random.randint(10, 500))
+        parts = []
+        start = 0
+        for end in sorted(random.sample(xrange(1, len(way)), 5)) + [len(way)]:
+            parts.append(way[max(0, start - random.randint(1, 3)):end])
+            start = end
+        random.shuffle(parts)
+        eq_(multimerge(parts), way)
+
+def test_multimerge_gap():
+    eq_(multimerge([[1, 2], [5, 6], [2, 3]]), [[5, 6], [1, 2, 3]])
+
+def test_way_merge():
+    way = Way(1, {}, [[1, 2, 3], [5, 6]])
+    way.merge({}, [3, 4, 5])
+    eq_(way.refs, [1, 2, 3, 4, 5, 6])
+    eq_(way.partial_refs, None)
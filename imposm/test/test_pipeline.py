@@ -0,0 +1,74 @@
+# Copyright 2011 Omniscale (http://omniscale.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+from Queue import Queue
+from multiprocessing import Process, JoinableQueue
+
+import imposm.config
+from imposm import pipeline
+
+from nose.tools import eq_
+
+class TestPipelineStats(object):
+    def setup(self):
+        imposm.config.imposm_pipeline_stats = True
+
+    def teardown(self):
+        imposm.config.imposm_pipeline_stats = False
+        pipeline.report('test', lambda msg: None)
+
+    def test_disabled(self):
+        imposm.config.imposm_pipeline_stats = False
+        queue = Queue()
+        assert pipeline.instrument(queue, 'nodes', 16) is queue
+        assert pipeline.start_sampler([queue]) is None
+
+    def test_queue_stats(self):
+        queue = pipeline.instrument(Queue(2), 'ways', 2)
+        sampler = pipeline.start_sampler([queue])
+        queue.put(1)
+        queue.put(2)
+        time.sleep(0.5)
+        eq_(queue.get(), 1)
+        sampler.stop()
+
+        stats = queue.stats.stats()
+        eq_((stats['puts'], stats['gets']), (2, 1))
+        eq_(stats['max_depth'], 2)
+        assert stats['full'] >= 1
+
+        messages = []
+        pipeline.report('writing', messages.append)
+        eq_(len(messages), 1)
+        assert messages[0].startswith('writing pipeline ways queue: 2 puts'), messages[0]
+        # stats are reset after each phase
+        messages = []
+        pipeline.report('writing', messages.append)
+        eq_(messages, [])
+
+    def test_shared_stats(self):
+        a = pipeline.instrument(JoinableQueue(), 'coords', 16)
+        b = pipeline.instrument(JoinableQueue(), 'coords', 16)
+        eq_(a.stats.consumers, 2)
+
+        def put():
+            a.put(1)
+            b.put(2)
+        proc = Process(target=put)
+        proc.start()
+        proc.join()
+        eq_((a.get(), b.get()), (1, 2))
+        stats = a.stats.stats()
+        eq_((stats['puts'], stats['gets']), (2, 2))
@@ -93,6 +93,18 @@ class TestTagMapper(object):
         eq_(tagfilter({'name': 'foo', 'boundary': 'administrative', 'type': 'boundary'}),
             {'name': 'foo', 'boundary': 'administrative', 'type': 'boundary'})
 
+    def test_tag_strings(self):
+        strings = self.tag_mapping.tag_strings()
+        for s in ('highway', 'residential', 'building', 'name', 'type', 'multipolygon'):
+            assert s in strings, s
+        assert '__any__' not in strings
+
+    def test_tag_filter_hash(self):
+        mappings = self.tag_mapping.mappings
+        eq_(TagMapper(list(reversed(mappings))).tag_filter_hash(),
+            self.tag_mapping.tag_filter_hash())
+        assert TagMapper(mappings[1:]).tag_filter_hash() != self.tag_mapping.tag_filter_hash()
+
     def test_mapping_for_nodes(self):
         for_nodes = self.tag_mapping.for_nodes
         eq_mapping(for_nodes({'unknown': 'baz'}), [])
@@ -220,6 +220,32 @@ class MMapPool(object):
     def free(self, idx):
         self.free_queue.put(idx)
 
+class MMapRing(object):
+    """
+    Ring of `n` shared memory buffers of `mmap_size` bytes for batches
+    that are sent from multiple processes. The sender `acquire`s a free
+    buffer and sends only its index to the receiver, which `release`s
+    the buffer after it read the batch. Senders block while all buffers
+    are in use.
+    """
+    def __init__(self, n, mmap_size):
+        self.n = n
+        self.mmap_size = mmap_size
+        self.pool = [mmap.mmap(-1, mmap_size) for _ in range(n)]
+        self.free_queue = multiprocessing.Queue()
+        for idx in range(n):
+            self.free_queue.put(idx)
+
+    def acquire(self):
+        idx = self.free_queue.get()
+        return idx, self.pool[idx]
+
+    def get(self, idx):
+        return self.pool[idx]
+
+    def release(self, idx):
+        self.free_queue.put(idx)
+
 
 def create_pool(creator, size):
     pool = []
@@ -17,6 +17,7 @@ from multiprocessing import Process, JoinableQueue
 from imposm.dbimporter import NodeProcessTuple, WayProcessTuple, RelationProcessTuple
 from imposm.dbimporter import NodeProcessDict, WayProcessDict, RelationProcessDict
 from imposm.util import create_pool, shutdown_pool
+from imposm import pipeline
 
 import_processes = {
     'tuple': {
@@ -42,10 +43,13 @@ class ImposmWriter(object):
         self.dry_run = dry_run
 
     def _write_elem(self, proc, elem_cache, log, pool_size, proc_args=[]):
-        queue = JoinableQueue(16)
+        queue = pipeline.instrument(JoinableQueue(16), log.title, 16, consumers=pool_size)
 
         importer = lambda: proc(queue, self.db, self.mapper, self.cache, self.dry_run, *proc_args)
         pool = create_pool(importer, pool_size)
+        sampler = pipeline.start_sampler([queue])
+
+        elem_cache.advise('sequential')
 
         data = []
         for i, elem in enumerate(elem_cache):
@@ -58,28 +62,49 @@ class ImposmWriter(object):
         queue.put(data)
 
         shutdown_pool(pool, queue)
+        if sampler:
+            sampler.stop()
         log.stop()
         self.cache.close_all()
+        self.cache.report_stats(log.title, log.message)
+        pipeline.report(log.title, log.message)
 
     def relations(self):
         self.cache.remove_inserted_way_cache()
+        # relations are built from ways and coords in random order
+        self.cache.warm_up(['coords', 'ways'])
         cache = self.cache.relations_cache()
         log = self.logger('relations', len(cache))
         inserted_way_queue = JoinableQueue()
         way_marker = WayMarkerProcess(inserted_way_queue, self.cache, self.logger)
         way_marker.start()
 
-        self._write_elem(import_processes[self.db.insert_data_format]['relation'],
-            cache, log, self.pool_size, [inserted_way_queue])
+        self.cache.open_shared_coords_cache()
+        try:
+            self._write_elem(import_processes[self.db.insert_data_format]['relation'],
+                cache, log, self.pool_size, [inserted_way_queue])
+        finally:
+            self.cache.close_shared_coords_cache()
 
         inserted_way_queue.put(None)
         way_marker.join()
 
     def ways(self):
-        cache = self.cache.ways_cache()
+        if self.cache.way_coords_cache() is not None:
+            self.cache.warm_up(['way_coords'])
+        else:
+            self.cache.warm_up(['coords'])
+        # skip the ways that are only members of relations
+        cache = self.cache.tagged_ways_cache()
+        if cache is None:
+            cache = self.cache.ways_cache()
         log = self.logger('ways', len(cache))
-        self._write_elem(import_processes[self.db.insert_data_format]['way'],
-            cache, log, self.pool_size)
+        self.cache.open_shared_coords_cache()
+        try:
+            self._write_elem(import_processes[self.db.insert_data_format]['way'],
+                cache, log, self.pool_size)
+        finally:
+            self.cache.close_shared_coords_cache()
         self.cache.remove_inserted_way_cache()
 
     def nodes(self):
@@ -100,10 +125,10 @@ class WayMarkerProcess(Process):
     def run(self):
         inserted_ways = self.cache.inserted_ways_cache('w')
         while True:
-            osmid = self.queue.get()
-            if osmid is None:
+            ids = self.queue.get()
+            if ids is None:
                 break
-            inserted_ways.put(osmid)
+            inserted_ways.update(ids)
 
         inserted_ways.close()
 